@@ -13,12 +13,16 @@ DROP TABLE IF EXISTS measurements CASCADE;
 
 -- Also drop our tables to allow idempotent re-runs in dev
 DROP TABLE IF EXISTS fact_measurement CASCADE;
+DROP TABLE IF EXISTS agg_measurement_daily CASCADE;
 DROP TABLE IF EXISTS dim_participant CASCADE;
 DROP TABLE IF EXISTS dim_study CASCADE;
 DROP TABLE IF EXISTS dim_site CASCADE;
 DROP TABLE IF EXISTS dim_measurement_type CASCADE;
 DROP TABLE IF EXISTS dim_unit CASCADE;
 DROP TABLE IF EXISTS etl_jobs CASCADE;
+DROP TABLE IF EXISTS etl_file_loads CASCADE;
+DROP TABLE IF EXISTS etl_rejects CASCADE;
+DROP TABLE IF EXISTS etl_work_queue CASCADE;
 
 -- ---------------------------------------------------------------------
 -- Dimension tables
@@ -56,8 +60,11 @@ CREATE TABLE dim_unit (
 -- ---------------------------------------------------------------------
 -- Fact table
 -- ---------------------------------------------------------------------
+-- Range-partitioned by ts month (optionally sub-partitioned by study_id).
+-- Partitions are created on demand by the ETL (etl-service/src/partitions.py)
+-- before a load touches them; there is no default partition.
 CREATE TABLE fact_measurement (
-  id                 BIGSERIAL PRIMARY KEY,
+  id                 BIGSERIAL,
 
   -- Natural keys
   study_id           TEXT NOT NULL REFERENCES dim_study(study_id) ON UPDATE CASCADE ON DELETE RESTRICT,
@@ -88,29 +95,141 @@ CREATE TABLE fact_measurement (
   CONSTRAINT fk_fact_participant
     FOREIGN KEY (study_id, participant_id)
     REFERENCES dim_participant(study_id, participant_id)
-    ON UPDATE CASCADE ON DELETE RESTRICT
+    ON UPDATE CASCADE ON DELETE RESTRICT,
+
+  -- the partition key must be part of the primary key
+  PRIMARY KEY (id, ts)
+) PARTITION BY RANGE (ts);
+
+-- ---------------------------------------------------------------------
+-- Daily rollups (see etl-service/src/rollups.py)
+-- Merged by the ETL in the same transaction as each loaded chunk;
+-- POST /rollups/rebuild recomputes a study and/or a day from the facts.
+-- ---------------------------------------------------------------------
+CREATE TABLE agg_measurement_daily (
+  study_id            TEXT NOT NULL,
+  site_id             TEXT NOT NULL,  -- '' when the fact has no site
+  measurement_type_id INT  NOT NULL REFERENCES dim_measurement_type(id),
+  day                 DATE NOT NULL,  -- UTC day of ts
+
+  n                   BIGINT NOT NULL,
+  n_invalid           BIGINT NOT NULL,
+
+  -- count / min / max / sum / sum of squares of the non-null values
+  value_count         BIGINT NOT NULL,
+  value_min           DOUBLE PRECISION,
+  value_max           DOUBLE PRECISION,
+  value_sum           DOUBLE PRECISION,
+  value_sumsq         DOUBLE PRECISION,
+  systolic_count      BIGINT NOT NULL,
+  systolic_min        SMALLINT,
+  systolic_max        SMALLINT,
+  systolic_sum        BIGINT,
+  systolic_sumsq      DOUBLE PRECISION,
+  diastolic_count     BIGINT NOT NULL,
+  diastolic_min       SMALLINT,
+  diastolic_max       SMALLINT,
+  diastolic_sum       BIGINT,
+  diastolic_sumsq     DOUBLE PRECISION,
+
+  flag_counts         JSONB NOT NULL DEFAULT '{}',  -- quality flag -> rows carrying it
+  updated_at          TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+
+  PRIMARY KEY (study_id, site_id, measurement_type_id, day)
 );
 
 -- ---------------------------------------------------------------------
 -- Job tracking (optional but useful for API/E2E tests)
 -- ---------------------------------------------------------------------
 CREATE TABLE etl_jobs (
-  id          UUID PRIMARY KEY,
-  filename    TEXT NOT NULL,
-  study_id    TEXT,
-  status      TEXT NOT NULL, -- queued|running|completed|failed
-  created_at  TIMESTAMPTZ NOT NULL DEFAULT NOW(),
-  updated_at  TIMESTAMPTZ NOT NULL DEFAULT NOW()
+  id              TEXT PRIMARY KEY,  -- UUID from the API; the ETL also accepts caller-chosen ids
+  filename        TEXT NOT NULL,
+  study_id        TEXT,
+  status          TEXT NOT NULL, -- pending|queued|running|completed|failed
+
+  -- Written by the ETL's job store flusher (batched, about once a second)
+  progress        SMALLINT NOT NULL DEFAULT 0,
+  message         TEXT,
+  load_mode       TEXT,
+  rows_processed  BIGINT NOT NULL DEFAULT 0,
+  rows_inserted   BIGINT NOT NULL DEFAULT 0,
+  rows_failed     BIGINT NOT NULL DEFAULT 0,
+  details         JSONB NOT NULL DEFAULT '{}',
+
+  created_at      TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+  updated_at      TIMESTAMPTZ NOT NULL DEFAULT NOW()
 );
 
+-- One row per distinct source file content and load options (see etl-service/src/checkpoint.py).
+-- Advanced in the same transaction as each loaded chunk, so a restarted job
+-- resumes exactly after the last committed row / piece.
+CREATE TABLE etl_file_loads (
+  content_hash    TEXT PRIMARY KEY,  -- sample:<hex> (sha256:<hex> for small files or ETL_HASH_MODE=full)/<options digest>
+  filename        TEXT NOT NULL,
+  size_bytes      BIGINT NOT NULL,
+  job_id          TEXT NOT NULL,     -- job currently (or last) loading this content
+  status          TEXT NOT NULL,     -- running|completed
+  rows_committed  BIGINT NOT NULL DEFAULT 0,
+  shards          INT,               -- sharded loads: plan used, so a resume cuts the same pieces
+  piece_bytes     BIGINT,
+  pieces_done     BIGINT[] NOT NULL DEFAULT '{}',  -- start offsets of committed pieces
+  created_at      TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+  updated_at      TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+
+-- Rows the ETL did not load (see etl-service/src/quarantine.py), written
+-- in the same transaction as their chunk; paged by GET /jobs/{id}/rejects.
+CREATE TABLE etl_rejects (
+  id              BIGSERIAL PRIMARY KEY,
+  job_id          TEXT NOT NULL,
+  filename        TEXT NOT NULL,
+  row_number      BIGINT,            -- 1-based data row (header not counted); NULL for sharded loads
+  raw             TEXT,              -- the row as CSV text
+  kind            TEXT NOT NULL,     -- error|invalid
+  reason          TEXT NOT NULL,
+  flags           TEXT[] NOT NULL DEFAULT '{}',
+  created_at      TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+
+CREATE INDEX idx_rejects_job ON etl_rejects (job_id, id);
+
+-- Jobs waiting for any ETL replica (ETL_WORK_QUEUE=postgres; see
+-- etl-service/src/workqueue.py). Claimed with FOR UPDATE SKIP LOCKED; a
+-- running item whose lease has expired can be claimed again.
+CREATE TABLE etl_work_queue (
+  id              BIGSERIAL PRIMARY KEY,
+  job_id          TEXT NOT NULL,
+  kind            TEXT NOT NULL,     -- file|batch
+  args            JSONB NOT NULL DEFAULT '{}',
+  status          TEXT NOT NULL DEFAULT 'queued',  -- queued|running|done|failed
+  worker          TEXT,              -- replica holding (or last holding) the lease
+  attempts        INT NOT NULL DEFAULT 0,
+  lease_until     TIMESTAMPTZ,
+  created_at      TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+  updated_at      TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+
+-- The claim scans only open items, oldest first
+CREATE INDEX idx_work_queue_open ON etl_work_queue (id)
+  WHERE status IN ('queued', 'running');
+
 -- ---------------------------------------------------------------------
 -- Indexes tuned for analytics
+-- (declared on the partitioned table, so every partition gets them; a
+-- partition attached after a detached load builds them in one pass)
 -- ---------------------------------------------------------------------
 
 -- Common filter pattern: participant time series per study
 CREATE INDEX idx_fact_study_part_ts
   ON fact_measurement (study_id, participant_id, ts DESC);
 
+-- Natural identity of a measurement: a re-sent reading is the same row.
+-- Every load into fact_measurement upserts on it (ETL_DEDUPE=skip, the
+-- default, keeps the stored row and counts the re-sent one as skipped;
+-- update replaces it). There is no mode that stores a key twice.
+CREATE UNIQUE INDEX uq_fact_natural_key
+  ON fact_measurement (study_id, participant_id, measurement_type_id, ts);
+
 -- Fast filtering/aggregates by measurement type and time
 CREATE INDEX idx_fact_meastype_ts
   ON fact_measurement (measurement_type_id, ts DESC);
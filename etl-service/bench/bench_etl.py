@@ -0,0 +1,276 @@
+# etl-service/bench/bench_etl.py
+"""
+Ingest throughput benchmarks: rows/sec and peak RSS per stage and load mode.
+
+    PYTHONPATH=src python bench/bench_etl.py --rows 200000 --invalid 0.02 \
+        --out bench-results.json --baseline bench/baseline.json
+
+Stages:
+  parse  read + parse only (CSVStream + parse_row / parse_batch)
+  buffer read + parse, keeping every parsed chunk (as a batch job's coalescer
+         holds them); reports bufferedMbPerMillionRows
+  load   load pre-parsed chunks (insert_rows / load_chunk); parse is untimed
+  e2e    main.process_file on the generated file, checkpointing included
+
+Loads go to an in-process stand-in connection (bench/standin.py) unless
+--postgres is given, in which case they go to the database configured by
+the usual POSTGRES_* variables (rows are really inserted there).
+
+Every stage runs in a fresh process so peak RSS is its own, and reports the
+garbage collections it triggered (gcCollections, gcSeconds). Results are
+written as JSON; with --baseline, any stage slower than the baseline by
+more than --tolerance is reported and the exit status is 1.
+"""
+import argparse
+import asyncio
+import gc
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, "..", "src"))
+sys.path.insert(0, BENCH_DIR)
+
+import gen_csv  # noqa: E402
+
+STAGES = ("parse", "buffer", "load", "e2e")
+MODES = ("row", "bulk")
+
+
+def _peak_rss_mb() -> float:
+    # ru_maxrss is KiB on Linux, bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
+
+
+def _chunk_size(mode: str, chunk: int) -> int:
+    return chunk if mode == "bulk" else 100  # same as process_file
+
+
+def _parsed_chunks(path: str, mode: str, chunk: int):
+    import batchparse
+    from parsing import parse_row
+    from reader import CSVStream
+
+    with CSVStream(path) as stream:
+        for _, rows in stream.chunks(_chunk_size(mode, chunk), mode):
+            yield batchparse.parse_batch(rows) if mode == "bulk" else [parse_row(r) for r in rows]
+
+
+def _rows(c, mode: str) -> int:
+    return len(c["ts"]) if mode == "bulk" else len(c)
+
+
+def _parse_stage(path: str, mode: str, chunk: int) -> int:
+    return sum(_rows(c, mode) for c in _parsed_chunks(path, mode, chunk))
+
+
+def _buffer_stage(path: str, mode: str, chunk: int) -> Dict[str, Any]:
+    before = _peak_rss_mb()
+    chunks = list(_parsed_chunks(path, mode, chunk))
+    rows = sum(_rows(c, mode) for c in chunks)
+    grown = _peak_rss_mb() - before
+    return {"rows": rows, "bufferedMbPerMillionRows": round(grown * 1_000_000 / rows, 1) if rows else None}
+
+
+class _GCStats:
+    """Collections run (all generations) and time spent in them while active."""
+
+    def __init__(self):
+        self.collections = 0
+        self.seconds = 0.0
+        self._t0 = 0.0
+
+    def __call__(self, phase: str, info: Dict[str, Any]):
+        if phase == "start":
+            self._t0 = time.perf_counter()
+        else:
+            self.collections += 1
+            self.seconds += time.perf_counter() - self._t0
+
+    def __enter__(self) -> "_GCStats":
+        gc.callbacks.append(self)
+        return self
+
+    def __exit__(self, *exc):
+        gc.callbacks.remove(self)
+
+
+def _connect(postgres: bool):
+    import main
+    if postgres:
+        return main.db.acquire
+    import standin
+    return standin.acquire_factory(standin.StandInConn())
+
+
+async def _load_stage(path: str, mode: str, chunk: int, postgres: bool) -> Dict[str, Any]:
+    import main
+
+    chunks = list(_parsed_chunks(path, mode, chunk))
+    acquire = _connect(postgres)
+    rows = 0
+    async with acquire() as conn:
+        if not main.dim_cache.warmed:
+            await main.dim_cache.warm(conn)
+        t0 = time.perf_counter()
+        for c in chunks:
+            if mode == "bulk":
+                await main.load_chunk(conn, c, "bench.csv")
+                rows += len(c["ts"])
+            else:
+                await main.insert_rows(conn, c, "bench.csv")
+                rows += len(c)
+        return {"rows": rows, "seconds": time.perf_counter() - t0}
+
+
+async def _e2e_stage(path: str, mode: str, chunk: int, postgres: bool) -> int:
+    import checkpoint
+    import main
+
+    acquire = _connect(postgres)
+    main.db.acquire = acquire
+    main.DATA_DIR, filename = os.path.split(path)
+    main.CHUNK_SIZE = chunk
+    if postgres:
+        # the same file is loaded once per mode; forget the previous load
+        async with acquire() as conn:
+            await conn.execute("DELETE FROM etl_file_loads WHERE content_hash LIKE $1 || '/%'",
+                               checkpoint.content_hash(path))
+    job_id = f"bench-{mode}-{os.getpid()}"
+    main.job_store.create({"jobId": job_id, "filename": filename, "status": "queued", "loadMode": mode,
+                           "rowsProcessed": 0, "rowsInserted": 0, "rowsFailed": 0})
+    await main.process_file(job_id, filename, None, mode)
+    job = main.jobs[job_id]
+    if job["status"] != "completed":
+        raise RuntimeError(f"e2e job failed: {job.get('message')}")
+    return job["rowsProcessed"]
+
+
+def run_stage(stage: str, mode: str, path: str, chunk: int, postgres: bool) -> Dict[str, Any]:
+    """Run one benchmark in the current process (called in a fresh child)."""
+    import main  # noqa: F401  (import time is not part of any stage)
+    extra: Dict[str, Any] = {}
+    with _GCStats() as gc_stats:
+        t0 = time.perf_counter()
+        if stage == "parse":
+            rows, seconds = _parse_stage(path, mode, chunk), None
+        elif stage == "buffer":
+            extra = _buffer_stage(path, mode, chunk)
+            rows, seconds = extra.pop("rows"), None
+        elif stage == "load":
+            res = asyncio.run(_load_stage(path, mode, chunk, postgres))
+            rows, seconds = res["rows"], res["seconds"]
+        else:
+            rows, seconds = asyncio.run(_e2e_stage(path, mode, chunk, postgres)), None
+        seconds = seconds if seconds is not None else time.perf_counter() - t0
+    return {
+        "rows": rows,
+        "seconds": round(seconds, 4),
+        "rowsPerSec": round(rows / seconds, 1) if seconds else None,
+        "peakRssMb": round(_peak_rss_mb(), 1),
+        "gcCollections": gc_stats.collections,
+        "gcSeconds": round(gc_stats.seconds, 4),
+        **extra,
+    }
+
+
+def _child(conn, *args):
+    sys.stdout = sys.stderr  # keep ETL log lines out of the JSON on stdout
+    try:
+        conn.send(run_stage(*args))
+    except Exception as e:
+        conn.send({"error": f"{type(e).__name__}: {e}"})
+    finally:
+        conn.close()
+
+
+def run_isolated(*args) -> Dict[str, Any]:
+    ctx = multiprocessing.get_context("spawn")
+    parent, child = ctx.Pipe(duplex=False)
+    proc = ctx.Process(target=_child, args=(child, *args))
+    proc.start()
+    child.close()
+    result = parent.recv()
+    proc.join()
+    return result
+
+
+def compare(results: Dict[str, Any], baseline: Dict[str, Any], tolerance: float) -> List[str]:
+    """Names of results whose rowsPerSec dropped more than `tolerance` below the baseline."""
+    slower = []
+    for name, res in results.items():
+        base = baseline.get(name)
+        if not base or not base.get("rowsPerSec") or not res.get("rowsPerSec"):
+            continue
+        res["vsBaseline"] = round(res["rowsPerSec"] / base["rowsPerSec"], 3)
+        if res["vsBaseline"] < 1 - tolerance:
+            slower.append(name)
+    return slower
+
+
+def main_(argv: List[str] = None) -> int:
+    ap = argparse.ArgumentParser(description="ETL ingest throughput benchmarks")
+    gen_csv.add_arguments(ap)
+    ap.add_argument("--stages", default=",".join(STAGES))
+    ap.add_argument("--modes", default=",".join(MODES))
+    ap.add_argument("--chunk", type=int, default=int(os.getenv("ETL_CHUNK_SIZE", "5000")))
+    ap.add_argument("--postgres", action="store_true", help="load into the POSTGRES_* database")
+    ap.add_argument("--csv", help="benchmark an existing file instead of generating one")
+    ap.add_argument("--out", help="write results JSON here (default: stdout)")
+    ap.add_argument("--baseline", help="results JSON to compare against")
+    ap.add_argument("--tolerance", type=float, default=0.10, help="allowed rows/sec drop vs baseline")
+    args = ap.parse_args(argv)
+
+    with tempfile.TemporaryDirectory(prefix="etl_bench_") as tmp:
+        path = args.csv
+        if not path:
+            path = os.path.join(tmp, "bench.csv")
+            with open(path, "w", newline="") as f:
+                gen_csv.write_csv(f, gen_csv.make_rows(args.rows, **gen_csv.generator_kwargs(args)))
+
+        results: Dict[str, Any] = {}
+        for stage in args.stages.split(","):
+            for mode in args.modes.split(","):
+                name = f"{stage}/{mode}"
+                results[name] = run_isolated(stage, mode, path, args.chunk, args.postgres)
+                print(f"{name:12s} {json.dumps(results[name])}", file=sys.stderr, flush=True)
+
+    report = {
+        "meta": {
+            "rows": args.rows if not args.csv else None,
+            "csv": args.csv,
+            "generator": None if args.csv else gen_csv.generator_kwargs(args),
+            "chunk": args.chunk,
+            "target": "postgres" if args.postgres else "standin",
+            "python": platform.python_version(),
+            "cpus": os.cpu_count(),
+        },
+        "results": results,
+    }
+    slower: List[str] = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            slower = compare(results, json.load(f).get("results", {}), args.tolerance)
+        report["regressions"] = slower
+
+    text = json.dumps(report, indent=2)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    for name in slower:
+        print(f"REGRESSION {name}: {results[name]['vsBaseline']}x baseline rows/sec", file=sys.stderr)
+    return 1 if slower else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_())
@@ -0,0 +1,48 @@
+# etl-service/bench/bench_parse.py
+"""
+CPU time per million rows for the read+parse stage: csv.DictReader + parse_row
+(row mode) vs csv.reader + batchparse.parse_batch (bulk mode).
+
+    PYTHONPATH=src python bench/bench_parse.py --rows 1000000 --chunk 5000
+"""
+import argparse
+import io
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+import batchparse  # noqa: E402
+import reader  # noqa: E402
+from parsing import parse_row  # noqa: E402
+from gen_csv import make_csv  # noqa: E402
+
+def row_stage(text: str, chunk: int):
+    for _, rows in reader.iter_chunks(io.StringIO(text), chunk, "row"):
+        [parse_row(r) for r in rows]
+
+def batch_stage(text: str, chunk: int):
+    for _, cols in reader.iter_chunks(io.StringIO(text), chunk, "bulk"):
+        batchparse.parse_batch(cols)
+
+def cpu_per_million(fn, text, chunk, n):
+    t0 = time.process_time()
+    fn(text, chunk)
+    return (time.process_time() - t0) * 1_000_000 / n
+
+def main_():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--rows", type=int, default=1_000_000)
+    ap.add_argument("--chunk", type=int, default=5000)
+    args = ap.parse_args()
+
+    text = make_csv(args.rows)
+    per_row = cpu_per_million(row_stage, text, args.chunk, args.rows)
+    batch = cpu_per_million(batch_stage, text, args.chunk, args.rows)
+    print(f"rows={args.rows} chunk={args.chunk}")
+    print(f"DictReader+parse_row     {per_row:8.2f} cpu-s / 1M rows")
+    print(f"reader+parse_batch       {batch:8.2f} cpu-s / 1M rows  ({per_row / batch:.2f}x)")
+
+if __name__ == "__main__":
+    main_()
@@ -0,0 +1,96 @@
+# etl-service/bench/gen_csv.py
+"""
+Synthetic clinical CSVs in the sample_study001.csv schema.
+
+    python bench/gen_csv.py out.csv --rows 1000000 --participants 5000 --sites 20 --invalid 0.02
+
+Invalid rows are spread evenly over the ways a real export goes wrong:
+non-numeric values, malformed blood pressure and unparseable timestamps.
+"""
+import argparse
+import csv
+import io
+import random
+from typing import Dict, Iterator, List
+
+CSV_COLUMNS = ["study_id", "participant_id", "measurement_type", "value", "unit",
+               "timestamp", "site_id", "quality_score"]
+
+INVALID_KINDS = ("non_numeric_value", "invalid_bp_format", "bad_timestamp")
+
+
+def make_rows(n: int, participants: int = 5000, sites: int = 20, invalid_ratio: float = 0.0,
+              studies: int = 1, seed: int = 0) -> Iterator[Dict[str, str]]:
+    rnd = random.Random(seed)
+    kinds = [
+        ("glucose", "mg/dL", lambda: f"{rnd.uniform(60, 200):.1f}"),
+        ("cholesterol", "mg/dL", lambda: str(rnd.randint(120, 260))),
+        ("weight", "lbs", lambda: f"{rnd.uniform(100, 250):.1f}"),
+        ("height", "in", lambda: f"{rnd.uniform(55, 75):.1f}"),
+        ("heart_rate", "bpm", lambda: str(rnd.randint(50, 110))),
+        ("blood_pressure", "mmHg", lambda: f"{rnd.randint(100, 150)}/{rnd.randint(60, 95)}"),
+    ]
+    participants, sites, studies = max(1, participants), max(1, sites), max(1, studies)
+    for i in range(n):
+        mt, unit, val = kinds[i % len(kinds)]
+        p = rnd.randrange(participants)
+        row = {
+            "study_id": f"STUDY{p % studies + 1:03d}", "participant_id": f"P{p:06d}",
+            "measurement_type": mt, "value": val(), "unit": unit,
+            "timestamp": f"2024-{1 + (i // 28000) % 12:02d}-{1 + (i // 1000) % 28:02d}T"
+                         f"{(i // 3600) % 24:02d}:{(i // 60) % 60:02d}:{i % 60:02d}Z",
+            "site_id": f"SITE_{p % sites:03d}", "quality_score": f"{rnd.random():.2f}",
+        }
+        if invalid_ratio and rnd.random() < invalid_ratio:
+            kind = INVALID_KINDS[rnd.randrange(len(INVALID_KINDS))]
+            if kind == "non_numeric_value":
+                row["measurement_type"], row["unit"], row["value"] = "glucose", "mg/dL", "n/a"
+            elif kind == "invalid_bp_format":
+                row["measurement_type"], row["unit"], row["value"] = "blood_pressure", "mmHg", "120-80"
+            else:
+                row["timestamp"] = "15/01/2024 9:30"
+        yield row
+
+
+def write_csv(f, rows) -> int:
+    w = csv.DictWriter(f, fieldnames=CSV_COLUMNS, lineterminator="\n")
+    w.writeheader()
+    n = 0
+    for row in rows:
+        w.writerow(row)
+        n += 1
+    return n
+
+
+def make_csv(n: int, **kwargs) -> str:
+    buf = io.StringIO()
+    write_csv(buf, make_rows(n, **kwargs))
+    return buf.getvalue()
+
+
+def add_arguments(ap: argparse.ArgumentParser):
+    ap.add_argument("--rows", type=int, default=100_000)
+    ap.add_argument("--participants", type=int, default=5000)
+    ap.add_argument("--sites", type=int, default=20)
+    ap.add_argument("--studies", type=int, default=1)
+    ap.add_argument("--invalid", type=float, default=0.0, help="fraction of invalid rows (0-1)")
+    ap.add_argument("--seed", type=int, default=0)
+
+
+def generator_kwargs(args) -> Dict:
+    return {"participants": args.participants, "sites": args.sites, "studies": args.studies,
+            "invalid_ratio": args.invalid, "seed": args.seed}
+
+
+def main_(argv: List[str] = None):
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    ap.add_argument("out")
+    add_arguments(ap)
+    args = ap.parse_args(argv)
+    with open(args.out, "w", newline="") as f:
+        n = write_csv(f, make_rows(args.rows, **generator_kwargs(args)))
+    print(f"wrote {n} rows to {args.out}")
+
+
+if __name__ == "__main__":
+    main_()
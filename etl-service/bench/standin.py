@@ -0,0 +1,72 @@
+# etl-service/bench/standin.py
+"""
+In-process stand-in for an asyncpg connection, so the load and end-to-end
+benchmarks can run without Postgres. It accepts every statement the loader
+sends and keeps only counts, so a run measures the ETL's own overhead:
+no network, no server time, and asyncpg's COPY encoding is skipped.
+"""
+from contextlib import asynccontextmanager
+from itertools import count
+
+import checkpoint
+import dedupe
+import loader
+
+
+class StandInConn:
+    def __init__(self):
+        self.statements = 0
+        self.facts = 0
+        self._ids = count(1)
+        self._staged = 0
+
+    @asynccontextmanager
+    async def transaction(self):
+        yield
+
+    async def execute(self, sql, *args):
+        self.statements += 1
+        if sql is loader.STAGE_INSERT_FACTS:
+            self.facts += self._staged
+            return f"INSERT 0 {self._staged}"
+        if sql.lstrip().startswith("UPDATE"):
+            return "UPDATE 1"
+        if sql.lstrip().startswith('INSERT INTO "fact_measurement"'):
+            self.facts += 1
+        return "INSERT 0 1"
+
+    async def executemany(self, sql, args):
+        self.statements += 1
+        self.facts += len(args)
+
+    async def fetch(self, sql, *args):
+        self.statements += 1
+        return []
+
+    async def fetchval(self, sql, *args):
+        self.statements += 1
+        return next(self._ids)
+
+    async def fetchrow(self, sql, *args):
+        self.statements += 1
+        if sql is checkpoint.BEGIN_LOAD:
+            return {"rows_committed": 0, "shards": None, "piece_bytes": None, "pieces_done": []}
+        if sql.lstrip().startswith("WITH src AS"):
+            # a dedupe.upsert_sql() statement: every staged row is new
+            self.facts += self._staged
+            return {"written": self._staged, "existing": 0, "inserted": self._staged, "touched": None,
+                    "unwritten": None}
+        return None
+
+    async def copy_records_to_table(self, table, records, columns):
+        self.statements += 1
+        if table in (loader.STAGE_TABLE, dedupe.FACT_STAGE):
+            self._staged = sum(1 for _ in records)
+
+
+def acquire_factory(conn: StandInConn):
+    """A drop-in for db.acquire that always hands out `conn`."""
+    @asynccontextmanager
+    async def acquire():
+        yield conn
+    return acquire
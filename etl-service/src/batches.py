@@ -0,0 +1,153 @@
+# etl-service/src/batches.py
+"""
+Batch jobs: many files under DATA_DIR loaded by one job (POST /batches).
+
+The files of a batch are read one after another on one pooled connection
+and parsed in bulk mode. Their parsed rows are buffered, and a load chunk
+is flushed once ETL_CHUNK_SIZE rows are waiting. A study of many small
+site files therefore costs about one COPY transaction per CHUNK_SIZE rows,
+not at least one per file.
+
+Every file keeps its own checkpoint (content hash), and the chunk
+transaction advances the checkpoint of each file it holds rows of. A file
+is marked complete in the transaction that commits its last rows, so a
+batch that stops part way resumes like any other job. Rows carry their own
+source_file through the loader.
+
+A watching batch polls its glob after the listed files are done. It picks
+up new files once their size has stayed the same for one poll. It finishes
+after idleSeconds without a new file.
+"""
+import glob
+import os
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from quarantine import ChunkRejects, CombinedRejects
+
+
+class BatchError(ValueError):
+    """The request names files that cannot be loaded (reported as a 400)."""
+
+
+def _inside(data_dir: str, path: str) -> bool:
+    root = os.path.realpath(data_dir)
+    return os.path.commonpath([root, os.path.realpath(path)]) == root
+
+
+def select_files(data_dir: str, files: Iterable[str] = (), pattern: Optional[str] = None) -> List[str]:
+    """
+    Names (relative to data_dir) of the listed files, then the files matching
+    the glob pattern in sorted order, without repeats. Everything must resolve
+    inside data_dir.
+    """
+    out: List[str] = []
+    seen = set()
+    for name in files:
+        path = os.path.join(data_dir, name)
+        if os.path.isabs(name) or not _inside(data_dir, path):
+            raise BatchError(f"{name}: not under DATA_DIR")
+        if not os.path.isfile(path):
+            raise BatchError(f"{name}: file not found")
+        if name not in seen:
+            seen.add(name)
+            out.append(name)
+    if pattern:
+        if os.path.isabs(pattern) or ".." in pattern.split("/"):
+            raise BatchError(f"{pattern}: glob must be relative to DATA_DIR")
+        for path in sorted(glob.glob(os.path.join(data_dir, pattern), recursive=True)):
+            name = os.path.relpath(path, data_dir)
+            if os.path.isfile(path) and _inside(data_dir, path) and name not in seen:
+                seen.add(name)
+                out.append(name)
+    return out
+
+
+class Watcher:
+    """New files matching a glob, reported once their size is stable across two polls."""
+
+    def __init__(self, data_dir: str, pattern: str, known: Iterable[str]):
+        self.data_dir = data_dir
+        self.pattern = pattern
+        self.known = set(known)
+        self._sizes: Dict[str, int] = {}
+
+    def poll(self) -> List[str]:
+        ready = []
+        sizes = {}
+        for name in select_files(self.data_dir, pattern=self.pattern):
+            if name in self.known:
+                continue
+            try:
+                sizes[name] = os.path.getsize(os.path.join(self.data_dir, name))
+            except OSError:
+                continue  # moved away between glob and stat
+            if self._sizes.get(name) == sizes[name]:
+                ready.append(name)
+        self._sizes = {n: s for n, s in sizes.items() if n not in ready}
+        self.known.update(ready)
+        return ready
+
+
+def file_entry(filename: str, size: int) -> Dict[str, Any]:
+    """Per-file status kept under "files" in the batch job."""
+    return {"filename": filename, "bytes": size, "status": "queued",
+            "rowsProcessed": 0, "rowsFailed": 0}
+
+
+class Segment:
+    """Rows of one file inside a coalesced chunk."""
+    __slots__ = ("entry", "cp", "rows", "committed", "last", "rejects")
+
+    def __init__(self, entry: Dict[str, Any], cp, rows: int, committed: int, rejects: ChunkRejects):
+        self.entry = entry
+        self.cp = cp
+        self.rows = rows
+        self.committed = committed  # the file's rows_committed once this chunk commits
+        self.last = False           # the file's last rows: the chunk also completes it
+        self.rejects = rejects
+
+
+class Coalescer:
+    """Parsed batches of several files, flushed as one load chunk."""
+
+    def __init__(self):
+        self.parts: List[Tuple[Dict[str, list], Segment]] = []
+        self.rows = 0
+
+    def add(self, parsed: Dict[str, list], segment: Segment):
+        self.parts.append((parsed, segment))
+        self.rows += segment.rows
+
+    def finish_file(self, entry: Dict[str, Any]) -> bool:
+        """Flag the file's last buffered segment; False if none is buffered."""
+        for _, seg in reversed(self.parts):
+            if seg.entry is entry:
+                seg.last = True
+                return True
+        return False
+
+    def drop_file(self, entry: Dict[str, Any]):
+        """Forget a failed file's buffered rows (its committed chunks stay loaded)."""
+        self.parts = [(p, s) for p, s in self.parts if s.entry is not entry]
+        self.rows = sum(s.rows for _, s in self.parts)
+
+    def take(self) -> Tuple[Dict[str, list], List[Segment], CombinedRejects]:
+        """The buffered rows as one column batch, their segments, and rejects by position in the batch."""
+        batch: Dict[str, list] = {}
+        for parsed, _ in self.parts:
+            for k, v in parsed.items():
+                batch.setdefault(k, []).extend(v)
+        segments = [s for _, s in self.parts]
+        rejects = CombinedRejects([(s.rows, s.rejects) for s in segments])
+        self.parts, self.rows = [], 0
+        return batch, segments, rejects
+
+
+def commit_hook(segments: List[Segment]):
+    """before_commit for a coalesced chunk: advance (and complete) each file's checkpoint."""
+    async def before_commit(conn):
+        for seg in segments:
+            await seg.cp.mark_rows(seg.committed)(conn)
+            if seg.last:
+                await seg.cp.complete(conn)
+    return before_commit
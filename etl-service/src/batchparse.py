@@ -0,0 +1,303 @@
+# etl-service/src/batchparse.py
+"""
+Columnar parse/normalize stage.
+
+parse_batch() takes a chunk of CSV rows as columns and produces exactly what
+parsing.parse_row() would for each row, and canonicalize_batch() does the same
+for quality.convert_to_canonical() + quality.range_flags(). Work is done
+with numpy/pandas over whole columns; the rare values the fast paths cannot
+handle (odd numeric spellings, non-standard timestamps) are handed to the
+per-row functions so results stay identical.
+"""
+import sys
+from datetime import datetime
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+import pandas as pd
+
+import timestamps
+from parsing import NO_FLAGS, Record
+from quality import BP_RE, NON_NUMERIC_QUALITY
+from rules import engine
+
+CSV_COLUMNS = [
+    "study_id", "participant_id", "measurement_type", "value",
+    "unit", "timestamp", "site_id", "quality_score",
+]
+
+def columns_from_rows(rows: Sequence[Dict[str, Optional[str]]]) -> Dict[str, List[Optional[str]]]:
+    """Pivot csv.DictReader rows into columns."""
+    return {c: [r.get(c) for r in rows] for c in CSV_COLUMNS}
+
+
+def columns_from_lists(header: Sequence[str], rows: List[List[str]]) -> Dict[str, Sequence[Optional[str]]]:
+    """
+    Pivot csv.reader rows into columns. Short rows are padded with None and
+    long rows truncated, which is what csv.DictReader yields for our columns.
+    """
+    width = len(header)
+    if any(len(r) != width for r in rows):
+        rows = [r[:width] + [None] * (width - len(r)) for r in rows]
+    cols = list(zip(*rows)) if rows else [()] * width
+    return dict(zip(header, cols))
+
+
+def _float_or_none(v: str) -> Optional[float]:
+    try:
+        return float(v)
+    except Exception:
+        return None
+
+
+def parse_floats(values: np.ndarray) -> tuple:
+    """
+    Parse an object array of str with float() semantics.
+    Returns (float64 array, ok mask). Casting an object array to float64
+    calls float() on each element in C, so rounding and accepted spellings
+    are exactly float()'s; a chunk with a bad value is redone element-wise.
+    """
+    n = len(values)
+    try:
+        return values.astype(np.float64), np.ones(n, dtype=bool)
+    except (ValueError, TypeError):
+        pass
+    parsed = [_float_or_none(v) for v in values]
+    ok = np.array([p is not None for p in parsed], dtype=bool)
+    out = np.array([p if p is not None else np.nan for p in parsed], dtype=np.float64)
+    return out, ok
+
+
+def parse_timestamps(values: Sequence[Optional[str]]) -> List[Optional[datetime]]:
+    """parsing.parse_ts over a column (see timestamps.parse_column)."""
+    return timestamps.parse_column(values)
+
+
+def _is_numeric(col) -> bool:
+    """A typed numeric column (columnar inputs) rather than strings."""
+    return isinstance(col, np.ndarray) and col.dtype.kind in "fiu"
+
+
+def _timestamps(col) -> List[Optional[datetime]]:
+    if isinstance(col, pd.Series) and pd.api.types.is_datetime64_any_dtype(col):
+        # typed timestamps (columnar inputs): no string parsing
+        utc = col.dt.tz_localize("UTC") if col.dt.tz is None else col.dt.tz_convert("UTC")
+        return [None if pd.isna(d) else d for d in pd.DatetimeIndex(utc).to_pydatetime()]
+    return parse_timestamps(col)
+
+
+def _normalize(col: Sequence[Optional[str]], lower: bool = False) -> np.ndarray:
+    """
+    (v or "").strip() (and .lower()) over a column. Study, participant, site,
+    type and unit columns repeat heavily, so each distinct value is normalized
+    once and broadcast back through the factorized codes. The values are
+    interned, so chunks buffered together share them too.
+    """
+    codes, uniques = pd.factorize(pd.Series(col, dtype=object), use_na_sentinel=True)
+    norm = [sys.intern(u.strip().lower() if lower else u.strip()) for u in uniques]
+    norm.append("")  # code -1 (None) -> ""
+    return np.asarray(norm, dtype=object)[codes]
+
+
+def _bp_fields(n: int, values: np.ndarray, has_value: np.ndarray, bp_idx: np.ndarray,
+               systolic: np.ndarray, diastolic: np.ndarray) -> list:
+    """(values, has value) columns in rules.FIELDS order for RuleEngine.flags_batch()."""
+    out = [(values, has_value)]
+    for col in (systolic, diastolic):
+        v = np.full(n, np.nan)
+        v[bp_idx] = col
+        has = np.zeros(n, dtype=bool)
+        has[bp_idx] = True
+        out.append((v, has))
+    return out
+
+
+def parse_batch(cols: Dict[str, Sequence[Optional[str]]]) -> Dict[str, list]:
+    """Columnar parsing.parse_row. Returns parse_row's keys, each as a list."""
+    n = len(next(iter(cols.values()))) if cols else 0
+    get = lambda c: cols.get(c) if cols.get(c) is not None else [None] * n
+
+    mt = _normalize(get("measurement_type"), lower=True)
+    unit = _normalize(get("unit"))
+    val_col = get("value")
+    typed_val = _is_numeric(val_col)
+    if typed_val:
+        # already numbers (columnar inputs); only blood pressure needs text, so it fails its format check
+        num_val = np.asarray(val_col, dtype=np.float64)
+        has_val = ~np.isnan(num_val)
+        raw_val = np.full(n, None, dtype=object)
+    else:
+        raw_val = np.asarray(pd.Series(val_col, dtype=object), dtype=object)
+        has_val = ~pd.isna(raw_val)
+
+    is_bp = engine.bp_mask(mt)
+    flags = np.full(n, None, dtype=object)
+
+    # blood pressure: "120/80"
+    systolic = np.full(n, None, dtype=object)
+    diastolic = np.full(n, None, dtype=object)
+    if is_bp.any():
+        bp_vals = pd.Series(raw_val[is_bp], dtype=object).fillna("")
+        m = bp_vals.str.extract(BP_RE.pattern)
+        matched = m[0].notna().to_numpy()
+        idx = np.flatnonzero(is_bp)
+        good, bad = idx[matched], idx[~matched]
+        sys_v = m[0][matched].astype(np.int64).to_numpy()
+        dia_v = m[1][matched].astype(np.int64).to_numpy()
+        systolic[good] = sys_v.tolist()
+        diastolic[good] = dia_v.tolist()
+        unit[good] = [engine.canonical.get(t) or "mmHg" for t in mt[good]]
+        flags[bad] = "invalid_bp_format"
+    else:
+        good = bad = np.empty(0, dtype=np.int64)
+        sys_v = dia_v = np.empty(0, dtype=np.int64)
+
+    # numeric values
+    value_numeric = np.full(n, np.nan)
+    numeric = ~is_bp & has_val
+    if typed_val:
+        vals, ok = num_val[numeric], np.ones(int(numeric.sum()), dtype=bool)
+    else:
+        vals, ok = parse_floats(raw_val[numeric])
+    value_numeric[numeric] = vals
+    has_num = np.zeros(n, dtype=bool)
+    has_num[numeric] = ok
+    not_numeric = np.flatnonzero(numeric)[~ok]
+    flags[not_numeric] = "non_numeric_value"
+
+    # unit conversion and range flags (rules.py)
+    engine.convert_batch(mt, _normalize(unit, lower=True), value_numeric, has_num, unit)
+    flag_lists = [[f] if f is not None else NO_FLAGS for f in flags.tolist()]
+    engine.flags_batch(mt, _bp_fields(n, value_numeric, has_num, good, sys_v, dia_v), flag_lists)
+
+    ts_col = get("timestamp")
+    ts = _timestamps(ts_col)
+    if None in ts and not isinstance(ts_col, pd.Series):
+        for i, (t, raw) in enumerate(zip(ts, ts_col)):
+            if t is None and raw:
+                flag_lists[i] = [*flag_lists[i], timestamps.UNPARSEABLE_TS]
+
+    # quality_score: float(raw or 0); a bad value is None and flagged, like parse_row
+    q_col = get("quality_score")
+    quality_list: List[Optional[float]]
+    if _is_numeric(q_col):
+        quality_list = np.nan_to_num(np.asarray(q_col, dtype=np.float64), nan=0.0).tolist()
+    else:
+        q_raw = np.asarray(pd.Series(q_col, dtype=object).fillna(""), dtype=object)
+        q_raw[q_raw == ""] = "0"
+        quality, q_ok = parse_floats(q_raw)
+        quality_list = quality.tolist()
+        for i in np.flatnonzero(~q_ok).tolist():
+            quality_list[i] = None
+            flag_lists[i] = [*flag_lists[i], NON_NUMERIC_QUALITY]
+
+    vn = value_numeric.astype(object)
+    vn[~has_num] = None
+    invalid = np.zeros(n, dtype=bool)
+    invalid[bad] = True
+    invalid[not_numeric] = True
+
+    return {
+        "study_id": _normalize(get("study_id")).tolist(),
+        "participant_id": _normalize(get("participant_id")).tolist(),
+        "site_id": _normalize(get("site_id")).tolist(),
+        "measurement_type": mt.tolist(),
+        "unit": unit.tolist(),
+        "value_numeric": vn.tolist(),
+        "systolic": systolic.tolist(),
+        "diastolic": diastolic.tolist(),
+        "quality_score": quality_list,
+        "ts": ts,
+        "flags": flag_lists,
+        "is_valid": (~invalid).tolist(),
+    }
+
+
+def take(parsed: Dict[str, list], idx: Sequence[int]) -> Dict[str, list]:
+    """Select rows of a parse_batch() result by position."""
+    return {k: [v[i] for i in idx] for k, v in parsed.items()}
+
+
+def to_records(parsed: Dict[str, list]) -> List[Record]:
+    """Turn parse_batch() columns back into parse_row() records."""
+    keys = list(parsed)
+    return [Record(**dict(zip(keys, vals))) for vals in zip(*parsed.values())]
+
+
+def parse_rows(rows: Sequence[Dict[str, Optional[str]]]) -> List[Record]:
+    """Drop-in batch replacement for [parse_row(r) for r in rows]."""
+    if not rows:
+        return []
+    return to_records(parse_batch(columns_from_rows(rows)))
+
+
+def canonicalize_batch(measurement_type: Sequence[str], value: Sequence[str], unit: Sequence[str]) -> Dict[str, list]:
+    """
+    Columnar quality.convert_to_canonical() + quality.range_flags(payload, measurement_type).
+    Returns columns ok, err, value_numeric, systolic, diastolic, unit, flags;
+    payload fields that convert_to_canonical would not set are None.
+    """
+    n = len(measurement_type)
+    mt = pd.Series(measurement_type, dtype=object).str.lower().str.strip().to_numpy(dtype=object)
+    unit_in = pd.Series(unit, dtype=object).str.strip().to_numpy(dtype=object)
+    val = np.asarray(value, dtype=object)
+
+    ok = np.ones(n, dtype=bool)
+    err = np.full(n, None, dtype=object)
+    out_unit = np.full(n, None, dtype=object)
+    systolic = np.full(n, None, dtype=object)
+    diastolic = np.full(n, None, dtype=object)
+    value_numeric = np.full(n, None, dtype=object)
+    flags: List[List[str]] = [[] for _ in range(n)]
+
+    is_bp = engine.bp_mask(mt)
+    good_bp = np.empty(0, dtype=np.int64)
+    sys_v = dia_v = np.empty(0, dtype=np.int64)
+    if is_bp.any():
+        idx = np.flatnonzero(is_bp)
+        m = pd.Series(val[is_bp], dtype=object).str.extract(BP_RE.pattern)
+        matched = m[0].notna().to_numpy()
+        good_bp, bad = idx[matched], idx[~matched]
+        sys_v = m[0][matched].astype(np.int64).to_numpy()
+        dia_v = m[1][matched].astype(np.int64).to_numpy()
+        systolic[good_bp] = sys_v.tolist()
+        diastolic[good_bp] = dia_v.tolist()
+        out_unit[good_bp] = [engine.canonical.get(t) or "mmHg" for t in mt[good_bp]]
+        ok[bad] = False
+        err[bad] = "invalid_bp_format"
+
+    num_idx = np.flatnonzero(~is_bp)
+    vals, parsed = parse_floats(val[~is_bp])
+    ok[num_idx[~parsed]] = False
+    err[num_idx[~parsed]] = "non_numeric_value"
+
+    idx = num_idx[parsed]
+    v = vals[parsed]
+    u = unit_in[idx].copy()
+    u_lc = pd.Series(u, dtype=object).str.lower().to_numpy(dtype=object)
+    m = mt[idx]
+    engine.convert_batch(m, u_lc, v, np.ones(len(v), dtype=bool), u)
+    canonical = np.array([engine.canonical.get(x) for x in m], dtype=object)
+    wrong = np.array([c is not None and uu != c for c, uu in zip(canonical, u)], dtype=bool)
+    ok[idx[wrong]] = False
+    err[idx[wrong]] = ["unexpected_unit:" + uu for uu in u[wrong]]
+    good = idx[~wrong]
+    value_numeric[good] = v[~wrong].tolist()
+    out_unit[good] = [c if c is not None else uu for c, uu in zip(canonical[~wrong], u[~wrong])]
+
+    # range flags, for rows convert_to_canonical accepts
+    num = np.full(n, np.nan)
+    num[good] = v[~wrong]
+    has_num = np.zeros(n, dtype=bool)
+    has_num[good] = True
+    engine.flags_batch(mt, _bp_fields(n, num, has_num, good_bp, sys_v, dia_v), flags)
+
+    return {
+        "ok": ok.tolist(),
+        "err": err.tolist(),
+        "value_numeric": value_numeric.tolist(),
+        "systolic": systolic.tolist(),
+        "diastolic": diastolic.tolist(),
+        "unit": out_unit.tolist(),
+        "flags": flags,
+    }
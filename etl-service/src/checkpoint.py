@@ -0,0 +1,163 @@
+# etl-service/src/checkpoint.py
+"""
+Resumable, idempotent file loads.
+
+Every load is keyed in etl_file_loads by the source file's content hash
+plus the options that decide what it stores (load_key): the same file
+submitted with another studyId, load mode, detached flag or dedupe mode is
+a different load, not one already done.
+Each chunk advances the checkpoint inside the same transaction that commits
+its facts, so the checkpoint never runs ahead of (or behind) what is really
+in fact_measurement. A resubmitted file resumes after the last committed
+row (or, for sharded loads, skips the pieces already committed); a file
+whose content was already loaded completely is skipped.
+"""
+import hashlib
+import json
+import os
+from typing import Any, List, Optional
+
+HASH_MODE = os.getenv("ETL_HASH_MODE", "sample")
+SAMPLE_BYTES = 1024 * 1024
+_READ_BYTES = 4 * 1024 * 1024
+
+BEGIN_LOAD = """
+INSERT INTO etl_file_loads (content_hash, filename, size_bytes, job_id, status)
+VALUES ($1, $2, $3, $4, 'running')
+ON CONFLICT (content_hash) DO UPDATE SET
+  filename   = EXCLUDED.filename,
+  job_id     = EXCLUDED.job_id,
+  updated_at = NOW()
+WHERE etl_file_loads.status <> 'completed'
+RETURNING rows_committed, shards, piece_bytes, pieces_done;
+"""
+
+SELECT_LOAD = "SELECT job_id FROM etl_file_loads WHERE content_hash = $1;"
+
+# Every write checks job_id: if another job has taken the file over, the
+# chunk transaction fails instead of loading the same rows twice.
+ADVANCE_ROWS = """
+UPDATE etl_file_loads SET rows_committed = $3, updated_at = NOW()
+WHERE content_hash = $1 AND job_id = $2;
+"""
+
+SET_PLAN = """
+UPDATE etl_file_loads SET shards = $3, piece_bytes = $4, updated_at = NOW()
+WHERE content_hash = $1 AND job_id = $2;
+"""
+
+ADVANCE_PIECE = """
+UPDATE etl_file_loads
+SET pieces_done = array_append(pieces_done, $3::bigint),
+    rows_committed = rows_committed + $4,
+    updated_at = NOW()
+WHERE content_hash = $1 AND job_id = $2;
+"""
+
+COMPLETE_LOAD = """
+UPDATE etl_file_loads SET status = 'completed', updated_at = NOW()
+WHERE content_hash = $1 AND job_id = $2;
+"""
+
+DISCARD_LOAD = "DELETE FROM etl_file_loads WHERE content_hash = $1 AND job_id = $2;"
+
+
+class CheckpointLost(Exception):
+    """Another job took over this file; the current job must stop."""
+
+
+def content_hash(path: str, mode: str = HASH_MODE) -> str:
+    """
+    sha256 of the file. mode "sample" (the default) hashes the size plus the
+    first, middle and last SAMPLE_BYTES instead of every byte, so a job does
+    not read a large file once just to key it before the load reads it
+    again; "full" hashes every byte, for files that may be edited in place
+    without changing size. Files small enough to be read whole get the same
+    "sha256:" hash either way.
+    """
+    size = os.path.getsize(path)
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        if mode != "sample" or size <= 3 * SAMPLE_BYTES:
+            for block in iter(lambda: f.read(_READ_BYTES), b""):
+                h.update(block)
+            return "sha256:" + h.hexdigest()
+        h.update(str(size).encode())
+        for pos in (0, (size - SAMPLE_BYTES) // 2, size - SAMPLE_BYTES):
+            f.seek(pos)
+            h.update(f.read(SAMPLE_BYTES))
+    return "sample:" + h.hexdigest()
+
+
+def load_key(content_hash: str, **options: Any) -> str:
+    """content_hash of the file, qualified by the load options (see module docstring)."""
+    digest = hashlib.sha256(json.dumps(options, sort_keys=True).encode()).hexdigest()[:16]
+    return f"{content_hash}/{digest}"
+
+
+class Checkpoint:
+    """Checkpoint state of one job's load of one file; see module docstring."""
+
+    def __init__(self, content_hash: str, job_id: str, rows: int = 0, shards: Optional[int] = None,
+                 piece_bytes: Optional[int] = None, pieces_done: Optional[List[int]] = None,
+                 completed_by: Optional[str] = None):
+        self.content_hash = content_hash
+        self.job_id = job_id
+        self.rows = rows
+        self.shards = shards
+        self.piece_bytes = piece_bytes
+        self.pieces_done = set(pieces_done or ())
+        self.completed_by = completed_by
+        # optional extra check run first in every checkpoint write (see workqueue.guard)
+        self.guard = None
+
+    @property
+    def completed(self) -> bool:
+        return self.completed_by is not None
+
+    @property
+    def resumed(self) -> bool:
+        return bool(self.rows or self.pieces_done)
+
+    async def _write(self, conn, sql: str, *args):
+        if self.guard is not None:
+            await self.guard(conn)
+        status = await conn.execute(sql, self.content_hash, self.job_id, *args)
+        if status != "UPDATE 1":
+            raise CheckpointLost(f"file {self.content_hash} was taken over by another job")
+
+    def mark_rows(self, rows: int):
+        """Hook for a chunk transaction: rows_committed becomes `rows` (absolute, so replays are safe)."""
+        async def before_commit(conn):
+            await self._write(conn, ADVANCE_ROWS, rows)
+        return before_commit
+
+    def mark_piece(self, start: int, rows: int):
+        """Hook for a sharded piece transaction: record the piece (by start offset) as loaded."""
+        async def before_commit(conn):
+            await self._write(conn, ADVANCE_PIECE, start, rows)
+        return before_commit
+
+    async def set_plan(self, conn, shards: int, piece_bytes: int):
+        await self._write(conn, SET_PLAN, shards, piece_bytes)
+        self.shards, self.piece_bytes = shards, piece_bytes
+
+    async def complete(self, conn):
+        await self._write(conn, COMPLETE_LOAD)
+
+    async def discard(self, conn):
+        """Forget this load (its rows were thrown away), so a resubmitted file starts over."""
+        await conn.execute(DISCARD_LOAD, self.content_hash, self.job_id)
+
+
+async def begin(conn, content_hash: str, filename: str, size: int, job_id: str) -> Checkpoint:
+    """Claim the load of this content for job_id and return where to resume from."""
+    row = await conn.fetchrow(BEGIN_LOAD, content_hash, filename, size, job_id)
+    if row is None:
+        # the conflicting row is a completed load
+        return Checkpoint(content_hash, job_id, completed_by=await conn.fetchval(SELECT_LOAD, content_hash))
+    return Checkpoint(
+        content_hash, job_id,
+        rows=row["rows_committed"], shards=row["shards"], piece_bytes=row["piece_bytes"],
+        pieces_done=row["pieces_done"],
+    )
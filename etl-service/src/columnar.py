@@ -0,0 +1,127 @@
+# etl-service/src/columnar.py
+"""
+Parquet and Arrow IPC inputs (optional: needs pyarrow).
+
+ColumnarStream has CSVStream's interface but yields column batches
+straight from the file's record batches, so the bulk parse stage gets
+columns without any per-row dicts or CSV text. Typed columns are passed
+through typed: numeric value / quality_score columns arrive as float64
+arrays and timestamp columns as datetime Series, and parse_batch skips
+string parsing for them. Naive timestamps are taken as UTC.
+"""
+import os
+from typing import Dict, Iterator, Optional, Tuple
+
+import numpy as np
+
+from batchparse import CSV_COLUMNS
+
+try:
+    import pyarrow as pa
+    import pyarrow.ipc
+    import pyarrow.parquet as pq
+except ImportError:  # optional: only needed for Parquet / Arrow inputs
+    pa = None
+
+TYPED_COLUMNS = ("value", "quality_score")  # kept numeric when the file has them numeric
+
+
+def batch_columns(batch) -> Dict[str, object]:
+    """pyarrow RecordBatch -> parse_batch columns (missing columns are left out)."""
+    cols: Dict[str, object] = {}
+    names = batch.schema.names
+    for name in CSV_COLUMNS:
+        if name not in names:
+            continue
+        arr = batch.column(names.index(name))
+        if pa.types.is_dictionary(arr.type):
+            arr = arr.dictionary_decode()
+        t = arr.type
+        if name == "timestamp" and pa.types.is_timestamp(t):
+            ts = arr.to_pandas()
+            cols[name] = ts.dt.tz_localize("UTC") if ts.dt.tz is None else ts
+        elif name in TYPED_COLUMNS and (pa.types.is_floating(t) or pa.types.is_integer(t)):
+            cols[name] = arr.to_numpy(zero_copy_only=False).astype(np.float64)
+        else:
+            if not (pa.types.is_string(t) or pa.types.is_large_string(t)):
+                arr = arr.cast(pa.string())
+            cols[name] = arr.to_numpy(zero_copy_only=False)
+    return cols
+
+
+class ColumnarStream:
+    """Context manager over one Parquet or Arrow IPC file; see module docstring."""
+    columnar = True
+
+    def __init__(self, path: str, fmt: str):
+        if pa is None:
+            raise RuntimeError("reading Parquet / Arrow files needs the pyarrow package")
+        self.path = path
+        self.format = fmt
+        self.size = os.stat(path).st_size
+        self.total_rows: Optional[int] = None
+        self.rows_read = 0
+        self._source = None
+        self._reader = None
+
+    def __enter__(self) -> "ColumnarStream":
+        if self.format == "parquet":
+            self._reader = pq.ParquetFile(self.path)
+            self.total_rows = self._reader.metadata.num_rows
+        else:
+            self._source = pa.memory_map(self.path)
+            try:
+                self._reader = pa.ipc.open_file(self._source)
+                self.total_rows = sum(self._reader.get_batch(i).num_rows
+                                      for i in range(self._reader.num_record_batches))
+            except pa.ArrowInvalid:  # streaming format, no footer
+                self._source.seek(0)
+                self._reader = pa.ipc.open_stream(self._source)
+        return self
+
+    def __exit__(self, *exc):
+        if self.format == "parquet":
+            self._reader.close()
+        if self._source is not None:
+            self._source.close()
+
+    @property
+    def bytes_read(self) -> int:
+        if self.total_rows:
+            return int(self.size * self.rows_read / self.total_rows)
+        if self._source is not None and not self._source.closed:
+            return self._source.tell()
+        return self.size
+
+    def progress(self) -> int:
+        """Percent of the file consumed so far (0-100)."""
+        if not self.size:
+            return 100
+        return min(100, int(self.bytes_read * 100 / self.size))
+
+    def _batches(self, chunk_size: int):
+        if self.format == "parquet":
+            yield from self._reader.iter_batches(batch_size=chunk_size)
+        elif isinstance(self._reader, pa.ipc.RecordBatchFileReader):
+            for i in range(self._reader.num_record_batches):
+                yield self._reader.get_batch(i)
+        else:
+            yield from self._reader
+
+    def chunks(self, chunk_size: int, load_mode: str = "bulk", skip_rows: int = 0) -> Iterator[Tuple[int, object]]:
+        """
+        Yield (row_count, columns) of at most chunk_size rows. Always column
+        batches: the caller loads columnar inputs in bulk mode.
+        """
+        skip = skip_rows
+        for batch in self._batches(chunk_size):
+            if skip >= batch.num_rows:
+                skip -= batch.num_rows
+                self.rows_read += batch.num_rows
+                continue
+            self.rows_read += skip
+            for off in range(skip, batch.num_rows, chunk_size):
+                part = batch.slice(off, chunk_size)
+                self.rows_read += part.num_rows
+                yield part.num_rows, batch_columns(part)
+            skip = 0
@@ -1,12 +1,108 @@
 # etl-service/src/db.py
-import asyncpg, os
+"""
+One asyncpg pool for the whole service.
 
-async def get_pool():
-    return await asyncpg.create_pool(
+The pool is opened by the FastAPI lifespan hook (main.lifespan) and shared by
+every job; get_pool() creates it lazily when the app runs without lifespan
+(e.g. a bare TestClient). Sizing and statement caching come from the env.
+"""
+import asyncio
+import os
+import time
+from contextlib import asynccontextmanager
+from typing import Any, Dict, Optional
+
+import asyncpg
+from asyncpg import Pool
+
+import metrics
+
+_pool: Optional[Pool] = None
+_pool_loop: Optional[asyncio.AbstractEventLoop] = None
+_lock: Optional[asyncio.Lock] = None
+
+# acquire() bookkeeping, exposed through pool_stats()
+_stats: Dict[str, Any] = {
+    "acquires": 0,
+    "waiting": 0,
+    "saturatedAcquires": 0,   # acquires that found the pool full and nothing idle
+    "waitSecondsTotal": 0.0,
+    "waitSecondsMax": 0.0,
+}
+
+def pool_config() -> Dict[str, Any]:
+    return dict(
         user=os.getenv("POSTGRES_USER", "user"),
-        password=os.getenv("POSTGRES_PASSWORD", "password"),
+        password=os.getenv("POSTGRES_PASSWORD", "pass"),
         host=os.getenv("POSTGRES_HOST", "postgres"),
         port=int(os.getenv("POSTGRES_PORT", "5432")),
         database=os.getenv("POSTGRES_DB", "clinical_data"),
-        min_size=1, max_size=10,
+        min_size=int(os.getenv("ETL_POOL_MIN_SIZE", "2")),
+        max_size=int(os.getenv("ETL_POOL_MAX_SIZE", "10")),
+        # prepared statements are cached per connection and reused across jobs
+        statement_cache_size=int(os.getenv("ETL_STATEMENT_CACHE_SIZE", "256")),
+        max_inactive_connection_lifetime=float(os.getenv("ETL_POOL_MAX_IDLE_SECONDS", "300")),
+    )
+
+async def get_pool() -> Pool:
+    """Return the shared pool, creating it on first use."""
+    global _pool, _pool_loop, _lock
+    loop = asyncio.get_running_loop()
+    if _pool is not None and _pool_loop is loop:
+        return _pool
+    if _lock is None or _pool_loop is not loop:
+        # a pool (and its lock) is bound to the loop that created it; that
+        # loop may be closed, so the old pool is terminated rather than closed
+        if _pool is not None:
+            _pool.terminate()
+        _lock, _pool, _pool_loop = asyncio.Lock(), None, loop
+    async with _lock:
+        if _pool is None:
+            _pool = await asyncpg.create_pool(**pool_config())
+        return _pool
+
+async def close_pool():
+    global _pool, _pool_loop
+    pool, _pool, _pool_loop = _pool, None, None
+    if pool is not None:
+        await pool.close()
+
+@asynccontextmanager
+async def acquire():
+    """pool.acquire() that records how long callers wait for a connection."""
+    pool = await get_pool()
+    _stats["acquires"] += 1
+    # with nothing idle the pool can still open a connection until it is at max_size
+    if pool.get_idle_size() == 0 and pool.get_size() >= pool.get_max_size():
+        _stats["saturatedAcquires"] += 1
+    _stats["waiting"] += 1
+    t0 = time.perf_counter()
+    try:
+        conn = await pool.acquire()
+    finally:
+        _stats["waiting"] -= 1
+    waited = time.perf_counter() - t0
+    _stats["waitSecondsTotal"] += waited
+    _stats["waitSecondsMax"] = max(_stats["waitSecondsMax"], waited)
+    metrics.observe("pool_wait", waited)
+    try:
+        yield conn
+    finally:
+        await pool.release(conn)
+
+def pool_stats() -> Dict[str, Any]:
+    out: Dict[str, Any] = dict(_stats)
+    if _pool is None:
+        out.update(open=False)
+        return out
+    size, idle = _pool.get_size(), _pool.get_idle_size()
+    out.update(
+        open=True,
+        size=size,
+        idle=idle,
+        inUse=size - idle,
+        minSize=_pool.get_min_size(),
+        maxSize=_pool.get_max_size(),
+        saturation=round((size - idle) / _pool.get_max_size(), 3),
     )
+    return out
@@ -0,0 +1,229 @@
+# etl-service/src/dedupe.py
+"""
+Deduplicating loads keyed on a measurement's natural identity,
+(study_id, participant_id, measurement_type_id, ts), which the unique index
+uq_fact_natural_key enforces. The index is part of the schema, so a
+measurement is never stored twice and there is no mode that inserts
+blindly: a re-sent row is counted as skipped (or updates the stored one),
+not loaded again or failed.
+
+Modes (ETL_DEDUPE, or "dedupe" on POST /jobs):
+  skip    the default; ON CONFLICT DO NOTHING: the row already loaded wins
+  update  ON CONFLICT DO UPDATE: the incoming row replaces it (identical
+          rows are left alone and counted as skipped)
+
+The index-free load tables of detached loads take plain inserts whatever
+the mode (see effective()); partitions.finish_detached rejects a load that
+repeats a key.
+
+Duplicates inside a chunk are dropped in memory first, through a dict
+keyed on the natural key (so at most one chunk of keys is held): DO UPDATE
+cannot touch a row twice in one statement, and the database never sees
+them. skip keeps a key's first row, update its last.
+
+Both load paths then send the chunk through one upsert_sql() statement
+that returns how many rows were written and how many keys already existed,
+which is enough to split inserted / updated / skipped, plus the chunk
+positions of the rows it did not write (so snapshots and profiles leave
+them out), and merges the newly inserted rows into the rollups. Updates can lower a max or raise a min,
+which a rollup delta cannot express, so the (study, day) slices they touch
+are rebuilt from the facts in the same transaction.
+"""
+import json
+import os
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import date
+from typing import Dict, List, Optional, Sequence, Set, Tuple
+
+import rollups
+
+MODES = ("skip", "update")
+# "off" was a separate mode that behaved as skip; jobs queued with it still run
+_ALIASES = {"off": "skip"}
+MODE = os.getenv("ETL_DEDUPE", "skip")
+MODE = _ALIASES.get(MODE, MODE)
+
+NATURAL_KEY = ("study_id", "participant_id", "measurement_type_id", "ts")
+FACT_COLUMNS = (
+    "study_id", "participant_id", "site_id", "measurement_type_id", "unit_id",
+    "value_numeric", "systolic", "diastolic", "quality_score", "ts", "source_file", "is_valid", "quality_flags",
+)
+UPDATE_COLUMNS = (
+    "site_id", "unit_id", "value_numeric", "systolic", "diastolic",
+    "quality_score", "source_file", "is_valid", "quality_flags",
+)
+
+# positions of the natural key in main.fact_args tuples, and its names in parsed batches
+ARGS_KEY = (0, 1, 3, 9)
+BATCH_KEY = ("study_id", "participant_id", "measurement_type", "ts")
+
+# row path: chunk rows (ids resolved, with their position in the chunk) are
+# COPYed here, then upserted set-based
+FACT_STAGE = "etl_stage_fact"
+CREATE_FACT_STAGE = f"""
+CREATE TEMP TABLE IF NOT EXISTS {FACT_STAGE} (
+  study_id            TEXT,
+  participant_id      TEXT,
+  site_id             TEXT,
+  measurement_type_id INT,
+  unit_id             INT,
+  value_numeric       NUMERIC(12,4),
+  systolic            SMALLINT,
+  diastolic           SMALLINT,
+  quality_score       NUMERIC(4,3),
+  ts                  TIMESTAMPTZ,
+  source_file         TEXT,
+  is_valid            BOOLEAN,
+  quality_flags       TEXT[],
+  pos                 INT
+) ON COMMIT DELETE ROWS;
+"""
+TRUNCATE_FACT_STAGE = f"TRUNCATE {FACT_STAGE};"
+FACT_STAGE_SOURCE = f"SELECT {', '.join(FACT_COLUMNS)}, pos FROM {FACT_STAGE}"
+
+_mode: ContextVar[str] = ContextVar("etl_dedupe", default=MODE)
+
+
+def current() -> str:
+    """Dedupe mode of the job running in this task (ETL_DEDUPE outside a job)."""
+    return _mode.get()
+
+
+def effective(mode: str, unique: bool) -> Optional[str]:
+    """The mode a write runs under; None (plain inserts) on a table without the natural key index."""
+    return mode if unique else None
+
+
+@contextmanager
+def job_mode(mode: str):
+    mode = _ALIASES.get(mode, mode)
+    if mode not in MODES:
+        raise ValueError(f"unknown dedupe mode {mode!r}")
+    token = _mode.set(mode)
+    try:
+        yield
+    finally:
+        _mode.reset(token)
+
+
+_upsert_sql: Dict[Tuple[str, str, str, bool], str] = {}
+
+def upsert_sql(source: str, table: str, mode: str) -> str:
+    """
+    Insert the rows of `source` (a SELECT of FACT_COLUMNS and pos, no
+    duplicate keys) into `table` under `mode`. Returns one row: written,
+    existing, inserted, touched (JSON [[study_id, day], ...] of updated
+    rows) and unwritten (pos of the source rows not written, or NULL).
+    """
+    cache_key = (source, table, mode, rollups.ENABLED)
+    if cache_key in _upsert_sql:
+        return _upsert_sql[cache_key]
+    key = ", ".join(NATURAL_KEY)
+    cols = ", ".join(FACT_COLUMNS)
+    if mode == "skip":
+        action = "DO NOTHING"
+    else:
+        sets = ", ".join(f"{c} = EXCLUDED.{c}" for c in UPDATE_COLUMNS)
+        old = ", ".join(f"f.{c}" for c in UPDATE_COLUMNS)
+        new = ", ".join(f"EXCLUDED.{c}" for c in UPDATE_COLUMNS)
+        action = f"DO UPDATE SET {sets}\n  WHERE ({old}) IS DISTINCT FROM ({new})"
+    roll = f",\nroll AS (\n{rollups.merge_sql('new')}\n)" if rollups.ENABLED else ""
+    # every CTE sees the table as it was before the statement, so `old` holds
+    # the keys that already existed and `ins` the rows written now
+    sql = f"""
+WITH src AS (
+{source}
+),
+old AS (
+  SELECT {", ".join(f"f.{c}" for c in NATURAL_KEY)}
+  FROM "{table}" f JOIN src USING ({key})
+),
+ins AS (
+  INSERT INTO "{table}" AS f ({cols})
+  SELECT {cols} FROM src ORDER BY {key}
+  ON CONFLICT ({key}) {action}
+  RETURNING f.*
+),
+new AS (
+  SELECT ins.* FROM ins LEFT JOIN old USING ({key}) WHERE old.ts IS NULL
+){roll}
+SELECT
+  (SELECT count(*) FROM ins) AS written,
+  (SELECT count(*) FROM old) AS existing,
+  (SELECT count(*) FROM new) AS inserted,
+  (SELECT jsonb_agg(DISTINCT jsonb_build_array(ins.study_id, (ins.ts AT TIME ZONE 'UTC')::date))
+     FROM ins JOIN old USING ({key})) AS touched,
+  (SELECT array_agg(src.pos) FROM src LEFT JOIN ins USING ({key}) WHERE ins.ts IS NULL) AS unwritten;"""
+    _upsert_sql[cache_key] = sql
+    return sql
+
+
+# ----------------------------------------------------------------------
+# In-chunk duplicates
+# ----------------------------------------------------------------------
+def _keep(keys: Sequence[tuple], mode: str) -> List[int]:
+    """Positions to keep: one per key, the first (skip) or last (update) occurrence, in input order."""
+    seen: Dict[tuple, int] = {}
+    for i, k in enumerate(keys):
+        if mode == "update" or k not in seen:
+            seen[k] = i
+    return sorted(seen.values()) if len(seen) < len(keys) else list(range(len(keys)))
+
+
+def unique_args(args: List[tuple], mode: str) -> Tuple[List[tuple], List[int]]:
+    """Drop in-chunk duplicates from fact_args tuples; returns (rows, their positions in args)."""
+    keep = _keep([tuple(a[i] for i in ARGS_KEY) for a in args], mode)
+    if len(keep) == len(args):
+        return args, keep
+    return [args[i] for i in keep], keep
+
+
+def unique_batch(batch: Dict[str, list], mode: str) -> Tuple[Dict[str, list], List[int]]:
+    """Drop in-chunk duplicates from a parsed column batch; returns (batch, its rows' positions in batch)."""
+    n = len(batch["study_id"])
+    keep = _keep(list(zip(*(batch[c] for c in BATCH_KEY))), mode)
+    if len(keep) == n:
+        return batch, keep
+    return {k: [v[i] for i in keep] for k, v in batch.items()}, keep
+
+
+# ----------------------------------------------------------------------
+# Upserts (call inside the chunk transaction)
+# ----------------------------------------------------------------------
+async def _finish(conn, row, submitted: int, unwritten: Optional[Set[int]]) -> Tuple[int, int, int]:
+    """Turn an upsert_sql() result into (inserted, updated, skipped), fixing rollups of updated rows."""
+    if unwritten is not None and row["unwritten"]:
+        unwritten.update(row["unwritten"])
+    inserted = row["inserted"]
+    updated = row["written"] - inserted
+    skipped = submitted - row["written"]
+    if updated and rollups.ENABLED:
+        touched = row["touched"]
+        for study_id, day in sorted(json.loads(touched) if isinstance(touched, str) else touched):
+            await rollups.rebuild(conn, study_id, date.fromisoformat(day))
+    return inserted, updated, skipped
+
+
+async def upsert_staged(conn, source: str, submitted: int, table: str, mode: str,
+                        unwritten: Optional[Set[int]] = None) -> Tuple[int, int, int]:
+    """
+    Upsert rows already staged (bulk path: the loader's staging join); the
+    pos of rows not written (keys already loaded, or unchanged) go to unwritten.
+    """
+    return await _finish(conn, await conn.fetchrow(upsert_sql(source, table, mode)), submitted, unwritten)
+
+
+async def upsert_rows(conn, args: List[tuple], table: str, mode: str,
+                      unwritten: Optional[Set[int]] = None) -> Tuple[int, int, int]:
+    """
+    Upsert fact_args tuples, each followed by its position in the chunk (row
+    path): COPY to the fact stage, then one statement. See upsert_staged.
+    """
+    if not args:
+        return 0, 0, 0
+    await conn.execute(CREATE_FACT_STAGE)
+    await conn.execute(TRUNCATE_FACT_STAGE)  # replayed sub-batches share one transaction
+    await conn.copy_records_to_table(FACT_STAGE, records=args, columns=[*FACT_COLUMNS, "pos"])
+    return await upsert_staged(conn, FACT_STAGE_SOURCE, len(args), table, mode, unwritten)
+
@@ -0,0 +1,209 @@
+# etl-service/src/dimcache.py
+"""
+Service-lifetime cache of dimension keys.
+
+Maps measurement type / unit names to their surrogate ids and remembers which
+study, site and (study_id, participant_id) keys already exist, so the loader
+can send resolved integer ids and skip upserts it has already done.
+Participants are the only unbounded keyspace and are kept in an LRU.
+"""
+import os
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, Set, Tuple
+
+# Resolve-or-create a surrogate id in one round-trip.
+_RESOLVE_ID = """
+WITH ins AS (
+  INSERT INTO {table}(name) VALUES($1)
+  ON CONFLICT (name) DO NOTHING
+  RETURNING id
+)
+SELECT id FROM ins
+UNION ALL
+SELECT id FROM {table} WHERE name=$1
+LIMIT 1;
+"""
+RESOLVE_MEAS_TYPE = _RESOLVE_ID.format(table="dim_measurement_type")
+RESOLVE_UNIT = _RESOLVE_ID.format(table="dim_unit")
+
+# ids of names a bulk upsert did not return (they already existed)
+SELECT_IDS = {
+    "measurement_type": "SELECT id, name FROM dim_measurement_type WHERE name = ANY($1::text[]);",
+    "unit": "SELECT id, name FROM dim_unit WHERE name = ANY($1::text[]);",
+}
+
+UPSERT_STUDY = "INSERT INTO dim_study(study_id) VALUES($1) ON CONFLICT DO NOTHING;"
+UPSERT_PARTICIPANT = "INSERT INTO dim_participant(study_id, participant_id) VALUES($1,$2) ON CONFLICT DO NOTHING;"
+UPSERT_SITE = "INSERT INTO dim_site(site_id) VALUES($1) ON CONFLICT DO NOTHING;"
+
+DIMENSIONS = ("study", "participant", "site", "measurement_type", "unit")
+
+
+class DimensionCache:
+    def __init__(self, max_participants: int = 100_000):
+        self.max_participants = max_participants
+        self.measurement_types: Dict[str, int] = {}
+        self.units: Dict[str, int] = {}
+        self.studies: Set[str] = set()
+        self.sites: Set[str] = set()
+        self.participants: "OrderedDict[Tuple[str, str], None]" = OrderedDict()
+        self.hits: Dict[str, int] = {d: 0 for d in DIMENSIONS}
+        self.misses: Dict[str, int] = {d: 0 for d in DIMENSIONS}
+        self.evictions = 0
+        self.warmed = False
+
+    # ------------------------------------------------------------------
+    # Warm-up / bookkeeping
+    # ------------------------------------------------------------------
+    async def warm(self, conn):
+        """Load existing dimension keys; participants up to the LRU bound."""
+        await self.load_names(conn)
+        for r in await conn.fetch("SELECT study_id FROM dim_study"):
+            self.studies.add(r["study_id"])
+        for r in await conn.fetch("SELECT site_id FROM dim_site"):
+            self.sites.add(r["site_id"])
+        rows = await conn.fetch(
+            "SELECT study_id, participant_id FROM dim_participant LIMIT $1", self.max_participants
+        )
+        for r in rows:
+            self.participants[(r["study_id"], r["participant_id"])] = None
+        self.warmed = True
+
+    async def load_names(self, conn):
+        """(Re)load the measurement type and unit ids, e.g. for ids created by another replica."""
+        for r in await conn.fetch("SELECT id, name FROM dim_measurement_type"):
+            self.measurement_types[r["name"]] = r["id"]
+        for r in await conn.fetch("SELECT id, name FROM dim_unit"):
+            self.units[r["name"]] = r["id"]
+
+    def names(self) -> Tuple[Dict[int, str], Dict[int, str]]:
+        """id -> name for measurement types and units (the export path reads ids back)."""
+        return ({i: n for n, i in self.measurement_types.items()},
+                {i: n for n, i in self.units.items()})
+
+    def clear(self):
+        self.measurement_types.clear()
+        self.units.clear()
+        self.studies.clear()
+        self.sites.clear()
+        self.participants.clear()
+        self.warmed = False
+
+    def _touch_participant(self, key: Tuple[str, str]) -> bool:
+        if key in self.participants:
+            self.participants.move_to_end(key)
+            self.hits["participant"] += 1
+            return True
+        self.misses["participant"] += 1
+        return False
+
+    def remember_participant(self, key: Tuple[str, str]):
+        self.participants[key] = None
+        self.participants.move_to_end(key)
+        while len(self.participants) > self.max_participants:
+            self.participants.popitem(last=False)
+            self.evictions += 1
+
+    def _count(self, dim: str, hit: bool) -> bool:
+        if hit:
+            self.hits[dim] += 1
+        else:
+            self.misses[dim] += 1
+        return hit
+
+    # ------------------------------------------------------------------
+    # Row path: resolve/ensure one key at a time. Upserts on a miss run in
+    # autocommit (outside the fact transaction) so a rolled-back fact can
+    # never leave the cache pointing at a key that does not exist.
+    # ------------------------------------------------------------------
+    async def measurement_type_id(self, conn, name: str) -> int:
+        if self._count("measurement_type", name in self.measurement_types):
+            return self.measurement_types[name]
+        self.measurement_types[name] = await conn.fetchval(RESOLVE_MEAS_TYPE, name)
+        return self.measurement_types[name]
+
+    async def unit_id(self, conn, name: str) -> int:
+        if self._count("unit", name in self.units):
+            return self.units[name]
+        self.units[name] = await conn.fetchval(RESOLVE_UNIT, name)
+        return self.units[name]
+
+    async def ensure_study(self, conn, study_id: str):
+        if self._count("study", study_id in self.studies):
+            return
+        await conn.execute(UPSERT_STUDY, study_id)
+        self.studies.add(study_id)
+
+    async def ensure_site(self, conn, site_id: str):
+        if self._count("site", site_id in self.sites):
+            return
+        await conn.execute(UPSERT_SITE, site_id)
+        self.sites.add(site_id)
+
+    async def ensure_participant(self, conn, study_id: str, participant_id: str):
+        key = (study_id, participant_id)
+        if self._touch_participant(key):
+            return
+        await conn.execute(UPSERT_PARTICIPANT, study_id, participant_id)
+        self.remember_participant(key)
+
+    async def resolve(self, conn, rec: Dict[str, Any]) -> Tuple[int, int]:
+        """Make sure every dimension key of a parsed row exists; return (measurement_type_id, unit_id)."""
+        await self.ensure_study(conn, rec["study_id"])
+        await self.ensure_participant(conn, rec["study_id"], rec["participant_id"])
+        await self.ensure_site(conn, rec["site_id"])
+        mt_id = await self.measurement_type_id(conn, rec["measurement_type"])
+        unit_id = await self.unit_id(conn, rec["unit"])
+        return mt_id, unit_id
+
+    # ------------------------------------------------------------------
+    # Bulk path: decide per chunk which set-based upserts can be skipped,
+    # then learn the chunk's keys once it has committed.
+    # ------------------------------------------------------------------
+    def unknown_dimensions(self, batch: Dict[str, list]) -> Set[str]:
+        """Dimensions with at least one key in a parsed column batch that is not cached."""
+        known = {
+            "study": self.studies.issuperset(batch["study_id"]),
+            "participant": self.participants.keys() >= set(zip(batch["study_id"], batch["participant_id"])),
+            "site": self.sites.issuperset(batch["site_id"]),
+            "measurement_type": self.measurement_types.keys() >= set(batch["measurement_type"]),
+            "unit": self.units.keys() >= set(batch["unit"]),
+        }
+        for d, hit in known.items():
+            self._count(d, hit)
+        return {d for d, hit in known.items() if not hit}
+
+    def remember_chunk(self, batch: Dict[str, list]):
+        self.studies.update(batch["study_id"])
+        self.sites.update(batch["site_id"])
+        for key in dict.fromkeys(zip(batch["study_id"], batch["participant_id"])):
+            self.remember_participant(key)
+
+    def missing_ids(self, dim: str, names: Iterable[str], returned: Iterable[Any]) -> List[str]:
+        """Names with no cached id that the upsert did not return either (ON CONFLICT); see SELECT_IDS."""
+        target = self.measurement_types if dim == "measurement_type" else self.units
+        return sorted(set(names).difference(target, (r["name"] for r in returned)))
+
+    def remember_ids(self, dim: str, rows: Iterable[Any]):
+        target = self.measurement_types if dim == "measurement_type" else self.units
+        for r in rows:
+            target[r["name"]] = r["id"]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "warmed": self.warmed,
+            "sizes": {
+                "study": len(self.studies),
+                "participant": len(self.participants),
+                "site": len(self.sites),
+                "measurement_type": len(self.measurement_types),
+                "unit": len(self.units),
+            },
+            "maxParticipants": self.max_participants,
+            "hits": dict(self.hits),
+            "misses": dict(self.misses),
+            "evictions": self.evictions,
+        }
+
+
+dim_cache = DimensionCache(int(os.getenv("ETL_DIM_CACHE_PARTICIPANTS", "100000")))
@@ -0,0 +1,196 @@
+# etl-service/src/export.py
+"""
+Streaming export of one study from fact_measurement (GET /studies/{id}/export).
+
+Rows come out in the order of idx_fact_study_part_ts, i.e. (participant_id,
+ts DESC) within the study, with measurement_type_id breaking ties. They are
+read in keyset pages of PAGE_ROWS: each page is one query that starts after
+the last row sent (no OFFSET, so page n costs what page 1 does), fetched
+whole into memory over a pooled connection that is released before any of
+it is written. The page then goes to the client BATCH_ROWS at a time, and
+the next page is only queried once the client has taken the last batch,
+so a slow reader slows the export down instead of growing a buffer or
+holding a connection the loads need.
+
+A server-side cursor would stream a large page BATCH_ROWS at a time, but
+only while its connection (and transaction) stays open between the
+client's reads. Instead a page defaults to BATCH_ROWS rows, so an export
+holds no more rows than one cursor fetch would, and pays one indexed
+keyset query per page for it.
+
+Measurement type and unit names come from the dimension cache (reloaded
+when a page has an id the cache does not know yet) instead of a join per
+row. A client that lost the connection can continue after the last row it
+got by passing that row's participantId, ts and measurementType as
+afterParticipant / afterTs / afterType.
+
+Formats: NDJSON (one JSON object per line), or an Arrow IPC stream with one
+record batch per BATCH_ROWS batch (needs pyarrow).
+"""
+import json
+import os
+from datetime import datetime
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+import db
+from dimcache import dim_cache
+
+try:
+    import pyarrow as pa
+    import pyarrow.ipc
+except ImportError:  # optional: only needed for format=arrow
+    pa = None
+
+BATCH_ROWS = int(os.getenv("ETL_EXPORT_BATCH_ROWS", "5000"))
+PAGE_ROWS = int(os.getenv("ETL_EXPORT_PAGE_ROWS", str(BATCH_ROWS)))
+
+FORMATS = {"ndjson": "application/x-ndjson", "arrow": "application/vnd.apache.arrow.stream"}
+
+_SELECT = """
+SELECT participant_id, site_id, measurement_type_id, unit_id,
+       value_numeric::float8 AS value_numeric, systolic, diastolic,
+       quality_score::float8 AS quality_score, is_valid, quality_flags, ts, source_file
+FROM fact_measurement
+WHERE study_id = $1 {after}
+ORDER BY participant_id, ts DESC, measurement_type_id
+LIMIT {limit};
+"""
+SELECT_FIRST = _SELECT.format(after="", limit="$2")
+# keyset: strictly after ($2, $3, $4) in the order above; the plain >= gives the index scan its start
+SELECT_AFTER = _SELECT.format(after="""
+  AND participant_id >= $2
+  AND (participant_id > $2 OR ts < $3 OR (ts = $3 AND measurement_type_id > $4))""", limit="$5")
+
+Key = Tuple[str, datetime, int]
+
+
+class ExportError(ValueError):
+    """Bad export request (unknown format, incomplete cursor, ...)."""
+
+
+async def _batches(study_id: str, after: Optional[Key]) -> AsyncIterator[List[Any]]:
+    """Record batches of the study's rows after `after`, page by page."""
+    while True:
+        async with db.acquire() as conn:
+            if after is None:
+                page = await conn.fetch(SELECT_FIRST, study_id, PAGE_ROWS)
+            else:
+                page = await conn.fetch(SELECT_AFTER, study_id, *after, PAGE_ROWS)
+            await _ensure_names(conn, page)
+        # the connection is back in the pool before the client sees a row
+        for i in range(0, len(page), BATCH_ROWS):
+            yield page[i:i + BATCH_ROWS]
+        if len(page) < PAGE_ROWS:
+            return
+        last = page[-1]
+        after = (last["participant_id"], last["ts"], last["measurement_type_id"])
+
+
+async def _ensure_names(conn, batch):
+    types, units = set(dim_cache.measurement_types.values()), set(dim_cache.units.values())
+    if any(r["measurement_type_id"] not in types or r["unit_id"] not in units for r in batch):
+        await dim_cache.load_names(conn)
+
+
+def _columns(batch, study_id: str) -> Dict[str, list]:
+    type_names, unit_names = dim_cache.names()
+    return {
+        "studyId": [study_id] * len(batch),
+        "participantId": [r["participant_id"] for r in batch],
+        "siteId": [r["site_id"] for r in batch],
+        "measurementType": [type_names.get(r["measurement_type_id"]) for r in batch],
+        "unit": [unit_names.get(r["unit_id"]) for r in batch],
+        "value": [r["value_numeric"] for r in batch],
+        "systolic": [r["systolic"] for r in batch],
+        "diastolic": [r["diastolic"] for r in batch],
+        "qualityScore": [r["quality_score"] for r in batch],
+        "isValid": [r["is_valid"] for r in batch],
+        "qualityFlags": [list(r["quality_flags"]) for r in batch],
+        "ts": [r["ts"] for r in batch],
+        "sourceFile": [r["source_file"] for r in batch],
+    }
+
+
+def ndjson_chunk(cols: Dict[str, list]) -> bytes:
+    names = list(cols)
+    cols = {**cols, "ts": [t.isoformat() for t in cols["ts"]]}
+    lines = (json.dumps(dict(zip(names, row)), separators=(",", ":")) for row in zip(*cols.values()))
+    return ("\n".join(lines) + "\n").encode()
+
+
+def arrow_schema():
+    return pa.schema([
+        ("studyId", pa.string()), ("participantId", pa.string()), ("siteId", pa.string()),
+        ("measurementType", pa.string()), ("unit", pa.string()), ("value", pa.float64()),
+        ("systolic", pa.int16()), ("diastolic", pa.int16()), ("qualityScore", pa.float64()),
+        ("isValid", pa.bool_()), ("qualityFlags", pa.list_(pa.string())),
+        ("ts", pa.timestamp("us", tz="UTC")), ("sourceFile", pa.string()),
+    ])
+
+
+class _Sink:
+    """Collects what the IPC writer produced since the last take()."""
+
+    def __init__(self):
+        self.parts: List[bytes] = []
+
+    def write(self, data):
+        self.parts.append(bytes(data))
+
+    def take(self) -> bytes:
+        out, self.parts = b"".join(self.parts), []
+        return out
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+    @property
+    def closed(self):
+        return False
+
+
+async def parse_after(participant: Optional[str], ts: Optional[str],
+                      measurement_type: Optional[str]) -> Optional[Key]:
+    """The keyset cursor from the last row a client got, or None to start at the beginning."""
+    given = [v is not None for v in (participant, ts, measurement_type)]
+    if not any(given):
+        return None
+    if not all(given):
+        raise ExportError("afterParticipant, afterTs and afterType go together")
+    try:
+        when = datetime.fromisoformat(ts)
+    except ValueError:
+        raise ExportError(f"afterTs is not an ISO timestamp: {ts}")
+    if when.tzinfo is None:
+        raise ExportError("afterTs needs a UTC offset (use the ts of the exported row)")
+    if measurement_type not in dim_cache.measurement_types:
+        async with db.acquire() as conn:
+            await dim_cache.load_names(conn)
+        if measurement_type not in dim_cache.measurement_types:
+            raise ExportError(f"unknown measurement type: {measurement_type}")
+    return participant, when, dim_cache.measurement_types[measurement_type]
+
+
+async def stream(study_id: str, fmt: str, after: Optional[Key] = None) -> AsyncIterator[bytes]:
+    """The export body in `fmt`, produced batch by batch."""
+    if fmt == "ndjson":
+        async for batch in _batches(study_id, after):
+            yield ndjson_chunk(_columns(batch, study_id))
+        return
+    schema = arrow_schema()
+    sink = _Sink()
+    with pa.ipc.new_stream(sink, schema) as writer:
+        async for batch in _batches(study_id, after):
+            writer.write_batch(pa.RecordBatch.from_pydict(_columns(batch, study_id), schema=schema))
+            yield sink.take()
+    yield sink.take()  # end-of-stream marker (and the schema, if there were no rows)
+
+
+def check_format(fmt: str):
+    if fmt not in FORMATS:
+        raise ExportError(f"format must be one of {sorted(FORMATS)}")
+    if fmt == "arrow" and pa is None:
+        raise ExportError("format=arrow needs the pyarrow package")
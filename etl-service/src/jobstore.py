@@ -0,0 +1,208 @@
+# etl-service/src/jobstore.py
+"""
+Job state backed by the etl_jobs table.
+
+Jobs running on this replica live in JobRepository.jobs (same shape the API
+has always returned). update() only touches that dict and marks the job
+dirty; a background task flushes all dirty jobs in one executemany every
+flush_interval seconds, so progress tracking never puts a write in the
+load loop. Jobs owned by other replicas (or from before a restart) are read
+from etl_jobs through a short-TTL read-through cache.
+"""
+import asyncio
+import json
+import os
+import time
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+import db
+
+# job dict key -> etl_jobs column
+COLUMNS = {
+    "jobId": "id",
+    "filename": "filename",
+    "studyId": "study_id",
+    "status": "status",
+    "progress": "progress",
+    "message": "message",
+    "loadMode": "load_mode",
+    "rowsProcessed": "rows_processed",
+    "rowsInserted": "rows_inserted",
+    "rowsFailed": "rows_failed",
+    "createdAt": "created_at",
+    "updatedAt": "updated_at",
+}
+
+UPSERT_JOB = """
+INSERT INTO etl_jobs (id, filename, study_id, status, progress, message, load_mode,
+                      rows_processed, rows_inserted, rows_failed, details, created_at, updated_at)
+VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11::jsonb, $12, $13)
+ON CONFLICT (id) DO UPDATE SET
+  status         = EXCLUDED.status,
+  progress       = EXCLUDED.progress,
+  message        = EXCLUDED.message,
+  load_mode      = EXCLUDED.load_mode,
+  rows_processed = EXCLUDED.rows_processed,
+  rows_inserted  = EXCLUDED.rows_inserted,
+  rows_failed    = EXCLUDED.rows_failed,
+  details        = EXCLUDED.details,
+  updated_at     = EXCLUDED.updated_at;
+"""
+
+SELECT_JOB = """
+SELECT id, filename, study_id, status, progress, message, load_mode,
+       rows_processed, rows_inserted, rows_failed, details, created_at, updated_at
+FROM etl_jobs WHERE id = $1;
+"""
+
+
+def now_iso() -> str:
+    return datetime.utcnow().isoformat()
+
+
+def _ts(value: Optional[str]) -> datetime:
+    # job dicts carry naive UTC ISO strings
+    d = datetime.fromisoformat(value) if value else datetime.utcnow()
+    return d if d.tzinfo else d.replace(tzinfo=timezone.utc)
+
+
+def to_params(job: Dict[str, Any]) -> Tuple:
+    details = {k: v for k, v in job.items() if k not in COLUMNS}
+    return (
+        job["jobId"], job.get("filename") or "", job.get("studyId"), job.get("status") or "queued",
+        int(job.get("progress") or 0), job.get("message"), job.get("loadMode"),
+        int(job.get("rowsProcessed") or 0), int(job.get("rowsInserted") or 0), int(job.get("rowsFailed") or 0),
+        json.dumps(details, default=str), _ts(job.get("createdAt")), _ts(job.get("updatedAt")),
+    )
+
+
+def from_row(row) -> Dict[str, Any]:
+    job: Dict[str, Any] = {}
+    details = row["details"]
+    if details:
+        job.update(json.loads(details) if isinstance(details, str) else details)
+    for key, col in COLUMNS.items():
+        val = row[col]
+        if isinstance(val, datetime):
+            val = val.astimezone(timezone.utc).replace(tzinfo=None).isoformat()
+        job[key] = val
+    return job
+
+
+class JobRepository:
+    def __init__(self, flush_interval: float = 1.0, cache_ttl: float = 2.0, read_timeout: float = 2.0):
+        self.flush_interval = flush_interval
+        self.cache_ttl = cache_ttl
+        self.read_timeout = read_timeout
+        self.jobs: Dict[str, Dict[str, Any]] = {}
+        self.dirty: Set[str] = set()
+        self._cache: Dict[str, Tuple[float, Dict[str, Any]]] = {}
+        self._task: Optional[asyncio.Task] = None
+        self.flushes = 0
+        self.rows_written = 0
+
+    # ------------------------------------------------------------------
+    # Writes: in-memory first, persisted by the flusher
+    # ------------------------------------------------------------------
+    def create(self, job: Dict[str, Any]) -> Dict[str, Any]:
+        self.jobs[job["jobId"]] = job
+        self.dirty.add(job["jobId"])
+        return job
+
+    def update(self, job_id: str, **fields):
+        job = self.jobs[job_id]
+        job.update(fields)
+        job["updatedAt"] = now_iso()
+        self.dirty.add(job_id)
+
+    def incr(self, job_id: str, **deltas: int):
+        """Add to numeric counters (rowsProcessed, rowsFailed, ...)."""
+        job = self.jobs[job_id]
+        for k, v in deltas.items():
+            job[k] = (job.get(k) or 0) + v
+        self.dirty.add(job_id)
+
+    def forget(self, job_id: str):
+        """Drop a local job without writing it again (another replica reports it now)."""
+        self.jobs.pop(job_id, None)
+        self.dirty.discard(job_id)
+
+    async def flush(self):
+        if not self.dirty:
+            return
+        ids, self.dirty = self.dirty, set()
+        params: List[Tuple] = [to_params(self.jobs[i]) for i in ids if i in self.jobs]
+        try:
+            async with db.acquire() as conn:
+                await conn.executemany(UPSERT_JOB, params)
+            self.flushes += 1
+            self.rows_written += len(params)
+        except Exception as e:
+            self.dirty |= ids  # keep them for the next tick
+            print(f"[ETL] job flush failed ({len(params)} jobs): {e}", flush=True)
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._flush_loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    # ------------------------------------------------------------------
+    # Reads: local jobs are authoritative; others come from etl_jobs
+    # ------------------------------------------------------------------
+    async def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        job = self.jobs.get(job_id)
+        if job is not None:
+            return job
+        hit = self._cache.get(job_id)
+        if hit and hit[0] > time.monotonic():
+            return hit[1]
+        try:
+            row = await asyncio.wait_for(self._fetch(job_id), self.read_timeout)
+        except Exception:
+            return None
+        if row is None:
+            return None
+        job = from_row(row)
+        self._prune()
+        self._cache[job_id] = (time.monotonic() + self.cache_ttl, job)
+        return job
+
+    async def _fetch(self, job_id: str):
+        async with db.acquire() as conn:
+            return await conn.fetchrow(SELECT_JOB, job_id)
+
+    def _prune(self, max_entries: int = 10_000):
+        if len(self._cache) < max_entries:
+            return
+        now = time.monotonic()
+        self._cache = {k: v for k, v in self._cache.items() if v[0] > now}
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "localJobs": len(self.jobs),
+            "dirty": len(self.dirty),
+            "flushes": self.flushes,
+            "rowsWritten": self.rows_written,
+            "cachedRemoteJobs": len(self._cache),
+        }
+
+
+job_store = JobRepository(
+    flush_interval=float(os.getenv("ETL_JOB_FLUSH_SECONDS", "1.0")),
+    cache_ttl=float(os.getenv("ETL_JOB_CACHE_TTL_SECONDS", "2.0")),
+)
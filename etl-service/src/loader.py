@@ -1,73 +1,184 @@
-from asyncpg import Pool
-from typing import Dict, Any, List
+import time
+from typing import Dict, List, Optional, Sequence, Set
 
-UPSERT_STUDY = """
-INSERT INTO dim_study(study_id) VALUES($1)
-ON CONFLICT (study_id) DO NOTHING;
-"""
+import dedupe
+import metrics
+from dimcache import SELECT_IDS, DimensionCache
+from partitions import FACT_TABLE
 
-UPSERT_PARTICIPANT = """
-INSERT INTO dim_participant(study_id, participant_id) VALUES($1,$2)
-ON CONFLICT (study_id, participant_id) DO NOTHING;
-"""
+# ---------------------------------------------------------------------
+# Bulk load path: COPY a chunk into a session-local staging table, upsert
+# the dimensions set-based, then move the facts over with one join.
+# ---------------------------------------------------------------------
 
-UPSERT_SITE = """
-INSERT INTO dim_site(site_id) VALUES($1)
-ON CONFLICT (site_id) DO NOTHING;
-"""
+STAGE_TABLE = "etl_stage_measurement"
 
-UPSERT_MEAS_TYPE = """
-INSERT INTO dim_measurement_type(name) VALUES($1)
-ON CONFLICT (name) DO NOTHING;
-"""
+STAGE_COLUMNS = [
+    "study_id", "participant_id", "site_id", "measurement_type", "unit",
+    "value_numeric", "systolic", "diastolic", "quality_score", "ts",
+    "source_file", "is_valid", "quality_flags", "pos",
+]
 
-UPSERT_UNIT = """
-INSERT INTO dim_unit(name) VALUES($1)
-ON CONFLICT (name) DO NOTHING;
+CREATE_STAGE = f"""
+CREATE TEMP TABLE IF NOT EXISTS {STAGE_TABLE} (
+  study_id         TEXT,
+  participant_id   TEXT,
+  site_id          TEXT,
+  measurement_type TEXT,
+  unit             TEXT,
+  value_numeric    DOUBLE PRECISION,
+  systolic         SMALLINT,
+  diastolic        SMALLINT,
+  quality_score    DOUBLE PRECISION,
+  ts               TIMESTAMPTZ,
+  source_file      TEXT,
+  is_valid         BOOLEAN,
+  quality_flags    TEXT[],
+  pos              INT
+) ON COMMIT DELETE ROWS;
 """
 
-INSERT_MEAS = """
-INSERT INTO fact_measurement(
+# Keyed by dimension name so chunks whose keys are all cached can skip them.
+# Keys are inserted in sorted order so concurrent chunks (sharded loads) take
+# row locks in the same order and cannot deadlock each other.
+# Surrogate-key dimensions return newly created ids for the cache (the ids
+# of names that already existed are selected after them).
+STAGE_UPSERT_DIMS = {
+    "study": f"""INSERT INTO dim_study(study_id)
+SELECT DISTINCT study_id FROM {STAGE_TABLE} ORDER BY 1
+ON CONFLICT (study_id) DO NOTHING;""",
+    "participant": f"""INSERT INTO dim_participant(study_id, participant_id)
+SELECT DISTINCT study_id, participant_id FROM {STAGE_TABLE} ORDER BY 1, 2
+ON CONFLICT (study_id, participant_id) DO NOTHING;""",
+    "site": f"""INSERT INTO dim_site(site_id)
+SELECT DISTINCT site_id FROM {STAGE_TABLE} ORDER BY 1
+ON CONFLICT (site_id) DO NOTHING;""",
+    "measurement_type": f"""INSERT INTO dim_measurement_type(name)
+SELECT DISTINCT measurement_type FROM {STAGE_TABLE} ORDER BY 1
+ON CONFLICT (name) DO NOTHING
+RETURNING id, name;""",
+    "unit": f"""INSERT INTO dim_unit(name)
+SELECT DISTINCT unit FROM {STAGE_TABLE} ORDER BY 1
+ON CONFLICT (name) DO NOTHING
+RETURNING id, name;""",
+}
+
+_STAGE_FACTS = f"""SELECT
+  s.study_id, s.participant_id, s.site_id, mt.id AS measurement_type_id, u.id AS unit_id,
+  s.value_numeric, s.systolic, s.diastolic, s.quality_score, s.ts, s.source_file, s.is_valid, s.quality_flags{{pos}}
+FROM {STAGE_TABLE} s
+JOIN dim_measurement_type mt ON mt.name = s.measurement_type
+JOIN dim_unit u ON u.name = s.unit"""
+
+# staged rows as fact columns (dedupe.FACT_COLUMNS order) and their position in the chunk
+STAGE_FACTS = _STAGE_FACTS.format(pos=", s.pos")
+
+_STAGE_INSERT_FACTS = f"""
+INSERT INTO {{table}}(
   study_id, participant_id, site_id, measurement_type_id, unit_id,
   value_numeric, systolic, diastolic, quality_score, ts, source_file, is_valid, quality_flags
 )
-SELECT
-  $1, $2, $3,
-  (SELECT id FROM dim_measurement_type WHERE name=$4),
-  (SELECT id FROM dim_unit WHERE name=$5),
-  $6, $7, $8, $9, $10, $11, $12, $13;
+{_STAGE_FACTS.format(pos="")};
 """
+_insert_facts_sql: Dict[str, str] = {}
+
+def stage_insert_facts(table: str = FACT_TABLE) -> str:
+    """Staging -> fact insert aimed at `table` (fact_measurement, or a detached load table)."""
+    if table not in _insert_facts_sql:
+        _insert_facts_sql[table] = _STAGE_INSERT_FACTS.format(table=f'"{table}"')
+    return _insert_facts_sql[table]
 
-async def load_row(pool: Pool, ri: Dict[str, Any], payload: Dict[str, Any], source_file: str, is_valid: bool, flags: List[str]):
-    study_id = ri["study_id"]
-    participant_id = ri["participant_id"]
-    site_id = ri["site_id"]
-    mt = ri["measurement_type"]
-    ts = ri["timestamp"]
-    q = ri["quality_score"]
+STAGE_INSERT_FACTS = stage_insert_facts(FACT_TABLE)
 
-    unit = payload.get("unit") or ri.get("unit")  # fallback to raw
-    async with pool.acquire() as conn:
-        async with conn.transaction():
-            await conn.execute(UPSERT_STUDY, study_id)
-            await conn.execute(UPSERT_PARTICIPANT, study_id, participant_id)
-            await conn.execute(UPSERT_SITE, site_id)
-            await conn.execute(UPSERT_MEAS_TYPE, mt)
-            await conn.execute(UPSERT_UNIT, unit)
+def stage_records(batch: Dict[str, list], source_file: str, pos: Optional[Sequence[int]] = None) -> List[tuple]:
+    """
+    Zip a parsed column batch (see batchparse.parse_batch) into staging-table
+    tuples. A "source_file" column (batches coalesced from several files)
+    takes precedence over source_file. pos numbers the rows (0..n-1 by default).
+    """
+    n = len(batch["study_id"])
+    return list(zip(
+        batch["study_id"], batch["participant_id"], batch["site_id"],
+        batch["measurement_type"], batch["unit"],
+        batch["value_numeric"], batch["systolic"], batch["diastolic"],
+        batch["quality_score"], batch["ts"], batch.get("source_file") or [source_file] * n, batch["is_valid"],
+        batch["flags"], pos if pos is not None else range(n),
+    ))
 
-            await conn.execute(
-                INSERT_MEAS,
-                study_id,
-                participant_id,
-                site_id,
-                mt,
-                unit,
-                payload.get("value_numeric"),
-                payload.get("systolic"),
-                payload.get("diastolic"),
-                q,
-                ts,
-                source_file,
-                is_valid,
-                flags if flags else [],
-            )
+async def copy_chunk(conn, batch: Dict[str, list], source_file: str,
+                     cache: Optional[DimensionCache] = None, before_commit=None,
+                     table: str = FACT_TABLE, unwritten: Optional[Set[int]] = None) -> int:
+    """
+    Load one chunk of parsed rows (as columns) in a single transaction:
+    COPY -> staging, one INSERT ... SELECT DISTINCT per dimension, one fact join
+    (an upsert on the natural key unless this is a detached load table; see dedupe.py).
+    With a cache, dimensions whose keys are all known are not upserted again.
+    before_commit(conn), if given, runs last inside the transaction (the job
+    checkpoint). Facts go to `table`, whose partitions must already exist
+    (see partitions.PartitionManager.ensure). Once the chunk committed, the
+    positions in batch of rows that were not written (in-chunk duplicates,
+    keys already loaded) are added to unwritten. Raises on any failure so the
+    caller can fall back to the per-row path.
+    """
+    if not batch["study_id"]:
+        if before_commit:
+            await before_commit(conn)
+        return 0
+    mode = dedupe.effective(dedupe.current(), table == FACT_TABLE)
+    updated = skipped = 0
+    n = len(batch["study_id"])
+    keep: Sequence[int] = range(n)
+    if mode is not None:
+        batch, keep = dedupe.unique_batch(batch, mode)
+        skipped = n - len(keep)
+    not_written = set(range(n)).difference(keep) if skipped else set()
+    unknown = cache.unknown_dimensions(batch) if cache else set(STAGE_UPSERT_DIMS)
+    new_ids: Dict[str, list] = {}
+    t0 = time.perf_counter()
+    async with conn.transaction():
+        await conn.execute(CREATE_STAGE)
+        await conn.copy_records_to_table(
+            STAGE_TABLE,
+            records=stage_records(batch, source_file, keep),
+            columns=STAGE_COLUMNS,
+        )
+        t_dims = time.perf_counter()
+        for dim, sql in STAGE_UPSERT_DIMS.items():
+            if dim not in unknown:
+                continue
+            if dim in ("measurement_type", "unit"):
+                rows = list(await conn.fetch(sql))
+                missing = cache.missing_ids(dim, batch[dim], rows) if cache else ()
+                if missing:
+                    # names another chunk or replica created first return nothing above
+                    rows += await conn.fetch(SELECT_IDS[dim], missing)
+                new_ids[dim] = rows
+            else:
+                await conn.execute(sql)
+        dims_seconds = time.perf_counter() - t_dims
+        if mode is not None:
+            # rollups are merged by the upsert statement itself
+            inserted, updated, conflicts = await dedupe.upsert_staged(
+                conn, STAGE_FACTS, len(batch["study_id"]), table, mode, not_written)
+            skipped += conflicts
+        else:
+            # a detached load table: its months are rolled up when they are
+            # moved into fact_measurement (partitions.finish_detached)
+            status = await conn.execute(stage_insert_facts(table))
+            # status looks like "INSERT 0 <n>"
+            inserted = int(status.split()[-1])
+        if before_commit:
+            await before_commit(conn)
+    # COPY, fact insert (with its rollup merge) and commit count as "insert";
+    # dimension upserts are reported on their own
+    metrics.observe("dimensions", dims_seconds)
+    metrics.observe("insert", time.perf_counter() - t0 - dims_seconds)
+    if mode is not None:
+        metrics.count_rows(updated=updated, skipped=skipped)
+    if unwritten is not None:
+        unwritten.update(not_written)
+    if cache:
+        cache.remember_chunk(batch)
+        for dim, rows in new_ids.items():
+            cache.remember_ids(dim, rows)
+    return inserted
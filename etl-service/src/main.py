@@ -1,20 +1,86 @@
 # etl-service/src/main.py
-from fastapi import FastAPI, BackgroundTasks, HTTPException
-from pydantic import BaseModel
-from typing import Optional, Dict, Any, List
+from fastapi import FastAPI, BackgroundTasks, HTTPException, Query
+from fastapi.responses import PlainTextResponse, Response, StreamingResponse
+from pydantic import BaseModel, Field
+from typing import Optional, Dict, Any, List, Literal, Set, Tuple
 from uuid import uuid4
-import os, csv, re, asyncpg
-from datetime import datetime
+from contextlib import asynccontextmanager
+import os, asyncio, asyncpg, functools
+from datetime import date, datetime
 
-app = FastAPI(title="Clinical Data ETL Service", version="1.0.0")
+import batches
+import batchparse
+import checkpoint
+import db
+import dedupe
+import export
+import loader
+import metrics
+import profiling
+import quarantine
+import rollups
+import sharding
+import snapshots
+import timeseries
+import workqueue
+from checkpoint import Checkpoint, CheckpointLost
+from dimcache import dim_cache
+from jobstore import job_store
+from partitions import FACT_TABLE, LoadOverlap, load_table_name, partition_manager
+from quarantine import ChunkRejects
+from parsing import RECORD_FIELDS, parse_row
+from reader import CSVStream, columnar_format, compression_of, open_input
+from scheduler import scheduler
+from timestamps import TimestampParser
+from workqueue import work_queue
 
-# In-memory job store (demo-grade; a real system would persist this)
-jobs: Dict[str, Dict[str, Any]] = {}
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Open the shared pool and warm the dimension cache once per process.
+    # A database that is not up yet is not fatal: jobs open the pool lazily.
+    try:
+        async with db.acquire() as conn:
+            await dim_cache.warm(conn)
+    except Exception as e:
+        print(f"[ETL] startup: database not ready ({e}); pool will open on first job", flush=True)
+    job_store.start()
+    if workqueue.enabled():
+        work_queue.register("file", functools.partial(scheduler.run, process_file))
+        work_queue.register("batch", functools.partial(scheduler.run, process_batch))
+        work_queue.start(scheduler.free_slots)
+    yield
+    await work_queue.stop()
+    await job_store.stop()
+    sharding.shutdown_executor()
+    await db.close_pool()
+
+app = FastAPI(title="Clinical Data ETL Service", version="1.0.0", lifespan=lifespan)
+
+# Jobs running on this replica; persisted to etl_jobs by job_store's flusher
+jobs: Dict[str, Dict[str, Any]] = job_store.jobs
 
 class ETLJobRequest(BaseModel):
     jobId: Optional[str] = None
     filename: str
     studyId: Optional[str] = None
+    loadMode: Optional[Literal["row", "bulk"]] = None  # defaults to ETL_LOAD_MODE
+    shards: Optional[int] = None  # bulk only; defaults to ETL_SHARDS (0 = one per core)
+    detached: Optional[bool] = None  # load into a detached table, attach partitions when done
+    dedupe: Optional[Literal["skip", "update"]] = None  # defaults to ETL_DEDUPE
+
+class BatchJobRequest(BaseModel):
+    jobId: Optional[str] = None
+    files: List[str] = []  # paths under DATA_DIR
+    glob: Optional[str] = None  # e.g. "study001/site_*.csv"; matches are added after `files`
+    studyId: Optional[str] = None
+    dedupe: Optional[Literal["skip", "update"]] = None  # defaults to ETL_DEDUPE
+    watch: bool = False  # keep polling `glob` for new files until idleSeconds pass without one
+    pollSeconds: float = Field(5.0, gt=0)
+    idleSeconds: float = Field(60.0, ge=0)
+
+class RollupRebuildRequest(BaseModel):
+    studyId: Optional[str] = None
+    day: Optional[date] = None  # UTC day
 
 class ETLJobResponse(BaseModel):
     jobId: str
@@ -28,125 +94,165 @@ class ETLJobStatus(BaseModel):
     message: Optional[str] = None
 
 DATA_DIR = os.getenv("DATA_DIR", "/data")
-PG_HOST = os.getenv("POSTGRES_HOST", "postgres")
-PG_DB   = os.getenv("POSTGRES_DB", "clinical_data")
-PG_USER = os.getenv("POSTGRES_USER", "user")
-PG_PASS = os.getenv("POSTGRES_PASSWORD", "pass")  # matches your docker-compose
-PG_PORT = int(os.getenv("POSTGRES_PORT", "5432"))
-
-BP_RE = re.compile(r"^\s*(\d{2,3})\s*/\s*(\d{2,3})\s*$")
-
-def parse_ts(s: Optional[str]):
-    """Parse ISO8601 strings (including trailing Z) into timezone-aware datetime."""
-    if not s:
-        return None
-    try:
-        if s.endswith("Z"):
-            s = s[:-1] + "+00:00"
-        return datetime.fromisoformat(s)  # tz-aware datetime
-    except Exception:
-        return None
-
-async def get_pool() -> asyncpg.Pool:
-    return await asyncpg.create_pool(
-        user=PG_USER, password=PG_PASS, host=PG_HOST, port=PG_PORT, database=PG_DB,
-        min_size=1, max_size=10
-    )
 
-UPSERT_STUDY = "INSERT INTO dim_study(study_id) VALUES($1) ON CONFLICT DO NOTHING;"
-UPSERT_PARTICIPANT = "INSERT INTO dim_participant(study_id, participant_id) VALUES($1,$2) ON CONFLICT DO NOTHING;"
-UPSERT_SITE = "INSERT INTO dim_site(site_id) VALUES($1) ON CONFLICT DO NOTHING;"
-UPSERT_MEAS_TYPE = "INSERT INTO dim_measurement_type(name) VALUES($1) ON CONFLICT DO NOTHING;"
-UPSERT_UNIT = "INSERT INTO dim_unit(name) VALUES($1) ON CONFLICT DO NOTHING;"
+# "row": one transaction per CSV row; "bulk": COPY + set-based upserts per chunk
+LOAD_MODE = os.getenv("ETL_LOAD_MODE", "row")
+CHUNK_SIZE = int(os.getenv("ETL_CHUNK_SIZE", "5000"))
+
+# Large bulk files are split into byte-range shards parsed in a process pool
+SHARDS = int(os.getenv("ETL_SHARDS", "0"))
+SHARD_MIN_BYTES = int(os.getenv("ETL_SHARD_MIN_BYTES", str(64 * 1024 * 1024)))
+SHARD_PIECE_BYTES = int(os.getenv("ETL_SHARD_PIECE_BYTES", str(4 * 1024 * 1024)))
+# Unsharded loads: chunks read/parsed ahead of the one being written (0 = no pipelining)
+PIPELINE_DEPTH = int(os.getenv("ETL_PIPELINE_DEPTH", "2"))
+# A chunk whose transaction fails is replayed in sub-batches of this many rows
+REPLAY_BATCH = int(os.getenv("ETL_REPLAY_BATCH", "64"))
 
-# Cast $10 to timestamptz as a defensive measure
-INSERT_FACT = """
-INSERT INTO fact_measurement(
+# Dimension keys are resolved to surrogate ids by dim_cache before the insert
+_INSERT_FACT = """
+INSERT INTO {table}(
   study_id, participant_id, site_id, measurement_type_id, unit_id,
   value_numeric, systolic, diastolic, quality_score, ts, source_file, is_valid, quality_flags
 )
-SELECT
-  $1, $2, $3,
-  (SELECT id FROM dim_measurement_type WHERE name=$4),
-  (SELECT id FROM dim_unit WHERE name=$5),
-  $6, $7, $8, $9, $10::timestamptz, $11, $12, $13;
+VALUES($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12, $13);
 """
+_insert_fact_sql: Dict[str, str] = {}
 
-def parse_row(raw: Dict[str, str]) -> Dict[str, Any]:
-    mt = (raw.get("measurement_type") or "").strip().lower()
-    unit = (raw.get("unit") or "").strip()
-    val = raw.get("value")
-    systolic = diastolic = None
-    value_numeric: Optional[float] = None
-    is_valid = True
-    flags: List[str] = []
-
-    if mt == "blood_pressure":
-        m = BP_RE.match(val or "")
-        if m:
-            systolic = int(m.group(1))
-            diastolic = int(m.group(2))
-            unit = "mmHg"
-        else:
-            is_valid = False
-            flags.append("invalid_bp_format")
-    else:
-        try:
-            value_numeric = float(val) if val is not None else None
-        except Exception:
-            is_valid = False
-            flags.append("non_numeric_value")
-
-    # light unit normalization
-    if mt == "weight" and unit.lower() in {"lb", "lbs"} and value_numeric is not None:
-        value_numeric *= 0.453592
-        unit = "kg"
-    if mt == "height" and unit.lower() in {"in", "inch", "inches"} and value_numeric is not None:
-        value_numeric *= 2.54
-        unit = "cm"
+def insert_fact_sql(table: str = FACT_TABLE) -> str:
+    if table not in _insert_fact_sql:
+        _insert_fact_sql[table] = _INSERT_FACT.format(table=f'"{table}"')
+    return _insert_fact_sql[table]
 
-    return {
-        "study_id": (raw.get("study_id") or "").strip(),
-        "participant_id": (raw.get("participant_id") or "").strip(),
-        "site_id": (raw.get("site_id") or "").strip(),
-        "measurement_type": mt,
-        "unit": unit or "",
-        "value_numeric": value_numeric,
-        "systolic": systolic,
-        "diastolic": diastolic,
-        "quality_score": float(raw.get("quality_score") or 0),
-        "ts": parse_ts(raw.get("timestamp")),  # tz-aware datetime (or None)
-        "flags": flags,
-        "is_valid": is_valid,
-    }
+INSERT_FACT = insert_fact_sql(FACT_TABLE)
 
 @app.get("/health")
 async def health_check():
     return {"status": "healthy", "service": "etl"}
 
+@app.get("/cache/stats")
+async def cache_stats():
+    """Dimension cache sizes and hit/miss counters (for sizing ETL_DIM_CACHE_PARTICIPANTS), and the series cache."""
+    return {**dim_cache.stats(), "series": timeseries.series_cache.stats()}
+
+@app.get("/pool/stats")
+async def pool_stats():
+    """Shared connection pool size, saturation and acquire wait times."""
+    return db.pool_stats()
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def prometheus_metrics():
+    """Row counters and per-stage timing histograms in the Prometheus text format."""
+    return PlainTextResponse(metrics.render(db.pool_stats()), media_type="text/plain; version=0.0.4")
+
+@app.post("/rollups/rebuild")
+async def rebuild_rollups(req: RollupRebuildRequest):
+    """Recompute agg_measurement_daily for one study and/or one day from the facts."""
+    if req.studyId is None and req.day is None:
+        raise HTTPException(status_code=400, detail="studyId and/or day is required")
+    async with db.acquire() as conn:
+        rows = await rollups.rebuild(conn, req.studyId, req.day)
+    return {"studyId": req.studyId, "day": req.day, "rows": rows}
+
+@app.get("/scheduler/stats")
+async def scheduler_stats():
+    return {**scheduler.stats(), "jobStore": job_store.stats(), "workQueue": work_queue.stats()}
+
 @app.post("/jobs", response_model=ETLJobResponse)
 async def submit_job(job_request: ETLJobRequest, background_tasks: BackgroundTasks):
     job_id = job_request.jobId or str(uuid4())
     filename = job_request.filename
     study_id = job_request.studyId
+    load_mode = job_request.loadMode or LOAD_MODE
+    detached = bool(job_request.detached)
+    dedupe_mode = job_request.dedupe or dedupe.MODE
+    if detached:
+        # the load table has no unique index: its rows are plain inserts, and
+        # attaching rejects a load that repeats a key (partitions.finish_detached)
+        if job_request.dedupe:
+            raise HTTPException(status_code=400, detail="dedupe modes cannot be combined with detached loads")
+        dedupe_mode = "skip"
 
-    jobs[job_id] = {
+    job = {
         "jobId": job_id,
         "filename": filename,
         "studyId": study_id,
-        "status": "running",
+        "loadMode": load_mode,
+        "detached": detached,
+        "dedupe": dedupe_mode,
+        "status": "queued",
+        "progress": 0,
+        "message": "Job queued",
+        "createdAt": datetime.utcnow().isoformat(),
+        "updatedAt": datetime.utcnow().isoformat(),
+        "rowsProcessed": 0,
+        "rowsInserted": 0,
+        "rowsFailed": 0,
+    }
+    if workqueue.enabled():
+        # whichever replica has a free slot claims it
+        await work_queue.submit(job, "file", {
+            "filename": filename, "study_id": study_id, "load_mode": load_mode,
+            "shards": job_request.shards, "detached": detached, "dedupe_mode": dedupe_mode,
+        })
+        return ETLJobResponse(jobId=job_id, status="queued", message="Job submitted successfully")
+
+    job_store.create(job)
+    # the scheduler bounds how many jobs run at once; the rest wait as "queued"
+    background_tasks.add_task(
+        scheduler.run, process_file, job_id, filename, study_id, load_mode, job_request.shards, detached,
+        dedupe_mode,
+    )
+    return ETLJobResponse(jobId=job_id, status="queued", message="Job submitted successfully")
+
+@app.post("/batches", response_model=ETLJobResponse)
+async def submit_batch(req: BatchJobRequest, background_tasks: BackgroundTasks):
+    """One job for many files (bulk mode); see batches.py."""
+    if req.watch and not req.glob:
+        raise HTTPException(status_code=400, detail="watch needs a glob")
+    try:
+        files = batches.select_files(DATA_DIR, req.files, req.glob)
+    except batches.BatchError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if not files and not req.watch:
+        raise HTTPException(status_code=400, detail="no files to load")
+    job_id = req.jobId or str(uuid4())
+    dedupe_mode = req.dedupe or dedupe.MODE
+
+    job = {
+        "jobId": job_id,
+        "kind": "batch",
+        "filename": req.glob or f"{len(files)} files",
+        "studyId": req.studyId,
+        "loadMode": "bulk",
+        "dedupe": dedupe_mode,
+        "watch": req.watch,
+        "files": [batches.file_entry(f, os.path.getsize(os.path.join(DATA_DIR, f))) for f in files],
+        "status": "queued",
         "progress": 0,
-        "message": "Job started",
+        "message": "Job queued",
         "createdAt": datetime.utcnow().isoformat(),
         "updatedAt": datetime.utcnow().isoformat(),
+        "rowsProcessed": 0,
+        "rowsInserted": 0,
+        "rowsFailed": 0,
     }
+    if workqueue.enabled():
+        await work_queue.submit(job, "batch", {
+            "watch_glob": req.glob if req.watch else None, "study_id": req.studyId, "dedupe_mode": dedupe_mode,
+            "poll_seconds": req.pollSeconds, "idle_seconds": req.idleSeconds,
+        })
+        return ETLJobResponse(jobId=job_id, status="queued", message=f"Batch of {len(files)} files submitted")
 
-    background_tasks.add_task(process_file, job_id, filename, study_id)
-    return ETLJobResponse(jobId=job_id, status="running", message="Job submitted successfully")
+    job_store.create(job)
+    background_tasks.add_task(
+        scheduler.run, process_batch, job_id, req.glob if req.watch else None, req.studyId, dedupe_mode,
+        req.pollSeconds, req.idleSeconds,
+    )
+    return ETLJobResponse(jobId=job_id, status="queued", message=f"Batch of {len(files)} files submitted")
 
 @app.get("/jobs/{job_id}/status", response_model=ETLJobStatus)
 async def get_job_status(job_id: str):
-    job = jobs.get(job_id)
+    job = await job_store.get(job_id)
     if not job:
         raise HTTPException(status_code=404, detail="Job not found")
     return ETLJobStatus(
@@ -158,75 +264,691 @@ async def get_job_status(job_id: str):
 
 @app.get("/jobs/{job_id}")
 async def get_job_details(job_id: str):
-    job = jobs.get(job_id)
+    job = await job_store.get(job_id)
     if not job:
         raise HTTPException(status_code=404, detail="Job not found")
-    return job
+    # the summary is under "profile"; the raw sketches are only for merging
+    return {k: v for k, v in job.items() if k != "profileSketches"}
 
-async def process_file(job_id: str, filename: str, study_id: Optional[str]):
-    path = os.path.join(DATA_DIR, filename)
-    if not os.path.exists(path):
-        jobs[job_id].update(
-            status="failed",
-            message="file_not_found",
-            updatedAt=datetime.utcnow().isoformat(),
+@app.get("/studies/{study_id}/export")
+async def export_study(study_id: str, format: str = Query("ndjson"),
+                       after_participant: Optional[str] = Query(None, alias="afterParticipant"),
+                       after_ts: Optional[str] = Query(None, alias="afterTs"),
+                       after_type: Optional[str] = Query(None, alias="afterType")):
+    """Stream every fact row of a study as NDJSON or Arrow IPC, in keyset order (see export.py)."""
+    try:
+        export.check_format(format)
+        after = await export.parse_after(after_participant, after_ts, after_type)
+    except export.ExportError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return StreamingResponse(export.stream(study_id, format, after), media_type=export.FORMATS[format])
+
+@app.get("/studies/{study_id}/participants/{participant_id}/series")
+async def participant_series(study_id: str, participant_id: str, type: str = Query(...),
+                             start: Optional[str] = Query(None, alias="from"),
+                             end: Optional[str] = Query(None, alias="to"),
+                             points: int = Query(timeseries.DEFAULT_POINTS), method: str = Query("lttb")):
+    """One participant's readings of a type, downsampled to `points` per series (see timeseries.py)."""
+    try:
+        type_id, start_ts, end_ts = await timeseries.parse_request(type, start, end, points, method)
+    except timeseries.SeriesError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    body, hit = await timeseries.series(study_id, participant_id, type, type_id, start_ts, end_ts, points, method)
+    return Response(body, media_type="application/json", headers={"X-Cache": "hit" if hit else "miss"})
+
+@app.post("/studies/{study_id}/snapshot")
+async def compact_study_snapshot(study_id: str):
+    """Compact a study's Parquet snapshot now: one file per month, one row per natural key (see snapshots.py)."""
+    if not snapshots.enabled():
+        raise HTTPException(status_code=409, detail="snapshots are off (set ETL_SNAPSHOT_DIR; needs pyarrow)")
+    months = await asyncio.to_thread(snapshots.compact_study, study_id)
+    if not months:
+        raise HTTPException(status_code=404, detail="No snapshot for this study")
+    return {"studyId": study_id, "months": months}
+
+@app.get("/studies/{study_id}/profile")
+async def get_study_profile(study_id: str):
+    """Profile of everything loaded for a study, merged from the sketches of its jobs (see profiling.py)."""
+    async with db.acquire() as conn:
+        profile = await profiling.study_profile(conn, study_id)
+    if profile is None:
+        raise HTTPException(status_code=404, detail="No profiled jobs for this study")
+    return profile
+
+@app.get("/jobs/{job_id}/rejects")
+async def get_job_rejects(job_id: str, after: int = Query(0, ge=0), limit: int = Query(100, ge=1, le=1000)):
+    """Page through a job's quarantined rows in load order; pass `next` back as `after`."""
+    if not await job_store.get(job_id):
+        raise HTTPException(status_code=404, detail="Job not found")
+    async with db.acquire() as conn:
+        rows = await conn.fetch(quarantine.SELECT_PAGE, job_id, after, limit)
+    return {
+        "jobId": job_id,
+        "rejects": [
+            {"id": r["id"], "rowNumber": r["row_number"], "raw": r["raw"], "kind": r["kind"],
+             "reason": r["reason"], "flags": list(r["flags"]), "createdAt": r["created_at"].isoformat()}
+            for r in rows
+        ],
+        "next": rows[-1]["id"] if len(rows) == limit else None,
+    }
+
+def fact_args(rec: Dict[str, Any], mt_id: int, unit_id: int, filename: str) -> Tuple:
+    return (
+        rec["study_id"], rec["participant_id"], rec["site_id"],
+        mt_id, unit_id,
+        rec["value_numeric"], rec["systolic"], rec["diastolic"],
+        rec["quality_score"], rec["ts"], rec.get("source_file") or filename, rec["is_valid"],
+        rec["flags"] if rec["flags"] else [],
+    )
+
+async def insert_rows(conn: asyncpg.Connection, recs: List[Dict[str, Any]], filename: str,
+                      before_commit=None, table: str = FACT_TABLE,
+                      rejects: Optional[ChunkRejects] = None, replay: bool = False,
+                      unwritten: Optional[Set[int]] = None) -> Tuple[int, int]:
+    """
+    Row path for one chunk. Rows that can never be inserted (and, unless
+    ETL_QUARANTINE_INVALID=0, invalid rows) go to `rejects` first (see
+    quarantine.py). Dimension keys and the partitions of `table` the rows
+    need are created next (cache hits cost nothing, misses run in
+    autocommit); the facts are then upserted on their natural key (see
+    dedupe.py; a detached load table takes one executemany) in a single
+    transaction that also writes the rejects and runs before_commit (the job
+    checkpoint). If that transaction fails it is replayed in sub-batches
+    (see _write_chunk), so only the rows that really fail are rejected;
+    replay=True goes straight there. Positions in recs of rows that were
+    not written (in-chunk duplicates, keys already loaded) go to unwritten.
+    Returns (inserted, failed).
+    """
+    rejects = (rejects if rejects is not None else ChunkRejects()).tracking()
+    args, pos, failed = await _resolve(conn, recs, filename, table, rejects)
+    before_commit = rejects.committing(before_commit)
+    mode = dedupe.effective(dedupe.current(), table == FACT_TABLE)
+    unwritten = unwritten if unwritten is not None else set()
+    if mode is None:
+        sql = insert_fact_sql(table)
+
+        async def write(part):
+            # a detached load table, rolled up when its months are moved (partitions.finish_detached)
+            await conn.executemany(sql, part)
+            return len(part)
+
+        results, errors = await _write_chunk(conn, args, write, before_commit, rejects.subset(pos), replay)
+        inserted = sum(results)
+    else:
+        args, kept = dedupe.unique_args(args, mode)
+        skipped = len(pos) - len(kept)
+        if skipped:
+            unwritten.update(set(pos).difference(pos[i] for i in kept))
+        pos = [pos[i] for i in kept]
+
+        async def write(part):
+            # rows carry their position in recs, so the upsert can report those it did not write
+            conflicts: Set[int] = set()
+            return await dedupe.upsert_rows(conn, part, table, mode, conflicts), conflicts
+
+        results, errors = await _write_chunk(
+            conn, [a + (p,) for a, p in zip(args, pos)], write, before_commit, rejects.subset(pos), replay,
         )
-        return
+        for _, conflicts in results:
+            unwritten.update(conflicts)
+        counts = [r[0] for r in results]
+        metrics.count_rows(updated=sum(c[1] for c in counts), skipped=skipped + sum(c[2] for c in counts))
+        inserted = sum(c[0] for c in counts)
+    if not replay:  # a replayed bulk chunk is recorded by load_chunk
+        await _committed(_record_columns(recs), rejects.rejected | unwritten, filename)
+    return inserted, failed + errors
 
-    jobs[job_id].update(status="running", message="starting", progress=0, updatedAt=datetime.utcnow().isoformat())
-    print(f"[ETL] start job_id={job_id} file={filename} study={study_id}", flush=True)
+async def _committed(cols: Dict[str, list], rejected, filename: str):
+    """
+    A chunk committed: profile and snapshot the rows it wrote (all but
+    `rejected`, which also holds the rows the upsert left alone) and drop
+    their participants' cached series.
+    """
+    profiling.observe(cols, rejected)
+    timeseries.loaded(cols, rejected)
+    await snapshots.add(cols, rejected, filename)
 
-    try:
-        total = max(0, sum(1 for _ in open(path)) - 1)
-    except Exception:
-        total = 0
-    processed = 0
+def _record_columns(recs: List[Dict[str, Any]]) -> Dict[str, list]:
+    # source_file is left out: row-mode records carry the job's filename instead
+    return {c: [r[c] for r in recs] for c in RECORD_FIELDS if c != "source_file"}
 
-    pool = await get_pool()
-    try:
-        with open(path, newline="") as f:
-            reader = csv.DictReader(f)
-            async with pool.acquire() as conn:
-                for row in reader:
-                    rec = parse_row(row)
-                    if study_id:
-                        rec["study_id"] = study_id
+async def _resolve(conn: asyncpg.Connection, recs: List[Dict[str, Any]], filename: str, table: str,
+                   rejects: ChunkRejects) -> Tuple[List[Tuple], List[int], int]:
+    """
+    fact_args for the rows that pass quarantine.precheck and whose dimension
+    keys resolve, with the partitions they need; the others are rejected.
+    Returns (args, positions of args in recs, rejected).
+    """
+    checked = quarantine.precheck([r["ts"] for r in recs], [r["quality_score"] for r in recs],
+                                  [r["is_valid"] for r in recs], [r["flags"] for r in recs])
+    for p, (kind, reason) in checked.items():
+        rejects.add(p, reason, kind, recs[p]["flags"])
+    failed = len(checked)
+    args, pos = [], []
+    with metrics.timed("dimensions"):
+        for p, rec in enumerate(recs):
+            if p in checked:
+                continue
+            try:
+                mt_id, unit_id = await dim_cache.resolve(conn, rec)
+            except Exception as e:
+                failed += 1
+                rejects.add(p, str(e))
+                continue
+            args.append(fact_args(rec, mt_id, unit_id, filename))
+            pos.append(p)
+        await partition_manager.ensure(conn, table, [a[9] for a in args], {a[0] for a in args})
+    return args, pos, failed
 
+async def _write_chunk(conn: asyncpg.Connection, args: List[Tuple], write, before_commit,
+                       rejects: ChunkRejects, replay: bool = False) -> Tuple[list, int]:
+    """
+    Run write(args) and then before_commit in one transaction. If that fails
+    (or with replay=True), write again in sub-batches of REPLAY_BATCH rows,
+    each under its own savepoint, and retry only a sub-batch that fails row
+    by row; rows that still fail go to `rejects` (by position in args).
+    Returns (results of the write() calls that committed, rows rejected).
+    """
+    if not replay:
+        try:
+            with metrics.timed("insert"):
+                async with conn.transaction():
+                    results = [await write(args)] if args else []
+                    await before_commit(conn)
+            return results, 0
+        except CheckpointLost:
+            raise
+        except Exception:
+            pass
+    results, failed = [], 0
+    with metrics.timed("insert"):
+        async with conn.transaction():
+            for lo in range(0, len(args), REPLAY_BATCH):
+                part = args[lo:lo + REPLAY_BATCH]
+                try:
+                    async with conn.transaction():
+                        results.append(await write(part))
+                    continue
+                except Exception:
+                    pass
+                for k, a in enumerate(part):
                     try:
                         async with conn.transaction():
-                            await conn.execute(UPSERT_STUDY, rec["study_id"])
-                            await conn.execute(UPSERT_PARTICIPANT, rec["study_id"], rec["participant_id"])
-                            await conn.execute(UPSERT_SITE, rec["site_id"])
-                            await conn.execute(UPSERT_MEAS_TYPE, rec["measurement_type"])
-                            await conn.execute(UPSERT_UNIT, rec["unit"])
-
-                            # (Optional) debug:
-                            # print(f"TS TYPE={type(rec['ts'])} VAL={rec['ts']}", flush=True)
-
-                            await conn.execute(
-                                INSERT_FACT,
-                                rec["study_id"], rec["participant_id"], rec["site_id"],
-                                rec["measurement_type"], rec["unit"],
-                                rec["value_numeric"], rec["systolic"], rec["diastolic"],
-                                rec["quality_score"], rec["ts"], filename, rec["is_valid"],
-                                rec["flags"] if rec["flags"] else [],
-                            )
+                            results.append(await write([a]))
                     except Exception as e:
-                        print(f"[ETL] row error: {e}", flush=True)
-
-                    processed += 1
-                    if total and (processed % 100 == 0 or processed == total):
-                        pct = int(processed * 100 / total)
-                        jobs[job_id].update(
-                            progress=pct,
-                            message=f"processed {processed}/{total}",
-                            updatedAt=datetime.utcnow().isoformat(),
-                        )
-
-        jobs[job_id].update(status="completed", progress=100, message="done", updatedAt=datetime.utcnow().isoformat())
-        print(f"[ETL] done job_id={job_id} processed={processed} total={total}", flush=True)
+                        failed += 1
+                        rejects.add(lo + k, str(e))
+            await before_commit(conn)
+    return results, failed
+
+async def load_chunk(conn: asyncpg.Connection, batch: Dict[str, list], filename: str,
+                     before_commit=None, table: str = FACT_TABLE,
+                     rejects: Optional[ChunkRejects] = None) -> Tuple[int, int]:
+    """
+    Bulk path for one parsed column batch. Rows that can never be inserted
+    (see quarantine.precheck) go to `rejects` without a database round trip;
+    the rest are COPYed in one transaction that also writes the rejects and
+    runs before_commit. If that transaction fails as a whole, the rows are
+    replayed through insert_rows in sub-batches, so only the bad ones are
+    rejected and the rest of the chunk still loads set-based.
+    Returns (inserted, failed).
+    """
+    rejects = (rejects if rejects is not None else ChunkRejects()).tracking()
+    checked = quarantine.precheck(batch["ts"], batch["quality_score"], batch["is_valid"], batch["flags"])
+    for p, (kind, reason) in checked.items():
+        rejects.add(p, reason, kind, batch["flags"][p])
+    good = batch
+    keep = range(len(batch["ts"]))
+    if checked:
+        keep = [i for i in keep if i not in checked]
+        good = batchparse.take(batch, keep)
+    unwritten: Set[int] = set()  # positions in good
+    try:
+        with metrics.timed("dimensions"):
+            await partition_manager.ensure(conn, table, good["ts"], good["study_id"])
+        inserted = await loader.copy_chunk(conn, good, filename, cache=dim_cache,
+                                           before_commit=rejects.committing(before_commit), table=table,
+                                           unwritten=unwritten)
+        await _committed(batch, rejects.rejected | {keep[p] for p in unwritten}, filename)
+        return inserted, len(checked)
+    except CheckpointLost:
+        raise
     except Exception as e:
-        jobs[job_id].update(status="failed", message=str(e), updatedAt=datetime.utcnow().isoformat())
-        print(f"[ETL] failed job_id={job_id}: {e}", flush=True)
+        print(f"[ETL] chunk error, replaying in batches of {REPLAY_BATCH}: {e}", flush=True)
+    ok, failed = await insert_rows(conn, batchparse.to_records(good), filename, before_commit, table,
+                                   rejects.subset(keep), replay=True, unwritten=unwritten)
+    await _committed(batch, rejects.rejected | {keep[p] for p in unwritten}, filename)
+    return ok, len(checked) + failed
+
+def shard_count(path: str, load_mode: str, requested: Optional[int]) -> int:
+    """Shards to use for a file: 1 unless bulk mode and the file is large (or shards were requested)."""
+    if load_mode != "bulk" or compression_of(path) or columnar_format(path):
+        return 1  # byte ranges need a plain, seekable CSV
+    if requested:
+        return max(1, requested)
+    if os.path.getsize(path) < SHARD_MIN_BYTES:
+        return 1
+    # one shard per core, but never more than the pool can serve concurrently
+    auto = SHARDS or os.cpu_count() or 1
+    return max(1, min(auto, db.pool_config()["max_size"]))
+
+async def begin_checkpoint(job_id: str, path: str, filename: str, study_id: Optional[str], load_mode: str,
+                           detached: bool = False) -> Checkpoint:
+    """Claim this file's load (under the job's options and dedupe mode) for job_id; see checkpoint.py."""
+    # hashing reads 3 MiB of the file (all of it with ETL_HASH_MODE=full); keep it off the event loop
+    content_hash = await asyncio.to_thread(checkpoint.content_hash, path)
+    key = checkpoint.load_key(content_hash, studyId=study_id, loadMode=load_mode, detached=detached,
+                              dedupe=dedupe.current())
+    async with db.acquire() as conn:
+        cp = await checkpoint.begin(conn, key, filename, os.path.getsize(path), job_id)
+    cp.guard = workqueue.guard()  # None unless the job came from the work queue
+    return cp
+
+async def process_file(job_id: str, filename: str, study_id: Optional[str], load_mode: str = "row",
+                       shards: Optional[int] = None, detached: bool = False, dedupe_mode: str = "skip"):
+    path = os.path.join(DATA_DIR, filename)
+    if not os.path.exists(path):
+        job_store.update(job_id, status="failed", message="file_not_found")
+        return
+
+    if columnar_format(path):
+        load_mode = "bulk"  # record batches go straight to the columnar parse
+    job_store.update(job_id, status="running", message="starting", progress=0, loadMode=load_mode)
+    print(f"[ETL] start job_id={job_id} file={filename} study={study_id} mode={load_mode}", flush=True)
+
+    with timeseries.job_scope(), metrics.job_scope(job_id) as job_metrics, dedupe.job_mode(dedupe_mode), \
+            profiling.job_scope() as profile, snapshots.job_scope(job_id) as snapshot:
+        try:
+            cp = await begin_checkpoint(job_id, path, filename, study_id, load_mode, detached)
+            job_store.update(job_id, contentHash=cp.content_hash)
+            if cp.completed:
+                job_store.update(job_id, status="completed", progress=100, skipped=True,
+                                 message=f"skipped: content already loaded by job {cp.completed_by}")
+                print(f"[ETL] skip job_id={job_id}: {cp.content_hash} already loaded", flush=True)
+                return
+            if cp.resumed:
+                job_store.update(job_id, resumedFromRow=cp.rows)
+                print(f"[ETL] resume job_id={job_id} after row {cp.rows}", flush=True)
+
+            table = FACT_TABLE
+            if detached:
+                # historical load: fill an index-free copy, attach its partitions at the end
+                table = load_table_name(cp.content_hash)
+                async with db.acquire() as conn:
+                    await partition_manager.create_load_table(conn, table)
+
+            # a resumed load keeps the strategy its checkpoint was written with
+            if cp.shards:
+                n_shards = cp.shards
+            elif cp.rows:
+                n_shards = 1
+            else:
+                n_shards = shard_count(path, load_mode, shards)
+            if n_shards > 1:
+                processed = await process_sharded(job_id, path, filename, study_id, n_shards, cp, table)
+            else:
+                processed = await process_stream(job_id, path, filename, study_id, load_mode, cp, table)
+
+            async with db.acquire() as conn:
+                if detached:
+                    job_store.update(job_id, message="attaching partitions")
+                    try:
+                        attached = await partition_manager.finish_detached(conn, table)
+                    except LoadOverlap:
+                        await cp.discard(conn)  # the load table is gone; a resubmitted file starts over
+                        raise
+                    job_store.update(job_id, attachedPartitions=attached)
+                await cp.complete(conn)
+            job_store.update(job_id, status="completed", progress=100, message="done")
+            print(f"[ETL] done job_id={job_id} processed={processed}", flush=True)
+        except workqueue.LeaseLost:
+            raise  # the job carries on elsewhere; its status is not ours to write
+        except Exception as e:
+            job_store.update(job_id, status="failed", message=str(e))
+            print(f"[ETL] failed job_id={job_id}: {e}", flush=True)
+        finally:
+            # a failed detached load attached nothing, so its rows are not in fact_measurement
+            attached_nothing = detached and jobs[job_id]["status"] == "failed"
+            published = await snapshots.finish(snapshot, not attached_nothing)
+            job_store.update(job_id, metrics=job_metrics.snapshot(), **_dedupe_counts(job_metrics),
+                             **({} if attached_nothing else _profile_fields(profile)), **published)
+
+async def process_batch(job_id: str, watch_glob: Optional[str], study_id: Optional[str],
+                        dedupe_mode: str = "skip", poll_seconds: float = 5.0, idle_seconds: float = 60.0):
+    """
+    Load every file of a batch job on one connection, coalescing their parsed
+    rows into CHUNK_SIZE-row load chunks (see batches.py). A file that cannot
+    be read or parsed is marked failed and the batch goes on; a failing load
+    fails the batch. With watch_glob, new matching files are loaded as they
+    arrive until idle_seconds pass without one.
+    """
+    entries: List[Dict[str, Any]] = jobs[job_id]["files"]
+    job_store.update(job_id, status="running", message="starting", progress=0)
+    print(f"[ETL] start batch job_id={job_id} files={len(entries)} study={study_id}", flush=True)
+    coalescer = batches.Coalescer()
+    hashes: Dict[str, str] = {}  # content hash -> first file with it in this batch
+
+    def report(current: Optional[Dict[str, Any]] = None, stream=None):
+        if current is not None and stream is not None:
+            current["progress"] = stream.progress()
+        done = sum(e["bytes"] for e in entries if e["status"] in ("completed", "skipped", "failed"))
+        reading = stream.bytes_read if stream is not None else 0
+        total = sum(e["bytes"] for e in entries) or 1
+        job_metrics = metrics.current()
+        job_store.update(
+            job_id,
+            files=entries,
+            filesDone=sum(e["status"] != "queued" and e["status"] != "loading" for e in entries),
+            progress=min(100, int((done + reading) * 100 / total)),
+            message=f"loading {current['filename']}" if current else f"{len(entries)} files",
+            **({"metrics": job_metrics.snapshot(), **_dedupe_counts(job_metrics)} if job_metrics else {}),
+        )
+
+    async def flush(conn):
+        if not coalescer.parts:
+            return
+        batch, segments, rejects = coalescer.take()
+        inserted, failed = await load_chunk(conn, batch, "", batches.commit_hook(segments), FACT_TABLE, rejects)
+        n = len(batch["study_id"])
+        job_store.incr(job_id, rowsProcessed=n, rowsInserted=inserted, rowsFailed=failed)
+        metrics.count_rows(read=n, parsed=n, inserted=inserted, rejected=failed)
+        for seg in segments:
+            seg.entry["rowsProcessed"] += seg.rows
+            seg.entry["rowsFailed"] += len(seg.rejects)
+            if seg.last:
+                seg.entry["status"], seg.entry["progress"] = "completed", 100
+
+    async def load_file(conn, entry: Dict[str, Any]):
+        name = entry["filename"]
+        path = os.path.join(DATA_DIR, name)
+        try:
+            cp = await begin_checkpoint(job_id, path, name, study_id, "bulk")
+        except OSError as e:  # removed since it was listed
+            entry.update(status="failed", error=str(e))
+            return
+        if cp.completed or cp.content_hash in hashes:
+            entry.update(status="skipped", progress=100,
+                         skippedBecause=f"already loaded by job {cp.completed_by}" if cp.completed
+                         else f"same content as {hashes[cp.content_hash]}")
+            return
+        hashes[cp.content_hash] = name
+        entry["status"] = "loading"
+        committed = cp.rows
+        reading = _batch_chunks(path, name, study_id, cp.rows)
+        try:
+            while True:
+                try:
+                    item = await asyncio.to_thread(next, reading, None)
+                except Exception as e:
+                    # rows of this file already committed stay loaded; its checkpoint resumes after them
+                    coalescer.drop_file(entry)
+                    entry.update(status="failed", error=str(e))
+                    print(f"[ETL] batch job_id={job_id}: {name} failed: {e}", flush=True)
+                    return
+                if item is None:
+                    break
+                n, parsed, raw, stream = item
+                rejects = ChunkRejects(job_id, name, raw, committed + 1)
+                committed += n
+                coalescer.add(parsed, batches.Segment(entry, cp, n, committed, rejects))
+                if coalescer.rows >= CHUNK_SIZE:
+                    await flush(conn)
+                report(entry, stream)
+        finally:
+            reading.close()
+        if not coalescer.finish_file(entry):
+            await cp.complete(conn)  # nothing left to load
+            entry.update(status="completed", progress=100)
+
+    with timeseries.job_scope(), metrics.job_scope(job_id) as job_metrics, dedupe.job_mode(dedupe_mode), \
+            profiling.job_scope() as profile, snapshots.job_scope(job_id) as snapshot:
+        try:
+            async with db.acquire() as conn:
+                if not dim_cache.warmed:
+                    await dim_cache.warm(conn)
+                for entry in list(entries):
+                    if entry["status"] in ("completed", "skipped", "failed"):
+                        continue  # settled on an earlier claim of this job
+                    await load_file(conn, entry)
+                    report()
+                if watch_glob:
+                    watcher = batches.Watcher(DATA_DIR, watch_glob, [e["filename"] for e in entries])
+                    idle = 0.0
+                    while idle < idle_seconds:
+                        await flush(conn)  # rows are not held back while waiting for files
+                        job_store.update(job_id, message=f"watching {watch_glob}")
+                        await asyncio.sleep(poll_seconds)
+                        new = await asyncio.to_thread(watcher.poll)
+                        idle = idle + poll_seconds if not new else 0.0
+                        for name in new:
+                            entry = batches.file_entry(name, os.path.getsize(os.path.join(DATA_DIR, name)))
+                            entries.append(entry)
+                            await load_file(conn, entry)
+                            report()
+                await flush(conn)
+            report()
+            failed = [e["filename"] for e in entries if e["status"] == "failed"]
+            job_store.update(job_id, status="completed", progress=100,
+                             message=f"done; {len(failed)} files failed" if failed else "done")
+            print(f"[ETL] done batch job_id={job_id} files={len(entries)} failed={len(failed)}", flush=True)
+        except workqueue.LeaseLost:
+            raise
+        except Exception as e:
+            job_store.update(job_id, status="failed", message=str(e))
+            print(f"[ETL] failed batch job_id={job_id}: {e}", flush=True)
+        finally:
+            job_store.update(job_id, metrics=job_metrics.snapshot(), **_dedupe_counts(job_metrics),
+                             **_profile_fields(profile), **await snapshots.finish(snapshot))
+
+def _batch_chunks(path: str, name: str, study_id: Optional[str], skip_rows: int):
+    """(rows, parsed batch, raw row accessor, stream) per chunk of one batch file; advanced in a worker thread."""
+    with open_input(path) as stream:
+        for n, chunk in metrics.timed_iter("read", stream.chunks(CHUNK_SIZE, "bulk", skip_rows=skip_rows)):
+            parsed = _parse(chunk, study_id, "bulk")
+            parsed["source_file"] = [name] * n
+            yield n, parsed, quarantine.raw_rows(chunk), stream
+
+async def process_stream(job_id: str, path: str, filename: str, study_id: Optional[str], load_mode: str,
+                         cp: Checkpoint, table: str = FACT_TABLE) -> int:
+    """Load one file in a single pass, checkpointing every chunk; returns rows processed by this job."""
+    chunk_size = CHUNK_SIZE if load_mode == "bulk" else 100
+    # this file's own timestamp layout detection; never shared with another job's stream
+    ts_parser = TimestampParser() if load_mode == "row" else None
+    # one pass over the file; progress comes from bytes consumed
+    with open_input(path) as stream:
+        async with db.acquire() as conn:
+            if not dim_cache.warmed:
+                await dim_cache.warm(conn)
+            chunks = stream.chunks(chunk_size, load_mode, skip_rows=cp.rows)
+            if PIPELINE_DEPTH > 0:
+                return await _pipelined(job_id, stream, chunks, conn, filename, study_id, load_mode, cp, table,
+                                        ts_parser)
+            processed = 0
+            committed = cp.rows
+            for n, chunk in metrics.timed_iter("read", chunks):
+                rejects = ChunkRejects(job_id, filename, quarantine.raw_rows(chunk), committed + 1)
+                committed += n
+                inserted, failed = await _flush(conn, chunk, filename, study_id, load_mode,
+                                                cp.mark_rows(committed), table, rejects, ts_parser)
+                processed += n
+                _chunk_done(job_id, n, inserted, failed, processed, stream)
+    return processed
+
+async def _pipelined(job_id: str, stream: CSVStream, chunks, conn: asyncpg.Connection, filename: str,
+                     study_id: Optional[str], load_mode: str, cp: Checkpoint, table: str,
+                     ts_parser: Optional[TimestampParser] = None) -> int:
+    """
+    process_stream with reading, parsing and writing overlapped: a reader
+    and a parser task feed the writer (this task) through queues holding at
+    most PIPELINE_DEPTH chunks each, so memory stays bounded and a slow
+    database stalls the reader instead of buffering the file. Reading and
+    parsing run in worker threads, keeping the event loop free for other
+    requests. Chunks are written (and checkpointed) in file order.
+    A failure in any stage is passed down the queues and raised here.
+    """
+    raw_q: asyncio.Queue = asyncio.Queue(PIPELINE_DEPTH)
+    parsed_q: asyncio.Queue = asyncio.Queue(PIPELINE_DEPTH)
+
+    async def read_stage():
+        try:
+            while True:
+                with metrics.timed("read"):
+                    item = await asyncio.to_thread(next, chunks, None)
+                await raw_q.put(item)
+                if item is None:
+                    return
+        except Exception as e:
+            await raw_q.put(e)
+
+    async def parse_stage():
+        while True:
+            item = await raw_q.get()
+            if item is None or isinstance(item, Exception):
+                await parsed_q.put(item)
+                return
+            n, chunk = item
+            try:
+                parsed = await asyncio.to_thread(_parse, chunk, study_id, load_mode, ts_parser)
+            except Exception as e:
+                await parsed_q.put(e)
+                return
+            await parsed_q.put((n, parsed, quarantine.raw_rows(chunk)))
+
+    stages = [asyncio.create_task(read_stage()), asyncio.create_task(parse_stage())]
+    processed = 0
+    committed = cp.rows
+    try:
+        while (item := await parsed_q.get()) is not None:
+            if isinstance(item, Exception):
+                raise item
+            n, parsed, raw = item
+            rejects = ChunkRejects(job_id, filename, raw, committed + 1)
+            committed += n
+            inserted, failed = await _load(conn, parsed, filename, load_mode, cp.mark_rows(committed), table,
+                                           rejects)
+            processed += n
+            _chunk_done(job_id, n, inserted, failed, processed, stream)
     finally:
-        await pool.close()
+        for t in stages:
+            t.cancel()
+        await asyncio.gather(*stages, return_exceptions=True)
+    return processed
+
+async def process_sharded(job_id: str, path: str, filename: str, study_id: Optional[str], n_shards: int,
+                          cp: Checkpoint, table: str = FACT_TABLE) -> int:
+    """
+    Bulk-load one file as n_shards byte ranges. Each shard parses its pieces in
+    the process pool (the next piece is parsed while the current one loads)
+    and loads them over its own pooled connection; per-shard progress is
+    rolled up into jobs[job_id]["progress"]. Pieces the checkpoint already
+    has are skipped. Returns rows processed by this job.
+    """
+    piece_bytes = cp.piece_bytes or SHARD_PIECE_BYTES
+    header, plan = sharding.plan_shards(path, n_shards, piece_bytes)
+    if cp.shards is None:
+        async with db.acquire() as conn:
+            await cp.set_plan(conn, n_shards, piece_bytes)
+    total_bytes = sum(e - s for pieces in plan for s, e in pieces) or 1
+    shard_info = [
+        {"shard": i, "bytes": sum(e - s for s, e in pieces), "bytesDone": 0, "rows": 0}
+        for i, pieces in enumerate(plan)
+    ]
+    for info, pieces in zip(shard_info, plan):
+        info["bytesDone"] = sum(e - s for s, e in pieces if s in cp.pieces_done)
+    job_store.update(job_id, shards=shard_info)
+    loop = asyncio.get_running_loop()
+    executor = sharding.get_executor()
+    job_metrics = metrics.current()
+
+    async def run_shard(info: Dict[str, Any], pieces):
+        pieces = [p for p in pieces if p[0] not in cp.pieces_done]
+        if not pieces:
+            return
+        async with db.acquire() as conn:
+            if not dim_cache.warmed:
+                await dim_cache.warm(conn)
+            parse = lambda p: loop.run_in_executor(executor, sharding.parse_range, path, p[0], p[1], header)
+            nxt = parse(pieces[0])
+            for k, (start, end) in enumerate(pieces):
+                with metrics.timed("parse"):  # time spent waiting on the process pool
+                    batch = await nxt
+                if k + 1 < len(pieces):
+                    nxt = parse(pieces[k + 1])
+                n = len(batch["study_id"])
+                if study_id:
+                    batch["study_id"] = [study_id] * n
+                # sharded pieces have no row numbers; rejects keep the piece's raw rows
+                rejects = ChunkRejects(job_id, filename, quarantine.raw_piece(path, start, end))
+                inserted, failed = await load_chunk(conn, batch, filename, cp.mark_piece(start, n), table, rejects)
+                job_store.incr(job_id, rowsProcessed=n, rowsInserted=inserted, rowsFailed=failed)
+                metrics.count_rows(read=n, parsed=n, inserted=inserted, rejected=failed)
+                info["bytesDone"] += end - start
+                info["rows"] += n
+                done = sum(i["bytesDone"] for i in shard_info)
+                rows = sum(i["rows"] for i in shard_info)
+                job_store.update(
+                    job_id,
+                    progress=min(100, int(done * 100 / total_bytes)),
+                    message=f"processed {rows} rows ({len(shard_info)} shards)",
+                    **({"metrics": job_metrics.snapshot(), **_dedupe_counts(job_metrics)} if job_metrics else {}),
+                )
+
+    await asyncio.gather(*(run_shard(info, pieces) for info, pieces in zip(shard_info, plan)))
+    return sum(i["rows"] for i in shard_info)
+
+def _parse(chunk, study_id: Optional[str], load_mode: str, ts_parser: Optional[TimestampParser] = None):
+    """
+    Parse one chunk (a column batch in bulk mode, records in row mode); CPU
+    only, safe in a thread. Row mode parses timestamps with ts_parser, the
+    stream's own, which only that stream's parse stage uses.
+    """
+    if load_mode == "bulk":
+        # columnar parse; results are identical to parse_row
+        with metrics.timed("parse"):
+            batch = batchparse.parse_batch(chunk)
+        if study_id:
+            batch["study_id"] = [study_id] * len(batch["study_id"])
+        return batch
+    with metrics.timed("parse"):
+        recs = [parse_row(r, ts_parser) for r in chunk]
+    if study_id:
+        for rec in recs:
+            rec.study_id = study_id
+    return recs
+
+async def _load(conn: asyncpg.Connection, parsed, filename: str, load_mode: str,
+                before_commit=None, table: str = FACT_TABLE,
+                rejects: Optional[ChunkRejects] = None) -> Tuple[int, int]:
+    if load_mode == "bulk":
+        return await load_chunk(conn, parsed, filename, before_commit, table, rejects)
+    return await insert_rows(conn, parsed, filename, before_commit, table, rejects)
+
+async def _flush(conn: asyncpg.Connection, chunk, filename: str, study_id: Optional[str],
+                 load_mode: str, before_commit=None, table: str = FACT_TABLE,
+                 rejects: Optional[ChunkRejects] = None,
+                 ts_parser: Optional[TimestampParser] = None) -> Tuple[int, int]:
+    return await _load(conn, _parse(chunk, study_id, load_mode, ts_parser), filename, load_mode, before_commit, table, rejects)
+
+def _chunk_done(job_id: str, n: int, inserted: int, failed: int, processed: int, stream: CSVStream):
+    job_store.incr(job_id, rowsProcessed=n, rowsInserted=inserted, rowsFailed=failed)
+    metrics.count_rows(read=n, parsed=n, inserted=inserted, rejected=failed)
+    _report_progress(job_id, processed, stream)
+
+def _report_progress(job_id: str, processed: int, stream: CSVStream):
+    job_metrics = metrics.current()
+    job_store.update(
+        job_id,
+        progress=stream.progress(),
+        message=f"processed {processed} rows ({stream.bytes_read}/{stream.size} bytes)",
+        **({"metrics": job_metrics.snapshot(), **_dedupe_counts(job_metrics)} if job_metrics else {}),
+    )
+
+def _profile_fields(profile: Optional[profiling.Profile]) -> Dict[str, Any]:
+    """profile (the summary) and profileSketches (for merging, see GET /studies/{id}/profile) for the job record."""
+    if profile is None or not profile.studies:
+        return {}
+    return {"profile": profile.summary(), "profileSketches": profile.to_dict()}
+
+def _dedupe_counts(job_metrics: metrics.StageMetrics) -> Dict[str, int]:
+    """rowsUpdated / rowsSkipped for the job record."""
+    return {"rowsUpdated": job_metrics.rows["updated"], "rowsSkipped": job_metrics.rows["skipped"]}
@@ -0,0 +1,181 @@
+# etl-service/src/metrics.py
+"""
+Stage timings and row counters for the load path.
+
+Every measurement goes to the service-wide totals and, when a job is
+running in the current task, to that job's StageMetrics (found through a
+context variable, so shard tasks started by a job report to it too).
+Timings are taken once per chunk or statement, never per row, so the cost
+is a couple of perf_counter() calls per chunk. render() produces the
+Prometheus text format served on /metrics.
+"""
+import bisect
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+
+STAGES = ("read", "parse", "dimensions", "insert", "rollup", "profile", "pool_wait")
+ROW_KINDS = ("read", "parsed", "rejected", "inserted", "updated", "skipped", "bad_timestamp")
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)  # last slot is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self) -> List[int]:
+        out, total = [], 0
+        for c in self.counts:
+            total += c
+            out.append(total)
+        return out
+
+
+class StageMetrics:
+    def __init__(self):
+        self.stages: Dict[str, Histogram] = {s: Histogram() for s in STAGES}
+        self.rows: Dict[str, int] = {k: 0 for k in ROW_KINDS}
+
+    def snapshot(self) -> Dict[str, Any]:
+        """JSON-friendly view for GET /jobs/{job_id}."""
+        return {
+            "rows": dict(self.rows),
+            "stages": {
+                s: {"seconds": round(h.sum, 6), "calls": h.count, "buckets": h.cumulative()}
+                for s, h in self.stages.items()
+            },
+            "bucketBounds": list(BUCKETS) + ["+Inf"],
+        }
+
+
+service = StageMetrics()
+jobs: Dict[str, StageMetrics] = {}  # running jobs only
+_current: ContextVar[Optional[StageMetrics]] = ContextVar("etl_job_metrics", default=None)
+
+
+def observe(stage: str, seconds: float):
+    service.stages[stage].observe(seconds)
+    job = _current.get()
+    if job is not None:
+        job.stages[stage].observe(seconds)
+
+
+@contextmanager
+def timed(stage: str):
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(stage, time.perf_counter() - t0)
+
+
+def timed_iter(stage: str, items: Iterable) -> Iterator:
+    """Yield from items, timing each next() (e.g. reading the next chunk of a file)."""
+    it = iter(items)
+    while True:
+        t0 = time.perf_counter()
+        try:
+            item = next(it)
+        except StopIteration:
+            return
+        finally:
+            observe(stage, time.perf_counter() - t0)
+        yield item
+
+
+def count_rows(**kinds: int):
+    job = _current.get()
+    for kind, n in kinds.items():
+        service.rows[kind] += n
+        if job is not None:
+            job.rows[kind] += n
+
+
+def current() -> Optional[StageMetrics]:
+    """Metrics of the job running in this task, if any."""
+    return _current.get()
+
+
+@contextmanager
+def job_scope(job_id: str):
+    """Attribute everything measured inside the block (and tasks it starts) to job_id."""
+    m = jobs[job_id] = StageMetrics()
+    token = _current.set(m)
+    try:
+        yield m
+    finally:
+        _current.reset(token)
+        jobs.pop(job_id, None)
+
+
+# ----------------------------------------------------------------------
+# Prometheus text exposition (format 0.0.4)
+# ----------------------------------------------------------------------
+def _escape(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(**labels: Any) -> str:
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels.items()) + "}"
+
+
+def render(pool: Optional[Dict[str, Any]] = None) -> str:
+    lines = [
+        "# HELP etl_rows_total Rows seen by the load path, by outcome.",
+        "# TYPE etl_rows_total counter",
+    ]
+    for kind, n in service.rows.items():
+        lines.append(f"etl_rows_total{_labels(kind=kind)} {n}")
+
+    lines += [
+        "# HELP etl_stage_seconds Time spent per stage (one observation per chunk or statement).",
+        "# TYPE etl_stage_seconds histogram",
+    ]
+    for stage, h in service.stages.items():
+        for bound, c in zip(list(BUCKETS) + ["+Inf"], h.cumulative()):
+            lines.append(f"etl_stage_seconds_bucket{_labels(stage=stage, le=bound)} {c}")
+        lines.append(f"etl_stage_seconds_sum{_labels(stage=stage)} {h.sum:.6f}")
+        lines.append(f"etl_stage_seconds_count{_labels(stage=stage)} {h.count}")
+
+    if jobs:
+        lines += [
+            "# HELP etl_job_stage_seconds Time spent per stage by running jobs.",
+            "# TYPE etl_job_stage_seconds gauge",
+        ]
+        for job_id, m in list(jobs.items()):
+            for stage, h in m.stages.items():
+                lines.append(f"etl_job_stage_seconds{_labels(job_id=job_id, stage=stage)} {h.sum:.6f}")
+        lines += [
+            "# HELP etl_job_rows Rows seen by running jobs, by outcome.",
+            "# TYPE etl_job_rows gauge",
+        ]
+        for job_id, m in list(jobs.items()):
+            for kind, n in m.rows.items():
+                lines.append(f"etl_job_rows{_labels(job_id=job_id, kind=kind)} {n}")
+
+    if pool is not None:
+        lines += [
+            "# HELP etl_pool_acquires_total Connections acquired from the shared pool.",
+            "# TYPE etl_pool_acquires_total counter",
+            f"etl_pool_acquires_total {pool['acquires']}",
+            "# HELP etl_pool_waiting Tasks currently waiting for a pooled connection.",
+            "# TYPE etl_pool_waiting gauge",
+            f"etl_pool_waiting {pool['waiting']}",
+        ]
+        if pool.get("open"):
+            lines += [
+                "# HELP etl_pool_in_use Pooled connections currently checked out.",
+                "# TYPE etl_pool_in_use gauge",
+                f"etl_pool_in_use {pool['inUse']}",
+            ]
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,141 @@
+# etl-service/src/parsing.py
+"""Per-row CSV parsing; batchparse.py is the columnar equivalent."""
+import sys
+from typing import Optional, Dict, List, Sequence
+
+from quality import BP_RE, NON_NUMERIC_QUALITY
+from rules import engine
+from timestamps import UNPARSEABLE_TS, TimestampParser, parse_ts  # noqa: F401  (parse_ts re-exported)
+
+# Shared by every row without quality flags (most of them); never mutate a
+# row's flags in place, assign a new list instead.
+NO_FLAGS: Sequence[str] = ()
+
+RECORD_FIELDS = (
+    "study_id", "participant_id", "site_id", "measurement_type", "unit",
+    "value_numeric", "systolic", "diastolic", "quality_score", "ts", "flags", "is_valid",
+    "source_file",
+)
+
+
+class Record:
+    """
+    One parsed row: parse_row()'s keys as slots, read and written like a dict
+    (rec["ts"], rec.get("source_file")). About a fifth of the size of the
+    equivalent dict, which matters when chunks are buffered before loading.
+    """
+    __slots__ = RECORD_FIELDS
+
+    def __init__(self, study_id, participant_id, site_id, measurement_type, unit,
+                 value_numeric, systolic, diastolic, quality_score, ts, flags, is_valid,
+                 source_file=None):
+        self.study_id = study_id
+        self.participant_id = participant_id
+        self.site_id = site_id
+        self.measurement_type = measurement_type
+        self.unit = unit
+        self.value_numeric = value_numeric
+        self.systolic = systolic
+        self.diastolic = diastolic
+        self.quality_score = quality_score
+        self.ts = ts
+        self.flags = flags
+        self.is_valid = is_valid
+        self.source_file = source_file
+
+    def __getitem__(self, key: str):
+        try:
+            return getattr(self, key)
+        except (AttributeError, TypeError):
+            raise KeyError(key) from None
+
+    def __setitem__(self, key: str, value):
+        if key not in RECORD_FIELDS:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def get(self, key: str, default=None):
+        return getattr(self, key, default) if key in RECORD_FIELDS else default
+
+    def keys(self):
+        return RECORD_FIELDS
+
+    def __iter__(self):
+        return iter(RECORD_FIELDS)
+
+    def values(self) -> tuple:
+        return tuple(getattr(self, k) for k in RECORD_FIELDS)
+
+    def __eq__(self, other):
+        if not isinstance(other, Record):
+            return NotImplemented
+        return self.values() == other.values()
+
+    def __repr__(self):
+        return "Record(" + ", ".join(f"{k}={getattr(self, k)!r}" for k in RECORD_FIELDS) + ")"
+
+
+def parse_row(raw: Dict[str, str], ts_parser: Optional[TimestampParser] = None) -> Record:
+    """One CSV row as a Record; ts_parser is the file's own (see process_stream), else parse_ts is used."""
+    mt = (raw.get("measurement_type") or "").strip().lower()
+    unit = (raw.get("unit") or "").strip()
+    val = raw.get("value")
+    systolic = diastolic = None
+    value_numeric: Optional[float] = None
+    is_valid = True
+    flags: List[str] = []
+
+    rule = engine.types.get(mt)
+    if rule is not None and rule.kind == "bp":
+        m = BP_RE.match(val or "")
+        if m:
+            systolic = int(m.group(1))
+            diastolic = int(m.group(2))
+            unit = rule.canonical or "mmHg"
+        else:
+            is_valid = False
+            flags.append("invalid_bp_format")
+    else:
+        try:
+            value_numeric = float(val) if val is not None else None
+        except Exception:
+            is_valid = False
+            flags.append("non_numeric_value")
+
+    # unit conversion and range flags (rules.py); out-of-range rows stay valid
+    if rule is not None:
+        if rule.factors and value_numeric is not None:
+            factor = rule.factors.get(unit.lower())
+            if factor is not None:
+                value_numeric *= factor
+                unit = rule.canonical
+        if rule.checks:
+            flags += rule.flags(value_numeric, systolic, diastolic)
+
+    raw_ts = raw.get("timestamp")
+    ts = (ts_parser.parse if ts_parser else parse_ts)(raw_ts)  # tz-aware datetime (or None)
+    if ts is None and raw_ts:
+        flags.append(UNPARSEABLE_TS)
+
+    try:
+        quality_score: Optional[float] = float(raw.get("quality_score") or 0)
+    except ValueError:
+        quality_score = None
+        flags.append(NON_NUMERIC_QUALITY)
+
+    # study, site, type and unit repeat on nearly every row: intern them so a
+    # buffered chunk holds one copy of each instead of one per row
+    return Record(
+        sys.intern((raw.get("study_id") or "").strip()),
+        (raw.get("participant_id") or "").strip(),
+        sys.intern((raw.get("site_id") or "").strip()),
+        sys.intern(mt),
+        sys.intern(unit or ""),
+        value_numeric,
+        systolic,
+        diastolic,
+        quality_score,
+        ts,
+        flags or NO_FLAGS,
+        is_valid,
+    )
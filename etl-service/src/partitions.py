@@ -0,0 +1,232 @@
+# etl-service/src/partitions.py
+"""
+Monthly range partitions of fact_measurement, managed by the ETL.
+
+fact_measurement is partitioned by ts month (optionally sub-partitioned by
+study_id with ETL_PARTITION_BY_STUDY=1). Before a chunk is loaded,
+PartitionManager.ensure() creates any partition the chunk's rows need;
+known partitions are cached, so the common case (a chunk within one month)
+costs a min/max over the chunk's timestamps and a couple of set lookups.
+Only months that rows fall in get a partition, never the gap between them.
+
+Detached loads: a large historical file can be loaded into a separate
+partitioned "load table" that has no indexes or foreign keys, and
+finish_detached() then moves each month into fact_measurement with ATTACH
+PARTITION, so the indexes are built once per partition instead of being
+updated row by row. Months that already exist in fact_measurement are
+copied over with one INSERT ... SELECT instead. The load table has no
+unique index, so before anything moves every month is checked for rows
+that repeat a natural key, within the file or against fact_measurement;
+a load with any is dropped whole (LoadOverlap) rather than attached with
+rows silently missing. Such files are loaded the normal way. Rollups of
+a month are merged in the transaction that moves it, so a failed or
+dropped load never counts in agg_measurement_daily.
+"""
+import hashlib
+import os
+from datetime import datetime, timezone
+from typing import Iterable, List, Optional, Sequence, Set, Tuple
+
+import metrics
+import rollups
+from dedupe import NATURAL_KEY
+
+FACT_TABLE = "fact_measurement"
+BY_STUDY = os.getenv("ETL_PARTITION_BY_STUDY", "0") == "1"
+
+# every partition below `parent`, with whether it is a leaf
+PARTITION_TREE = """
+SELECT relid::regclass::text AS name, isleaf
+FROM pg_partition_tree($1::regclass)
+WHERE relid <> $1::regclass;
+"""
+
+# direct children of `parent` with their bound clauses
+CHILD_PARTITIONS = """
+SELECT c.relname AS name, pg_get_expr(c.relpartbound, c.oid) AS bound
+FROM pg_inherits i
+JOIN pg_class c ON c.oid = i.inhrelid
+WHERE i.inhparent = $1::regclass
+ORDER BY c.relname;
+"""
+
+LOCK_NAME = "SELECT pg_advisory_xact_lock(hashtext($1));"
+
+# rows of a load month beyond the first of their natural key
+LOAD_MONTH_REPEATS = (
+    'SELECT coalesce(sum(n - 1), 0) FROM (SELECT count(*) AS n FROM "{src}" GROUP BY '
+    + ", ".join(NATURAL_KEY) + ") k;"
+)
+# rows of a load month whose natural key the fact partition already holds
+LOAD_MONTH_LOADED = (
+    'SELECT count(*) FROM "{src}" s WHERE EXISTS (SELECT 1 FROM "{final}" f WHERE '
+    + " AND ".join(f"f.{c} = s.{c}" for c in NATURAL_KEY) + ");"
+)
+MERGE_LOAD_MONTH = f'INSERT INTO "{FACT_TABLE}" SELECT * FROM "{{src}}";'
+
+
+class LoadOverlap(Exception):
+    """A detached load repeats measurements; it was dropped and nothing was attached."""
+
+
+def month_of(ts: datetime) -> Tuple[int, int]:
+    ts = ts.astimezone(timezone.utc)
+    return ts.year, ts.month
+
+
+def months_of(stamps: Sequence[datetime]) -> List[Tuple[int, int]]:
+    """The months the timestamps fall in (not the ones between them: one mistyped year must not add centuries)."""
+    lo, hi = month_of(min(stamps)), month_of(max(stamps))
+    if lo == hi:
+        return [lo]  # the usual chunk
+    return sorted({month_of(t) for t in stamps})
+
+
+def month_bounds(year: int, month: int) -> Tuple[datetime, datetime]:
+    nxt = (year + 1, 1) if month == 12 else (year, month + 1)
+    return (datetime(year, month, 1, tzinfo=timezone.utc),
+            datetime(nxt[0], nxt[1], 1, tzinfo=timezone.utc))
+
+
+def month_partition(parent: str, year: int, month: int) -> str:
+    return f"{parent}_{year:04d}_{month:02d}"
+
+
+def study_partition(month_table: str, study_id: str) -> str:
+    # study ids are free text; a digest keeps the name a safe identifier
+    return f"{month_table}_s{hashlib.md5(study_id.encode()).hexdigest()[:12]}"
+
+
+def _literal(value: str) -> str:
+    return "'" + value.replace("'", "''") + "'"
+
+
+def load_table_name(content_hash: str) -> str:
+    """Load table for a detached load; named after the file so a resumed job finds it again."""
+    return "etl_load_" + hashlib.md5(content_hash.encode()).hexdigest()[:16]
+
+
+class PartitionManager:
+    def __init__(self, by_study: bool = BY_STUDY):
+        self.by_study = by_study
+        self.known: Set[str] = set()
+        self.leaves: Set[str] = set()
+        self._loaded: Set[str] = set()  # parents whose existing partitions were read
+        self.created = 0
+
+    def clear(self):
+        self.known.clear()
+        self.leaves.clear()
+        self._loaded.clear()
+
+    async def _load(self, conn, parent: str):
+        for r in await conn.fetch(PARTITION_TREE, parent):
+            name = r["name"].strip('"')
+            self.known.add(name)
+            if r["isleaf"]:
+                self.leaves.add(name)
+        self._loaded.add(parent)
+
+    async def ensure(self, conn, parent: str, ts: Sequence[Optional[datetime]], study_ids: Iterable[str]):
+        """Create every partition of `parent` that rows with these ts / study_id values need."""
+        stamps = [t for t in ts if t is not None]
+        if not stamps:
+            return
+        if parent not in self._loaded:
+            await self._load(conn, parent)
+        studies = set(study_ids) if self.by_study else ()
+        for y, m in months_of(stamps):
+            name = month_partition(parent, y, m)
+            if name not in self.known:
+                await self._create_month(conn, parent, name, y, m)
+            if name in self.leaves:
+                continue  # created before study sub-partitioning was turned on
+            for study_id in studies:
+                sub = study_partition(name, study_id)
+                if sub not in self.known:
+                    await self._create_study(conn, name, sub, study_id)
+
+    async def _create(self, conn, name: str, ddl: str):
+        # the advisory lock serializes replicas/shards creating the same partition
+        async with conn.transaction():
+            await conn.execute(LOCK_NAME, name)
+            await conn.execute(ddl)
+        self.known.add(name)
+        self.created += 1
+
+    async def _create_month(self, conn, parent: str, name: str, y: int, m: int):
+        lo, hi = month_bounds(y, m)
+        sub = " PARTITION BY LIST (study_id)" if self.by_study else ""
+        await self._create(conn, name, (
+            f'CREATE TABLE IF NOT EXISTS "{name}" PARTITION OF "{parent}" '
+            f"FOR VALUES FROM ('{lo.isoformat()}') TO ('{hi.isoformat()}'){sub};"
+        ))
+        if not self.by_study:
+            self.leaves.add(name)
+
+    async def _create_study(self, conn, month_table: str, name: str, study_id: str):
+        await self._create(conn, name, (
+            f'CREATE TABLE IF NOT EXISTS "{name}" PARTITION OF "{month_table}" '
+            f"FOR VALUES IN ({_literal(study_id)});"
+        ))
+        self.leaves.add(name)
+
+    # ------------------------------------------------------------------
+    # Detached loads
+    # ------------------------------------------------------------------
+    async def create_load_table(self, conn, load_table: str):
+        # LIKE keeps the columns, NOT NULL/CHECK constraints (required by
+        # ATTACH) and the id sequence default, but no indexes or FKs
+        await conn.execute(
+            f'CREATE TABLE IF NOT EXISTS "{load_table}" '
+            f'(LIKE "{FACT_TABLE}" INCLUDING DEFAULTS INCLUDING CONSTRAINTS) PARTITION BY RANGE (ts);'
+        )
+
+    async def finish_detached(self, conn, load_table: str) -> List[str]:
+        """
+        Move every month of load_table into fact_measurement, one transaction
+        per month (safe to re-run after a crash), then drop the load table.
+        Returns the fact_measurement partitions that were attached. Raises
+        LoadOverlap, after dropping the load table, if any row repeats a
+        natural key (see module docstring).
+        """
+        if FACT_TABLE not in self._loaded:
+            await self._load(conn, FACT_TABLE)
+        months = [(r["name"], r["bound"], FACT_TABLE + r["name"][len(load_table):])
+                  for r in await conn.fetch(CHILD_PARTITIONS, load_table)]
+        repeated = 0
+        for src, _, final in months:
+            repeated += await conn.fetchval(LOAD_MONTH_REPEATS.format(src=src))
+            if final in self.known:
+                repeated += await conn.fetchval(LOAD_MONTH_LOADED.format(src=src, final=final))
+        if repeated:
+            await conn.execute(f'DROP TABLE IF EXISTS "{load_table}";')
+            raise LoadOverlap(f"{repeated} rows repeat a measurement already loaded or earlier in the file; "
+                              "load it without detached")
+        attached = []
+        for src, bound, final in months:
+            async with conn.transaction():
+                await conn.execute(f'ALTER TABLE "{load_table}" DETACH PARTITION "{src}";')
+                if rollups.ENABLED:
+                    # the month's rows count once they are in fact_measurement, in the same transaction
+                    with metrics.timed("rollup"):
+                        await conn.execute(rollups.merge_sql(f'"{src}"') + ";")
+                if final in self.known:
+                    await conn.execute(MERGE_LOAD_MONTH.format(src=src))
+                    await conn.execute(f'DROP TABLE "{src}";')
+                    continue
+                for child in await conn.fetch(CHILD_PARTITIONS, src):
+                    await conn.execute(
+                        f'ALTER TABLE "{child["name"]}" RENAME TO "{FACT_TABLE + child["name"][len(load_table):]}";'
+                    )
+                await conn.execute(f'ALTER TABLE "{src}" RENAME TO "{final}";')
+                # builds fact_measurement's indexes on the partition in one pass
+                await conn.execute(f'ALTER TABLE "{FACT_TABLE}" ATTACH PARTITION "{final}" {bound};')
+            attached.append(final)
+        await conn.execute(f'DROP TABLE IF EXISTS "{load_table}";')
+        # names moved between parents; re-read on next use
+        self.clear()
+        return attached
+
+
+partition_manager = PartitionManager()
@@ -0,0 +1,378 @@
+# etl-service/src/profiling.py
+"""
+Data profile of the rows a job loads, built during the load pass.
+
+Every chunk is observed once, after it committed (main._committed), per
+study, minus the rows it did not write:
+
+* distinct participants and sites: HyperLogLog sketches (HLL_PRECISION
+  bits of register index, about 1.6% standard error at the default 12);
+* value / systolic / diastolic / quality_score per measurement type:
+  merging t-digests (DIGEST_COMPRESSION bounds the centroids kept);
+* rows per quality flag: exact counters (the flag vocabulary is small).
+
+The state is fixed-size however large the file is: HLL registers are a
+fixed array and a digest compresses its buffer into at most about
+compression/2 centroids. Hashes come from pandas' hash_array, which does
+not depend on the process, so sketches written by different replicas
+(and jobs) merge: Profile.merge() on the sketches stored with each job
+gives a study-wide profile without reading fact_measurement again.
+
+A resumed job profiles the rows it loaded itself, not those committed
+before the restart. Rows quarantined, rows the upsert left alone (keys
+already loaded) and chunks that rolled back are not profiled, and a
+detached load that attached nothing stores no profile, so merged row and
+flag counts match what fact_measurement holds.
+"""
+import base64
+import json
+import math
+import os
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Optional, Sequence, Set
+
+import numpy as np
+import pandas as pd
+
+import metrics
+
+ENABLED = os.getenv("ETL_PROFILE", "1") == "1"
+HLL_PRECISION = int(os.getenv("ETL_PROFILE_HLL_PRECISION", "12"))
+DIGEST_COMPRESSION = int(os.getenv("ETL_PROFILE_DIGEST_COMPRESSION", "200"))
+
+# sketches of one study, from every job that loaded rows of it
+SELECT_STUDY_SKETCHES = """
+SELECT id, details->'profileSketches'->$1 AS sketch
+FROM etl_jobs
+WHERE details->'profileSketches' ? $1;
+"""
+
+QUANTILES = (("min", 0.0), ("p05", 0.05), ("p25", 0.25), ("p50", 0.5), ("p75", 0.75), ("p95", 0.95),
+             ("max", 1.0))
+NUMERIC_FIELDS = {"value_numeric": "value", "systolic": "systolic", "diastolic": "diastolic",
+                  "quality_score": "qualityScore"}
+
+
+def _row_hashes(values: Sequence):
+    """(stable 64-bit hash per value, mask of non-empty values); each distinct value is hashed once."""
+    codes, uniques = pd.factorize(pd.Series([v or None for v in values], dtype=object))
+    hashed = pd.util.hash_array(np.asarray(uniques, dtype=str).astype(object)) if len(uniques) else \
+        np.empty(0, dtype=np.uint64)
+    return np.r_[hashed, np.uint64(0)][codes], codes >= 0
+
+
+def _hashes(values: Sequence) -> np.ndarray:
+    h, present = _row_hashes(values)
+    return h[present]
+
+
+def _groups(codes: np.ndarray):
+    """(code, positions) for each distinct code, in first-seen order of the sorted codes."""
+    order = np.argsort(codes, kind="stable")
+    bounds = np.flatnonzero(np.diff(codes[order])) + 1
+    for pos in np.split(order, bounds):
+        yield int(codes[pos[0]]), pos
+
+
+class HyperLogLog:
+    """Distinct-count sketch with 2**p one-byte registers."""
+
+    def __init__(self, p: int = HLL_PRECISION, registers: Optional[np.ndarray] = None):
+        self.p = p
+        self.registers = registers if registers is not None else np.zeros(1 << p, dtype=np.uint8)
+
+    def add(self, values: Sequence):
+        self.add_hashes(_hashes(values))
+
+    def add_hashes(self, h: np.ndarray):
+        if not len(h):
+            return
+        idx = (h >> np.uint64(64 - self.p)).astype(np.intp)
+        rest = h & np.uint64((1 << (64 - self.p)) - 1)
+        # rank = position of the first 1 bit in the remaining 64-p bits (64-p+1 if none)
+        bits = np.frexp(rest.astype(np.float64))[1]
+        rank = (64 - self.p + 1 - bits).astype(np.uint8)
+        np.maximum.at(self.registers, idx, rank)
+
+    def merge(self, other: "HyperLogLog"):
+        np.maximum(self.registers, other.registers, out=self.registers)
+
+    def estimate(self) -> int:
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        raw = alpha * m * m / float(np.sum(np.ldexp(1.0, -self.registers.astype(np.int64))))
+        zeros = int(np.count_nonzero(self.registers == 0))
+        if raw <= 2.5 * m and zeros:
+            return int(round(m * math.log(m / zeros)))  # linear counting for small cardinalities
+        return int(round(raw))
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"p": self.p, "registers": base64.b64encode(self.registers.tobytes()).decode()}
+
+    @classmethod
+    def from_dict(cls, d: Dict[str, Any]) -> "HyperLogLog":
+        regs = np.frombuffer(base64.b64decode(d["registers"]), dtype=np.uint8).copy()
+        return cls(d["p"], regs)
+
+
+class TDigest:
+    """
+    Merging t-digest (k1 scale). Values are buffered and compressed in one
+    vectorized pass: points are sorted and every point whose cumulative
+    quantile falls in the same unit of k-space joins the same centroid.
+    """
+
+    def __init__(self, compression: int = DIGEST_COMPRESSION):
+        self.compression = compression
+        self.means = np.empty(0)
+        self.weights = np.empty(0)
+        self.count = 0
+        self.min = math.inf
+        self.max = -math.inf
+        self._buffer: list = []
+        self._buffered = 0
+
+    def add(self, values: np.ndarray):
+        values = values[~np.isnan(values)]
+        if not len(values):
+            return
+        self.count += len(values)
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+        self._buffer.append((values, np.ones(len(values))))
+        self._buffered += len(values)
+        if self._buffered >= 10 * self.compression:
+            self._compress()
+
+    def merge(self, other: "TDigest"):
+        other._compress()
+        if not other.count:
+            return
+        self.count += other.count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self._buffer.append((other.means, other.weights))
+        self._buffered += len(other.means)
+        self._compress()
+
+    def _compress(self):
+        if not self._buffer:
+            return
+        means = np.concatenate([self.means] + [m for m, _ in self._buffer])
+        weights = np.concatenate([self.weights] + [w for _, w in self._buffer])
+        self._buffer, self._buffered = [], 0
+        order = np.argsort(means, kind="stable")
+        means, weights = means[order], weights[order]
+        cum = np.cumsum(weights)
+        q = (cum - weights / 2) / cum[-1]
+        k = np.floor(self.compression / (2 * math.pi) * np.arcsin(2 * q - 1)).astype(np.int64)
+        # k is non-decreasing along the sorted points, so each run is one centroid
+        starts = np.flatnonzero(np.r_[True, k[1:] != k[:-1]])
+        w = np.add.reduceat(weights, starts)
+        self.means = np.add.reduceat(means * weights, starts) / w
+        self.weights = w
+
+    def quantile(self, q: float) -> Optional[float]:
+        self._compress()
+        if not self.count:
+            return None
+        if q <= 0:
+            return self.min
+        if q >= 1:
+            return self.max
+        cum = np.cumsum(self.weights)
+        mids = (cum - self.weights / 2) / cum[-1]
+        xs = np.r_[0.0, mids, 1.0]
+        ys = np.r_[self.min, self.means, self.max]
+        return float(np.interp(q, xs, ys))
+
+    def summary(self) -> Dict[str, Any]:
+        out: Dict[str, Any] = {"count": self.count}
+        for name, q in QUANTILES:
+            v = self.quantile(q)
+            out[name] = None if v is None else round(v, 6)
+        return out
+
+    def to_dict(self) -> Dict[str, Any]:
+        self._compress()
+        return {"compression": self.compression, "count": self.count, "min": self.min, "max": self.max,
+                "means": self.means.tolist(), "weights": self.weights.tolist()}
+
+    @classmethod
+    def from_dict(cls, d: Dict[str, Any]) -> "TDigest":
+        t = cls(d["compression"])
+        t.count, t.min, t.max = d["count"], d["min"], d["max"]
+        t.means = np.asarray(d["means"], dtype=float)
+        t.weights = np.asarray(d["weights"], dtype=float)
+        return t
+
+
+class StudyProfile:
+    def __init__(self):
+        self.rows = 0
+        self.participants = HyperLogLog()
+        self.sites = HyperLogLog()
+        self.flags: Counter = Counter()
+        self.types: Dict[str, Dict[str, Any]] = {}  # measurement type -> {"rows": n, field: TDigest}
+
+    def _type(self, name: str) -> Dict[str, Any]:
+        t = self.types.get(name)
+        if t is None:
+            t = self.types[name] = {"rows": 0}
+        return t
+
+    def merge(self, other: "StudyProfile"):
+        self.rows += other.rows
+        self.participants.merge(other.participants)
+        self.sites.merge(other.sites)
+        self.flags.update(other.flags)
+        for name, theirs in other.types.items():
+            ours = self._type(name)
+            ours["rows"] += theirs["rows"]
+            for field, digest in theirs.items():
+                if field != "rows":
+                    ours.setdefault(field, TDigest(digest.compression)).merge(digest)
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            "rows": self.rows,
+            "participants": self.participants.estimate(),
+            "sites": self.sites.estimate(),
+            "flags": dict(self.flags.most_common()),
+            "measurementTypes": {
+                name: {"rows": t["rows"], **{f: d.summary() for f, d in t.items() if f != "rows"}}
+                for name, t in sorted(self.types.items())
+            },
+        }
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "rows": self.rows,
+            "participants": self.participants.to_dict(),
+            "sites": self.sites.to_dict(),
+            "flags": dict(self.flags),
+            "types": {name: {f: (v if f == "rows" else v.to_dict()) for f, v in t.items()}
+                      for name, t in self.types.items()},
+        }
+
+    @classmethod
+    def from_dict(cls, d: Dict[str, Any]) -> "StudyProfile":
+        s = cls()
+        s.rows = d["rows"]
+        s.participants = HyperLogLog.from_dict(d["participants"])
+        s.sites = HyperLogLog.from_dict(d["sites"])
+        s.flags = Counter(d["flags"])
+        s.types = {name: {f: (v if f == "rows" else TDigest.from_dict(v)) for f, v in t.items()}
+                   for name, t in d["types"].items()}
+        return s
+
+
+class Profile:
+    """Per-study profiles of the rows one job (or, merged, many jobs) loaded."""
+
+    def __init__(self):
+        self.studies: Dict[str, StudyProfile] = {}
+
+    def observe(self, batch: Dict[str, Sequence]):
+        """Add a column batch (parse_batch layout; only the profiled columns are read)."""
+        n = len(batch["study_id"])
+        if not n:
+            return
+        study_codes, studies = pd.factorize(pd.Series(batch["study_id"], dtype=object).fillna(""))
+        mt_codes, types = pd.factorize(pd.Series(batch["measurement_type"], dtype=object).fillna(""))
+        hashes = {col: _row_hashes(batch[col]) for col in ("participant_id", "site_id")}
+        numeric = {name: np.asarray(batch[col], dtype=float) for col, name in NUMERIC_FIELDS.items()}
+        profiles = []
+        for code, pos in _groups(study_codes):
+            s = self.studies.get(studies[code])
+            if s is None:
+                s = self.studies[studies[code]] = StudyProfile()
+            s.rows += len(pos)
+            for col, hll in (("participant_id", s.participants), ("site_id", s.sites)):
+                h, present = hashes[col]
+                hll.add_hashes(h[pos][present[pos]])
+            profiles.append((code, s))
+        by_code = dict(profiles)
+        flags = batch["flags"]
+        for i, f in enumerate(flags):
+            if f:
+                by_code[study_codes[i]].flags.update(f)
+        for key, pos in _groups(study_codes.astype(np.int64) * len(types) + mt_codes):
+            t = by_code[key // len(types)]._type(types[key % len(types)])
+            t["rows"] += len(pos)
+            for name, values in numeric.items():
+                v = values[pos]
+                if not np.isnan(v).all():
+                    if name not in t:
+                        t[name] = TDigest()
+                    t[name].add(v)
+
+    def observe_records(self, recs: Sequence):
+        """observe() for parsed records (row mode)."""
+        if recs:
+            cols = ("study_id", "participant_id", "site_id", "measurement_type", "flags", *NUMERIC_FIELDS)
+            self.observe({c: [r[c] for r in recs] for c in cols})
+
+    def merge(self, other: "Profile"):
+        for study, theirs in other.studies.items():
+            ours = self.studies.get(study)
+            if ours is None:
+                ours = self.studies[study] = StudyProfile()
+            ours.merge(theirs)
+
+    def summary(self) -> Dict[str, Any]:
+        return {"studies": {study: s.summary() for study, s in sorted(self.studies.items())}}
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {study: s.to_dict() for study, s in self.studies.items()}
+
+    @classmethod
+    def from_dict(cls, d: Dict[str, Any]) -> "Profile":
+        p = cls()
+        p.studies = {study: StudyProfile.from_dict(s) for study, s in d.items()}
+        return p
+
+
+_current: ContextVar[Optional[Profile]] = ContextVar("etl_job_profile", default=None)
+
+
+@contextmanager
+def job_scope():
+    """Profile the chunks loaded inside the block (and tasks it starts); yields None when profiling is off."""
+    p = Profile() if ENABLED else None
+    token = _current.set(p)
+    try:
+        yield p
+    finally:
+        _current.reset(token)
+
+
+def current() -> Optional[Profile]:
+    return _current.get()
+
+
+def observe(batch: Dict[str, Sequence], rejected: Optional[Set[int]] = None):
+    """Profile the rows of a committed column batch not in `rejected`, for the job running in this task, if any."""
+    p = _current.get()
+    if p is None:
+        return
+    with metrics.timed("profile"):
+        if rejected:
+            keep = [i for i in range(len(batch["study_id"])) if i not in rejected]
+            cols = ("study_id", "participant_id", "site_id", "measurement_type", "flags", *NUMERIC_FIELDS)
+            batch = {c: [batch[c][i] for i in keep] for c in cols}
+        p.observe(batch)
+
+
+async def study_profile(conn, study_id: str) -> Optional[Dict[str, Any]]:
+    """Merge the sketches every job stored for study_id; None if no job profiled it."""
+    rows = await conn.fetch(SELECT_STUDY_SKETCHES, study_id)
+    if not rows:
+        return None
+    merged = StudyProfile()
+    for r in rows:
+        sketch = r["sketch"]
+        merged.merge(StudyProfile.from_dict(json.loads(sketch) if isinstance(sketch, str) else sketch))
+    return {"studyId": study_id, "jobs": sorted(r["id"] for r in rows), **merged.summary()}
@@ -0,0 +1,213 @@
+# etl-service/src/quarantine.py
+"""
+Quarantine for rows that are not loaded into fact_measurement.
+
+Each chunk gets a ChunkRejects. Rows that can never be inserted (missing
+or unparseable timestamp, quality_score not a number or outside 0..1) are
+set aside before any statement runs, so one bad row does not fail the
+chunk's batch. Rows that parsed as invalid (is_valid false) are
+quarantined too, as kind "invalid"; ETL_QUARANTINE_INVALID=0 loads them
+flagged instead. Rows that still fail in the database are found by
+replaying the chunk in small sub-batches, and only a sub-batch that fails
+is retried row by row.
+
+All of a chunk's rejects go to etl_rejects with one COPY in the chunk's
+own transaction, just before the checkpoint. A resumed job therefore never
+records a row twice. Each reject keeps the job id, the file, the 1-based
+data row number (header not counted; NULL for sharded loads, which work
+in byte ranges), the row as CSV text, and the reason.
+"""
+import bisect
+import csv
+import io
+import math
+import os
+from typing import Any, Callable, Dict, List, Optional, Sequence, Set, Tuple
+
+import metrics
+import sharding
+from timestamps import UNPARSEABLE_TS
+
+QUARANTINE_INVALID = os.getenv("ETL_QUARANTINE_INVALID", "1") == "1"
+
+TABLE = "etl_rejects"
+COLUMNS = ["job_id", "filename", "row_number", "raw", "kind", "reason", "flags"]
+
+# keyset pagination on id (GET /jobs/{job_id}/rejects)
+SELECT_PAGE = f"""
+SELECT id, row_number, raw, kind, reason, flags, created_at
+FROM {TABLE}
+WHERE job_id = $1 AND id > $2
+ORDER BY id
+LIMIT $3;
+"""
+
+MISSING_TS = "missing timestamp"
+BAD_TS = "unparseable timestamp"
+BAD_QUALITY = "quality_score must be between 0 and 1"
+
+
+def precheck(ts: Sequence[Any], quality: Sequence[Any], is_valid: Sequence[bool],
+             flags: Sequence[List[str]]) -> Dict[int, Tuple[str, str]]:
+    """
+    Positions of rows that must not reach the insert -> (kind, reason).
+    Rows whose timestamp was present but unparseable are counted as
+    bad_timestamp rows.
+    """
+    out: Dict[int, Tuple[str, str]] = {}
+    bad_ts = 0
+    for i, (t, q, ok) in enumerate(zip(ts, quality, is_valid)):
+        if t is None:
+            if UNPARSEABLE_TS in flags[i]:
+                out[i] = ("error", BAD_TS)
+                bad_ts += 1
+            else:
+                out[i] = ("error", MISSING_TS)
+        elif q is None or math.isnan(q) or not 0 <= q <= 1:
+            out[i] = ("error", BAD_QUALITY)
+        elif QUARANTINE_INVALID and not ok:
+            out[i] = ("invalid", ", ".join(flags[i]) or "invalid")
+    if bad_ts:
+        metrics.count_rows(bad_timestamp=bad_ts)
+    return out
+
+
+# ----------------------------------------------------------------------
+# Raw row text, rendered only for rows that are rejected
+# ----------------------------------------------------------------------
+def _csv_line(values: Sequence[Any]) -> str:
+    buf = io.StringIO()
+    csv.writer(buf, lineterminator="").writerow(["" if v is None else v for v in values])
+    return buf.getvalue()
+
+
+def raw_rows(chunk) -> Callable[[int], Optional[str]]:
+    """Row i of a reader chunk (DictReader rows or a column batch) as CSV text."""
+    if isinstance(chunk, list):
+        return lambda i: _csv_line(list(chunk[i].values()))
+    cols = list(chunk.values())
+    return lambda i: _csv_line([c[i] for c in cols])
+
+
+def raw_piece(path: str, start: int, end: int) -> Callable[[int], Optional[str]]:
+    """Row i of a shard piece; the piece is read again only when it has a reject."""
+    rows: List[List[str]] = []
+
+    def raw(i: int) -> Optional[str]:
+        if not rows:
+            rows.extend(sharding.read_range(path, start, end))
+        return _csv_line(rows[i]) if i < len(rows) else None
+    return raw
+
+
+class ChunkRejects:
+    """
+    Rejected rows of one chunk, by position in the chunk. first_row is the
+    data row number of position 0 (None when unknown). Without a job_id
+    (direct callers, tests) rejects are only printed.
+    """
+    def __init__(self, job_id: Optional[str] = None, filename: str = "",
+                 raw: Optional[Callable[[int], Optional[str]]] = None, first_row: Optional[int] = None):
+        self.job_id = job_id
+        self.filename = filename
+        self.raw = raw
+        self.first_row = first_row
+        self.rows: Dict[int, Tuple[str, str, List[str]]] = {}
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def add(self, pos: int, reason: str, kind: str = "error", flags: Sequence[str] = ()):
+        self.rows[pos] = (kind, reason, list(flags))
+
+    def subset(self, positions: Sequence[int]) -> "ChunkRejects":
+        """View whose position i is positions[i] here (for a filtered part of the chunk)."""
+        return _Subset(self, positions)
+
+    def tracking(self) -> "TrackedRejects":
+        """View that also remembers which positions were rejected (see TrackedRejects)."""
+        return TrackedRejects(self)
+
+    def records(self) -> List[tuple]:
+        out = []
+        for pos in sorted(self.rows):
+            kind, reason, flags = self.rows[pos]
+            out.append((
+                self.job_id, self.filename,
+                self.first_row + pos if self.first_row is not None else None,
+                self.raw(pos) if self.raw else None, kind, reason, flags,
+            ))
+        return out
+
+    async def write(self, conn):
+        """COPY this chunk's rejects into etl_rejects (call inside the chunk transaction)."""
+        if not len(self):
+            return
+        if self.job_id is None:
+            for _, _, _, _, kind, reason, _ in self.records():
+                print(f"[ETL] row {kind}: {reason}", flush=True)
+            return
+        await conn.copy_records_to_table(TABLE, records=self.records(), columns=COLUMNS)
+        print(f"[ETL] job={self.job_id}: {len(self)} rows quarantined", flush=True)
+
+    def committing(self, before_commit=None):
+        """before_commit hook that writes the rejects, then runs before_commit."""
+        async def hook(conn):
+            await self.write(conn)
+            if before_commit:
+                await before_commit(conn)
+        return hook
+
+
+class _Subset(ChunkRejects):
+    def __init__(self, parent: ChunkRejects, positions: Sequence[int]):
+        self.parent = parent
+        self.positions = list(positions)
+
+    def __len__(self) -> int:
+        return len(self.parent)
+
+    def add(self, pos: int, reason: str, kind: str = "error", flags: Sequence[str] = ()):
+        self.parent.add(self.positions[pos], reason, kind, flags)
+
+    def subset(self, positions: Sequence[int]) -> ChunkRejects:
+        return _Subset(self.parent, [self.positions[i] for i in positions])
+
+    async def write(self, conn):
+        await self.parent.write(conn)
+
+
+class TrackedRejects(_Subset):
+    """Passes rejects on unchanged and keeps their positions in `rejected`, so the rows that did load are known."""
+    def __init__(self, parent: ChunkRejects):
+        self.parent = parent
+        self.rejected: Set[int] = set()
+
+    def add(self, pos: int, reason: str, kind: str = "error", flags: Sequence[str] = ()):
+        self.rejected.add(pos)
+        self.parent.add(pos, reason, kind, flags)
+
+    def subset(self, positions: Sequence[int]) -> ChunkRejects:
+        return _Subset(self, positions)
+
+
+class CombinedRejects(ChunkRejects):
+    """Rejects of a chunk coalesced from several files: (rows, ChunkRejects) per file, in chunk order."""
+    def __init__(self, parts: Sequence[Tuple[int, ChunkRejects]]):
+        self.parts = [r for _, r in parts]
+        self.starts: List[int] = []
+        offset = 0
+        for n, _ in parts:
+            self.starts.append(offset)
+            offset += n
+        self.job_id = self.parts[0].job_id if self.parts else None
+
+    def __len__(self) -> int:
+        return sum(len(r) for r in self.parts)
+
+    def add(self, pos: int, reason: str, kind: str = "error", flags: Sequence[str] = ()):
+        k = bisect.bisect_right(self.starts, pos) - 1
+        self.parts[k].add(pos - self.starts[k], reason, kind, flags)
+
+    def records(self) -> List[tuple]:
+        return [rec for r in self.parts for rec in r.records()]
@@ -0,0 +1,137 @@
+# etl-service/src/reader.py
+"""
+Single-pass streaming CSV reader.
+
+CSVStream opens the file once, reads it in large buffered blocks and yields
+row chunks to the parse/load stages. Progress is bytes consumed over the
+os.stat size, so no extra pass is needed to count lines, and memory stays
+at one block plus one chunk whatever the file size.
+
+.csv.gz and .csv.zst files are decompressed on the fly (zstd needs the
+optional zstandard package); progress is then compressed bytes consumed.
+open_input() picks CSVStream or, for Parquet / Arrow IPC files,
+columnar.ColumnarStream, which has the same interface.
+"""
+import csv
+import gzip
+import io
+import itertools
+import os
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+import batchparse
+
+try:
+    import zstandard
+except ImportError:  # optional: only needed for .zst inputs
+    zstandard = None
+
+BLOCK_SIZE = int(os.getenv("ETL_READ_BLOCK_BYTES", str(1024 * 1024)))
+
+COMPRESSION_SUFFIXES = {".gz": "gzip", ".zst": "zstd"}
+COLUMNAR_SUFFIXES = {".parquet": "parquet", ".pq": "parquet", ".arrow": "arrow", ".feather": "arrow", ".ipc": "arrow"}
+
+
+def compression_of(path: str) -> Optional[str]:
+    return COMPRESSION_SUFFIXES.get(os.path.splitext(path)[1].lower())
+
+
+def columnar_format(path: str) -> Optional[str]:
+    return COLUMNAR_SUFFIXES.get(os.path.splitext(path)[1].lower())
+
+
+def open_input(path: str, block_size: int = BLOCK_SIZE):
+    """Stream for any supported input file (use as a context manager)."""
+    fmt = columnar_format(path)
+    if fmt:
+        import columnar
+        return columnar.ColumnarStream(path, fmt)
+    return CSVStream(path, block_size)
+
+
+def _batched(rows: Iterable, size: int) -> Iterator[List]:
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _skip(rows: Iterator, n: int) -> Iterator:
+    next(itertools.islice(rows, n, n), None)
+    return rows
+
+
+def iter_chunks(f, chunk_size: int, load_mode: str, skip_rows: int = 0) -> Iterator[Tuple[int, object]]:
+    """
+    Yield (row_count, chunk) from a text file object. Bulk mode reads plain
+    lists and pivots them into columns for batchparse; row mode keeps
+    csv.DictReader rows for parse_row. The first skip_rows data rows (blank
+    lines not counted) are read past without being parsed, for resumed jobs.
+    """
+    if load_mode == "bulk":
+        reader = csv.reader(f)
+        header = next(reader, [])
+        rows = _skip((r for r in reader if r), skip_rows)  # DictReader skips blank lines too
+        for rows in _batched(rows, chunk_size):
+            yield len(rows), batchparse.columns_from_lists(header, rows)
+    else:
+        dict_reader = csv.DictReader(f)
+        if skip_rows:
+            dict_reader.fieldnames  # consume the header before skipping raw rows
+            _skip((r for r in dict_reader.reader if r), skip_rows)
+        for rows in _batched(dict_reader, chunk_size):
+            yield len(rows), rows
+
+
+def _decompress(f, compression: Optional[str], block_size: int):
+    if compression == "gzip":
+        return gzip.GzipFile(fileobj=f, mode="rb")
+    if compression == "zstd":
+        if zstandard is None:
+            raise RuntimeError("reading .zst files needs the zstandard package")
+        return zstandard.ZstdDecompressor().stream_reader(f, read_size=block_size)
+    return f
+
+
+class CSVStream:
+    """Context manager over one CSV file; see module docstring."""
+    columnar = False
+
+    def __init__(self, path: str, block_size: int = BLOCK_SIZE):
+        self.path = path
+        self.block_size = block_size
+        self.size = os.stat(path).st_size
+        self.compression = compression_of(path)
+        self._raw = None
+        self._text = None
+
+    def __enter__(self) -> "CSVStream":
+        # unbuffered raw file under our own block-sized buffer, so raw.tell()
+        # is exactly the number of bytes pulled from disk
+        self._raw = open(self.path, "rb", buffering=0)
+        buffered = io.BufferedReader(self._raw, buffer_size=self.block_size)
+        self._text = io.TextIOWrapper(
+            _decompress(buffered, self.compression, self.block_size), encoding="utf-8-sig", newline=""
+        )
+        return self
+
+    def __exit__(self, *exc):
+        self._text.close()
+        self._raw.close()  # decompressors leave the file they wrap open
+
+    @property
+    def bytes_read(self) -> int:
+        return self._raw.tell() if self._raw and not self._raw.closed else self.size
+
+    def progress(self) -> int:
+        """Percent of the file consumed so far (0-100)."""
+        if not self.size:
+            return 100
+        return min(100, int(self.bytes_read * 100 / self.size))
+
+    def chunks(self, chunk_size: int, load_mode: str, skip_rows: int = 0) -> Iterator[Tuple[int, object]]:
+        return iter_chunks(self._text, chunk_size, load_mode, skip_rows)
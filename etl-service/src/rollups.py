@@ -0,0 +1,121 @@
+# etl-service/src/rollups.py
+"""
+Daily rollups of fact_measurement, maintained incrementally by the loader.
+
+agg_measurement_daily holds, per (study, site, measurement type, UTC day):
+row and invalid counts, count/min/max/sum/sum of squares of value_numeric,
+systolic and diastolic, and per-flag counts. Rows are added exactly when
+they reach fact_measurement, inside the same transaction, so rollups stay
+in step with the facts across retries, resumed jobs and failed loads:
+
+- chunk loads: the fact upsert (dedupe.upsert_sql) merges the rows it
+  inserted, in the same statement;
+- detached loads: nothing is merged while the load table fills; each month
+  is merged as partitions.finish_detached moves it into fact_measurement.
+
+Both use merge_sql(), which merges in key order so concurrent chunks lock
+rollup rows in the same order. rebuild() recomputes a study and/or a day
+from the facts.
+"""
+import os
+from datetime import date
+from typing import Optional
+
+ENABLED = os.getenv("ETL_ROLLUPS", "1") == "1"
+
+KEY = ("study_id", "site_id", "measurement_type_id", "day")
+STATS = ("value", "systolic", "diastolic")
+
+_STAT_COLUMNS = [f"{s}_{a}" for s in STATS for a in ("count", "min", "max", "sum", "sumsq")]
+COLUMNS = list(KEY) + ["n", "n_invalid"] + _STAT_COLUMNS + ["flag_counts"]
+
+_MERGE = ",\n  ".join(
+    [
+        "n = a.n + EXCLUDED.n",
+        "n_invalid = a.n_invalid + EXCLUDED.n_invalid",
+    ]
+    + [
+        f"{s}_count = a.{s}_count + EXCLUDED.{s}_count,\n  "
+        f"{s}_min = LEAST(a.{s}_min, EXCLUDED.{s}_min),\n  "
+        f"{s}_max = GREATEST(a.{s}_max, EXCLUDED.{s}_max),\n  "
+        f"{s}_sum = COALESCE(a.{s}_sum, 0) + COALESCE(EXCLUDED.{s}_sum, 0),\n  "
+        f"{s}_sumsq = COALESCE(a.{s}_sumsq, 0) + COALESCE(EXCLUDED.{s}_sumsq, 0)"
+        for s in STATS
+    ]
+    + [
+        """flag_counts = COALESCE((
+    SELECT jsonb_object_agg(k, COALESCE((a.flag_counts->>k)::bigint, 0) + COALESCE((EXCLUDED.flag_counts->>k)::bigint, 0))
+    FROM (SELECT jsonb_object_keys(a.flag_counts) UNION SELECT jsonb_object_keys(EXCLUDED.flag_counts)) AS keys(k)
+  ), '{}'::jsonb)""",
+        "updated_at = NOW()",
+    ]
+)
+
+_ON_CONFLICT = f"""
+ON CONFLICT ({", ".join(KEY)}) DO UPDATE SET
+  {_MERGE}"""
+
+def _aggregate_sql(source: str, where: str = "") -> str:
+    """SELECT producing rollup rows (in COLUMNS order) from `source` (aliased f, with f.measurement_type_id)."""
+    stats = ",\n  ".join(
+        f"count({col}), min({col}), max({col}), sum({col}), sum({col}::float8 * {col})"
+        for col in ("f.value_numeric", "f.systolic", "f.diastolic")
+    )
+    return f"""
+WITH f AS (
+  SELECT f.study_id, COALESCE(f.site_id, '') AS site_id, f.measurement_type_id,
+         (f.ts AT TIME ZONE 'UTC')::date AS day,
+         f.value_numeric, f.systolic, f.diastolic, f.is_valid, f.quality_flags
+  FROM {source} {where}
+),
+flags AS (
+  SELECT study_id, site_id, measurement_type_id, day, jsonb_object_agg(flag, n) AS flag_counts
+  FROM (
+    SELECT f.study_id, f.site_id, f.measurement_type_id, f.day, fl AS flag, count(*) AS n
+    FROM f, unnest(f.quality_flags) AS fl
+    GROUP BY 1, 2, 3, 4, 5
+  ) x
+  GROUP BY 1, 2, 3, 4
+)
+SELECT f.study_id, f.site_id, f.measurement_type_id, f.day,
+  count(*), count(*) FILTER (WHERE NOT f.is_valid),
+  {stats},
+  COALESCE(max(flags.flag_counts::text)::jsonb, '{{}}'::jsonb)
+FROM f
+LEFT JOIN flags USING (study_id, site_id, measurement_type_id, day)
+GROUP BY f.study_id, f.site_id, f.measurement_type_id, f.day
+ORDER BY 1, 2, 3, 4"""
+
+
+def merge_sql(source: str) -> str:
+    """Rollup upsert of the fact rows in `source` (a table, CTE or subquery), without the trailing ';'."""
+    return f"INSERT INTO agg_measurement_daily AS a ({', '.join(COLUMNS)})" + _aggregate_sql(source + " f") + _ON_CONFLICT
+
+
+# ----------------------------------------------------------------------
+# Rebuild from facts
+# ----------------------------------------------------------------------
+async def rebuild(conn, study_id: Optional[str] = None, day: Optional[date] = None) -> int:
+    """Recompute rollups for one study and/or one UTC day from fact_measurement; returns rows written."""
+    if study_id is None and day is None:
+        raise ValueError("rebuild needs a study_id and/or a day")
+    agg_conds, fact_conds, args = [], [], []
+    if study_id is not None:
+        args.append(study_id)
+        agg_conds.append(f"study_id = ${len(args)}")
+        fact_conds.append(f"f.study_id = ${len(args)}")
+    if day is not None:
+        args.append(day)
+        n = len(args)
+        agg_conds.append(f"day = ${n}")
+        # a ts range, so partition pruning and the ts indexes apply
+        fact_conds.append(f"f.ts >= ${n}::date::timestamp AT TIME ZONE 'UTC' "
+                          f"AND f.ts < (${n}::date + 1)::timestamp AT TIME ZONE 'UTC'")
+    async with conn.transaction():
+        await conn.execute(f"DELETE FROM agg_measurement_daily WHERE {' AND '.join(agg_conds)};", *args)
+        status = await conn.execute(
+            f"INSERT INTO agg_measurement_daily ({', '.join(COLUMNS)})"
+            + _aggregate_sql("fact_measurement f", "WHERE " + " AND ".join(fact_conds)) + ";",
+            *args,
+        )
+    return int(status.split()[-1])
@@ -0,0 +1,197 @@
+# etl-service/src/rules.py
+"""
+Table-driven unit conversion and range/flag rules per measurement type.
+
+The rules are data: by default they come from CANONICAL_UNITS, CONVERSIONS
+and RANGES below, and ETL_RULES_FILE can point at a JSON file that adds or
+replaces measurement types:
+
+    {"types": {
+        "spo2": {"unit": "%", "ranges": {"value": [50, 100]}},
+        "weight": {"unit": "kg", "convert": {"lb": 0.453592, "lbs": 0.453592, "g": 0.001},
+                   "ranges": {"value": [20, 400]},
+                   "flags": [{"field": "value", "min": 25, "max": 300, "flag": "weight_implausible"}]},
+        "blood_pressure": {"kind": "bp", "unit": "mmHg",
+                           "ranges": {"systolic": [60, 260], "diastolic": [40, 160]}}
+    }}
+
+"convert" maps lower-cased source units to the factor into the canonical
+unit; "ranges" become "<field>_out_of_range" flags; "flags" are extra
+min/max rules with their own flag name. kind "bp" types carry "120/80"
+values (systolic/diastolic) instead of a number.
+
+RuleEngine compiles this once into a dict of TypeRule objects (unit ->
+factor table and a tuple of range checks per type), so a row costs one
+dict lookup for its type plus arithmetic. The *_batch methods apply the
+same tables to numpy columns, one vectorized pass per measurement type
+present in the chunk.
+"""
+import json
+import os
+from typing import Any, Dict, FrozenSet, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+RULES_FILE = os.getenv("ETL_RULES_FILE", "")
+
+# Canonical units we want to land with
+CANONICAL_UNITS = {
+    "glucose": "mg/dL",
+    "cholesterol": "mg/dL",
+    "weight": "kg",
+    "height": "cm",
+    "heart_rate": "bpm",
+    "blood_pressure": "mmHg",
+}
+
+# Basic physiological ranges (illustrative, adjustable)
+RANGES = {
+    "glucose": (30, 500),            # mg/dL
+    "cholesterol": (50, 400),        # mg/dL
+    "weight": (20, 400),             # kg
+    "height": (50, 250),             # cm
+    "heart_rate": (30, 230),         # bpm
+    "systolic": (60, 260),           # mmHg
+    "diastolic": (40, 160),          # mmHg
+}
+
+# Factors into the canonical unit, by lower-cased source unit
+CONVERSIONS = {
+    "weight": {"lb": 0.453592, "lbs": 0.453592},
+    "height": {"in": 2.54, "inch": 2.54, "inches": 2.54},
+}
+
+FIELDS = ("value", "systolic", "diastolic")  # what range/flag rules can test
+
+# (index into FIELDS, low, high, flag)
+Check = Tuple[int, float, float, str]
+
+
+def default_config() -> Dict[str, Any]:
+    """The built-in rules, as a config dict."""
+    types: Dict[str, Dict[str, Any]] = {}
+    for mt, unit in CANONICAL_UNITS.items():
+        t: Dict[str, Any] = {"unit": unit}
+        if mt in CONVERSIONS:
+            t["convert"] = dict(CONVERSIONS[mt])
+        if mt == "blood_pressure":
+            t["kind"] = "bp"
+            t["ranges"] = {"systolic": RANGES["systolic"], "diastolic": RANGES["diastolic"]}
+        elif mt in RANGES:
+            t["ranges"] = {"value": RANGES[mt]}
+        types[mt] = t
+    return {"types": types}
+
+
+def load_config(path: str = RULES_FILE) -> Dict[str, Any]:
+    """Built-in rules, with the types defined in `path` (if any) added or replaced."""
+    config = default_config()
+    if path:
+        with open(path) as f:
+            config["types"].update(json.load(f).get("types", {}))
+    return config
+
+
+class TypeRule:
+    __slots__ = ("name", "kind", "canonical", "factors", "checks")
+
+    def __init__(self, name: str, kind: str, canonical: Optional[str],
+                 factors: Dict[str, float], checks: Tuple[Check, ...]):
+        self.name = name
+        self.kind = kind
+        self.canonical = canonical
+        self.factors = factors  # lower-cased unit -> factor into canonical
+        self.checks = checks
+
+    def flags(self, value=None, systolic=None, diastolic=None) -> List[str]:
+        out: List[str] = []
+        vals = (value, systolic, diastolic)
+        for i, lo, hi, flag in self.checks:
+            v = vals[i]
+            if v is not None and not lo <= v <= hi:
+                out.append(flag)
+        return out
+
+
+class RuleEngine:
+    def __init__(self, config: Dict[str, Any]):
+        self.types: Dict[str, TypeRule] = {}
+        for name, t in config.get("types", {}).items():
+            mt = name.strip().lower()
+            canonical = t.get("unit")
+            kind = t.get("kind", "numeric")
+            if kind not in ("numeric", "bp"):
+                raise ValueError(f"rules: {mt}: unknown kind {kind!r}")
+            factors = {u.strip().lower(): float(f) for u, f in (t.get("convert") or {}).items()}
+            if factors and canonical is None:
+                raise ValueError(f"rules: {mt}: conversions need a canonical unit")
+            checks: List[Check] = []
+            for field, (lo, hi) in (t.get("ranges") or {}).items():
+                checks.append((self._field(mt, field), lo, hi, f"{field}_out_of_range"))
+            for rule in t.get("flags") or ():
+                lo = rule.get("min", float("-inf"))
+                hi = rule.get("max", float("inf"))
+                checks.append((self._field(mt, rule["field"]), lo, hi, rule["flag"]))
+            self.types[mt] = TypeRule(mt, kind, canonical, factors, tuple(checks))
+        self.canonical: Dict[str, Optional[str]] = {mt: r.canonical for mt, r in self.types.items()}
+        self.bp_types: FrozenSet[str] = frozenset(mt for mt, r in self.types.items() if r.kind == "bp")
+
+    @staticmethod
+    def _field(mt: str, field: str) -> int:
+        if field not in FIELDS:
+            raise ValueError(f"rules: {mt}: unknown field {field!r}")
+        return FIELDS.index(field)
+
+    # ------------------------------------------------------------------
+    # Single rows (parse_row inlines these around one types.get())
+    # ------------------------------------------------------------------
+    def convert(self, mt: str, unit: str, value: Optional[float]) -> Tuple[Optional[float], str]:
+        """Convert a numeric value into the type's canonical unit when a conversion is defined."""
+        rule = self.types.get(mt)
+        if rule is None or not rule.factors or value is None:
+            return value, unit
+        factor = rule.factors.get(unit.lower())
+        if factor is None:
+            return value, unit
+        return value * factor, rule.canonical
+
+    def flags(self, mt: str, value=None, systolic=None, diastolic=None) -> List[str]:
+        """Range/flag rule hits for one (converted) row."""
+        rule = self.types.get(mt)
+        return rule.flags(value, systolic, diastolic) if rule is not None and rule.checks else []
+
+    # ------------------------------------------------------------------
+    # Column batches (numpy object / float arrays, as in batchparse)
+    # ------------------------------------------------------------------
+    def bp_mask(self, mt: np.ndarray) -> np.ndarray:
+        return np.isin(mt, list(self.bp_types))
+
+    def convert_batch(self, mt: np.ndarray, unit_lc: np.ndarray, values: np.ndarray,
+                      has_value: np.ndarray, unit: np.ndarray) -> None:
+        """convert() over columns; updates values and unit in place."""
+        for t in np.unique(mt[np.isin(mt, [t for t, r in self.types.items() if r.factors])]):
+            rule = self.types[t]
+            is_t = (mt == t) & has_value
+            for u, factor in rule.factors.items():
+                sel = is_t & (unit_lc == u)
+                if sel.any():
+                    values[sel] *= factor
+                    unit[sel] = rule.canonical
+
+    def flags_batch(self, mt: np.ndarray, fields: Sequence[Tuple[np.ndarray, np.ndarray]],
+                    out: List[List[str]]) -> None:
+        """
+        flags() over columns; extends out[i] by replacing it, so rows may
+        share one empty value (parsing.NO_FLAGS). `fields` holds one
+        (float values, has value) pair per FIELDS entry.
+        """
+        for t in np.unique(mt[np.isin(mt, [t for t, r in self.types.items() if r.checks])]):
+            is_t = mt == t
+            hits = [(i, flag, is_t & fields[i][1] & ~((fields[i][0] >= lo) & (fields[i][0] <= hi)))
+                    for i, lo, hi, flag in self.types[t].checks]
+            # row-major, so each row's flags keep the rule order flags() uses
+            for row in np.flatnonzero(np.logical_or.reduce([h for _, _, h in hits])):
+                out[row] = [*out[row], *(flag for _, flag, h in hits if h[row])]
+
+
+engine = RuleEngine(load_config())
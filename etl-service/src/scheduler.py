@@ -0,0 +1,57 @@
+# etl-service/src/scheduler.py
+"""
+Bounded job scheduler.
+
+Every submitted job runs through JobScheduler.run(), which holds one of
+max_jobs slots for the job's lifetime; jobs beyond that wait as "queued".
+"""
+import asyncio
+import os
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+
+class JobScheduler:
+    def __init__(self, max_jobs: int):
+        self.max_jobs = max(1, max_jobs)
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+        self._sem: Optional[asyncio.Semaphore] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def _semaphore(self) -> asyncio.Semaphore:
+        # asyncio primitives belong to one loop; rebuild if the loop changed
+        loop = asyncio.get_running_loop()
+        if self._sem is None or self._loop is not loop:
+            self._sem, self._loop = asyncio.Semaphore(self.max_jobs), loop
+        return self._sem
+
+    def free_slots(self) -> int:
+        """Jobs that could start right now without waiting."""
+        return self.max_jobs - self.running - self.queued
+
+    async def run(self, fn: Callable[..., Awaitable[Any]], *args, **kwargs) -> Any:
+        sem = self._semaphore()
+        self.queued += 1
+        try:
+            await sem.acquire()
+        finally:
+            self.queued -= 1
+        self.running += 1
+        try:
+            return await fn(*args, **kwargs)
+        finally:
+            self.running -= 1
+            self.completed += 1
+            sem.release()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "maxJobs": self.max_jobs,
+            "running": self.running,
+            "queued": self.queued,
+            "completed": self.completed,
+        }
+
+
+scheduler = JobScheduler(int(os.getenv("ETL_MAX_CONCURRENT_JOBS", "4")))
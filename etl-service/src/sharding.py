@@ -0,0 +1,97 @@
+# etl-service/src/sharding.py
+"""
+Byte-range sharding of a single CSV.
+
+plan_shards() cuts a file into line-aligned byte ranges; parse_range() reads
+one range and returns a parsed column batch. parse_range runs in a process
+pool, so this module only depends on the parse stage.
+
+Sharding assumes records do not contain quoted newlines (true for our
+exports); a file that does should be loaded unsharded.
+"""
+import csv
+import io
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Tuple
+import multiprocessing
+
+import batchparse
+
+_executor: Optional[ProcessPoolExecutor] = None
+
+
+def get_executor() -> ProcessPoolExecutor:
+    """Process pool shared by all sharded jobs, created on first use."""
+    global _executor
+    if _executor is None:
+        workers = int(os.getenv("ETL_PARSE_PROCESSES", "0")) or os.cpu_count() or 1
+        _executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+    return _executor
+
+
+def shutdown_executor():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+
+def read_header(path: str) -> Tuple[List[str], int]:
+    """Return (header columns, byte offset of the first data row)."""
+    with open(path, "rb") as f:
+        line = f.readline()
+    header = next(csv.reader([line.decode("utf-8-sig")]), [])
+    return header, len(line)
+
+
+def _next_line_start(f, pos: int, end: int) -> int:
+    """First offset >= pos that starts a line (pos itself if it follows a newline)."""
+    if pos >= end:
+        return end
+    f.seek(pos - 1)
+    if f.read(1) == b"\n":
+        return pos
+    f.readline()
+    return min(f.tell(), end)
+
+
+def plan_shards(path: str, shards: int, piece_bytes: int) -> Tuple[List[str], List[List[Tuple[int, int]]]]:
+    """
+    Split the data section of a CSV into `shards` line-aligned ranges, each
+    further cut into pieces of about piece_bytes (one parse task each).
+    Returns (header, [[(start, end), ...] per shard]).
+    """
+    header, data_start = read_header(path)
+    size = os.path.getsize(path)
+    shards = max(1, shards)
+    span = max(1, (size - data_start) // shards)
+    out: List[List[Tuple[int, int]]] = []
+    with open(path, "rb") as f:
+        bounds = [data_start]
+        for i in range(1, shards):
+            bounds.append(_next_line_start(f, data_start + i * span, size))
+        bounds.append(size)
+        for s, e in zip(bounds, bounds[1:]):
+            if s >= e:
+                continue
+            pieces, pos = [], s
+            while pos < e:
+                nxt = _next_line_start(f, min(pos + piece_bytes, e), e)
+                pieces.append((pos, nxt))
+                pos = nxt
+            out.append(pieces)
+    return header, out
+
+
+def read_range(path: str, start: int, end: int) -> List[List[str]]:
+    """The CSV rows in [start, end), blank lines skipped."""
+    with open(path, "rb") as f:
+        f.seek(start)
+        text = f.read(end - start).decode("utf-8")
+    return [r for r in csv.reader(io.StringIO(text, newline="")) if r]
+
+
+def parse_range(path: str, start: int, end: int, header: List[str]) -> Dict[str, list]:
+    """Parse the rows in [start, end) into a batchparse column batch (runs in a worker process)."""
+    return batchparse.parse_batch(batchparse.columns_from_lists(header, read_range(path, start, end)))
@@ -0,0 +1,282 @@
+# etl-service/src/snapshots.py
+"""
+Parquet snapshot of the loaded facts for analytical scans (ETL_SNAPSHOT_DIR).
+
+Each job writes the rows it committed, taken from the column batches the
+load path already holds (no query against fact_measurement). Files are
+Hive-partitioned by study and month of ts:
+
+    <ETL_SNAPSHOT_DIR>/study_id=<study>/month=<YYYY-MM>/part-<ns>-<job>.parquet
+
+so pyarrow.dataset, pandas, DuckDB or Spark prune by study and month from
+the path alone. Study and job ids are percent-encoded in paths (readers
+of Hive partitions decode them), so no id can reach outside the directory. Inside a file, the dimension columns (participant, site,
+measurement type, unit, source file) are dictionary-encoded, and every
+row group is sorted by ts and carries min/max statistics, so a time range
+skips row groups too.
+
+Snapshots are incremental. A job appends one new file per partition it
+touched and never rewrites existing ones. Its files are written under a
+temporary name and renamed when the job ends, so readers never see a
+partial file. Rows of a chunk that rolled back are never written: a
+chunk is added after it committed, minus the rows quarantine rejected and
+the rows the upsert left alone (keys already loaded, see dedupe.py).
+A failed detached load attached nothing, so its files are dropped.
+
+Compaction rewrites a partition's files as one file, sorted by ts and
+participant. It also keeps only the last copy of each natural key
+(participant, measurement type, ts): since only written rows are added,
+that is the copy a dedupe=update load wrote last, as in fact_measurement. It runs after a job leaves a partition
+with more than COMPACT_FILES files, and on demand with
+POST /studies/{study_id}/snapshot. A process that dies mid-job leaves
+only temporary files behind. That job's rows are then missing from the
+snapshot, and the rows its resumed run loads are appended as usual.
+
+Needs pyarrow; without it (or with ETL_SNAPSHOT_DIR unset) nothing is written.
+"""
+import asyncio
+import os
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, List, Optional, Sequence, Set, Tuple
+from urllib.parse import quote, unquote
+
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # optional: snapshots are off without it
+    pa = None
+
+ROOT = os.getenv("ETL_SNAPSHOT_DIR", "")
+ROW_GROUP_ROWS = int(os.getenv("ETL_SNAPSHOT_ROW_GROUP_ROWS", "65536"))
+COMPACT_FILES = int(os.getenv("ETL_SNAPSHOT_COMPACT_FILES", "16"))
+
+DICTIONARY_COLUMNS = ["participant_id", "site_id", "measurement_type", "unit", "source_file"]
+NATURAL_KEY = ["participant_id", "measurement_type", "ts"]
+TMP_SUFFIX = ".tmp"
+
+
+def enabled() -> bool:
+    return bool(ROOT) and pa is not None
+
+
+def schema():
+    return pa.schema([
+        ("participant_id", pa.string()), ("site_id", pa.string()),
+        ("measurement_type", pa.string()), ("unit", pa.string()),
+        ("value", pa.float64()), ("systolic", pa.int16()), ("diastolic", pa.int16()),
+        ("quality_score", pa.float64()), ("is_valid", pa.bool_()),
+        ("quality_flags", pa.list_(pa.string())),
+        ("ts", pa.timestamp("us", tz="UTC")), ("source_file", pa.string()),
+    ])
+
+
+def _segment(value: str) -> str:
+    # path separators are escaped too, so a segment is always one path component
+    return quote(value, safe="")
+
+
+def study_dir(root: str, study_id: str) -> str:
+    path = os.path.join(root, f"study_id={_segment(study_id)}")
+    top = os.path.realpath(root)
+    if os.path.dirname(os.path.realpath(path)) != top:
+        raise ValueError(f"study {study_id!r} does not map to a directory under {root}")
+    return path
+
+
+def partition_dir(root: str, study_id: str, month: str) -> str:
+    return os.path.join(study_dir(root, study_id), f"month={_segment(month)}")
+
+
+def _open_writer(path: str):
+    return pq.ParquetWriter(path, schema(), use_dictionary=DICTIONARY_COLUMNS, write_statistics=True,
+                            compression="zstd")
+
+
+def _write_sorted(writer, table, sort_by):
+    """Write table in ROW_GROUP_ROWS row groups, each sorted by sort_by (for tight ts statistics)."""
+    for lo in range(0, table.num_rows, ROW_GROUP_ROWS):
+        writer.write_table(table.slice(lo, ROW_GROUP_ROWS).sort_by(sort_by))
+
+
+class SnapshotWriter:
+    """Files one job adds to the snapshot; add() is called from worker threads."""
+
+    def __init__(self, root: str, job_id: str):
+        self.root = root
+        self.job_id = job_id
+        self.buffers: Dict[Tuple[str, str], List[Any]] = {}
+        self.buffered: Dict[Tuple[str, str], int] = {}
+        self.writers: Dict[Tuple[str, str], Any] = {}
+        self.rows = 0
+        self.error: Optional[str] = None
+        self._lock = threading.Lock()
+
+    def _tmp_path(self, key: Tuple[str, str]) -> str:
+        return os.path.join(partition_dir(self.root, *key), f"part-{_segment(self.job_id)}.parquet{TMP_SUFFIX}")
+
+    def add(self, cols: Dict[str, Sequence], rows: Sequence[int]):
+        """Buffer the given rows of a column batch (parse_batch layout); full row groups are written out."""
+        if not len(rows) or self.error:
+            return
+        rows = np.asarray(rows, dtype=np.intp)
+        pick = lambda name: [cols[name][i] for i in rows]
+        ts = pa.array(pick("ts"), pa.timestamp("us", tz="UTC"))
+        table = pa.table({
+            "participant_id": pa.array(pick("participant_id"), pa.string()),
+            "site_id": pa.array(pick("site_id"), pa.string()),
+            "measurement_type": pa.array(pick("measurement_type"), pa.string()),
+            "unit": pa.array(pick("unit"), pa.string()),
+            "value": pa.array(pick("value_numeric"), pa.float64()),
+            "systolic": pa.array(pick("systolic"), pa.int16()),
+            "diastolic": pa.array(pick("diastolic"), pa.int16()),
+            "quality_score": pa.array(pick("quality_score"), pa.float64()),
+            "is_valid": pa.array(pick("is_valid"), pa.bool_()),
+            "quality_flags": pa.array([list(f) for f in pick("flags")], pa.list_(pa.string())),
+            "ts": ts,
+            "source_file": pa.array(pick("source_file"), pa.string()),
+        }, schema=schema())
+        months = ts.to_numpy(zero_copy_only=False).astype("datetime64[M]").astype(str)
+        study_codes, study_names = pd.factorize(np.asarray(pick("study_id"), dtype=object))
+        month_names, month_codes = np.unique(months, return_inverse=True)
+        keys = study_codes * len(month_names) + month_codes
+        with self._lock:
+            for key in np.unique(keys):
+                part = table.filter(pa.array(keys == key))
+                pkey = (study_names[key // len(month_names)], str(month_names[key % len(month_names)]))
+                self.buffers.setdefault(pkey, []).append(part)
+                self.buffered[pkey] = self.buffered.get(pkey, 0) + part.num_rows
+                if self.buffered[pkey] >= ROW_GROUP_ROWS:
+                    self._flush(pkey)
+            self.rows += table.num_rows
+
+    def _flush(self, key: Tuple[str, str]):
+        parts = self.buffers.pop(key, None)
+        self.buffered.pop(key, None)
+        if not parts:
+            return
+        writer = self.writers.get(key)
+        if writer is None:
+            os.makedirs(partition_dir(self.root, *key), exist_ok=True)
+            writer = self.writers[key] = _open_writer(self._tmp_path(key))
+        _write_sorted(writer, pa.concat_tables(parts), "ts")
+
+    def close(self, publish: bool = True) -> List[Tuple[str, str]]:
+        """Write what is buffered and publish (or drop) this job's files; returns the partitions published."""
+        with self._lock:
+            if publish and not self.error:
+                for key in list(self.buffers):
+                    self._flush(key)
+            for w in self.writers.values():
+                w.close()
+            published = []
+            for key in self.writers:
+                tmp = self._tmp_path(key)
+                if publish and not self.error:
+                    # named by publish time, so compaction can tell which copy of a row is newest
+                    os.replace(tmp, os.path.join(partition_dir(self.root, *key),
+                                                 f"part-{time.time_ns()}-{_segment(self.job_id)}.parquet"))
+                    published.append(key)
+                else:
+                    os.remove(tmp)
+            self.writers.clear()
+            self.buffers.clear()
+            return published
+
+
+_current: ContextVar[Optional[SnapshotWriter]] = ContextVar("etl_job_snapshot", default=None)
+_compacting: Dict[str, threading.Lock] = {}
+
+
+@contextmanager
+def job_scope(job_id: str):
+    """Snapshot the chunks committed inside the block (and tasks it starts); yields None when snapshots are off."""
+    w = SnapshotWriter(ROOT, job_id) if enabled() else None
+    token = _current.set(w)
+    try:
+        yield w
+    finally:
+        _current.reset(token)
+
+
+async def add(cols: Dict[str, Sequence], rejected: Set[int], filename: str = ""):
+    """Snapshot a committed chunk of the job running in this task: every row not in `rejected`."""
+    w = _current.get()
+    if w is None or w.error:
+        return
+    n = len(cols["study_id"])
+    rows = [i for i in range(n) if i not in rejected] if rejected else range(n)
+    if "source_file" not in cols:
+        cols = {**cols, "source_file": [filename] * n}
+    try:
+        await asyncio.to_thread(w.add, cols, rows)
+    except Exception as e:  # the load goes on; the job reports the snapshot as incomplete
+        w.error = str(e)
+        print(f"[ETL] snapshot of job {w.job_id} stopped: {e}", flush=True)
+
+
+async def finish(w: Optional[SnapshotWriter], publish: bool = True) -> Dict[str, Any]:
+    """Publish a job's files and compact the partitions that have too many; job fields to record."""
+    if w is None:
+        return {}
+    try:
+        published = await asyncio.to_thread(w.close, publish)
+        for study_id, month in published:
+            if len(_parts(partition_dir(w.root, study_id, month))) > COMPACT_FILES:
+                await asyncio.to_thread(compact_partition, w.root, study_id, month)
+    except Exception as e:
+        w.error = w.error or str(e)
+        print(f"[ETL] snapshot of job {w.job_id} failed: {e}", flush=True)
+        return {"snapshot": {"rows": w.rows, "error": w.error}}
+    if w.error:
+        return {"snapshot": {"rows": w.rows, "error": w.error}}
+    return {"snapshot": {"rows": w.rows if publish else 0,
+                         "partitions": [f"study_id={s}/month={m}" for s, m in published]}}
+
+
+def _parts(directory: str) -> List[str]:
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return []
+    return sorted(n for n in names if n.startswith("part-") and n.endswith(".parquet"))
+
+
+def compact_partition(root: str, study_id: str, month: str) -> Dict[str, Any]:
+    """Rewrite one partition's files as one, keeping the newest row per natural key."""
+    directory = partition_dir(root, study_id, month)
+    with _compacting.setdefault(directory, threading.Lock()):
+        parts = _parts(directory)
+        if len(parts) < 2:
+            return {"month": month, "files": len(parts), "rows": None}
+        tables = [pq.read_table(os.path.join(directory, n), schema=schema()) for n in parts]
+        table = pa.concat_tables(tables)
+        before = table.num_rows
+        # newest copy of a key wins: files are in publish order, rows in load order within a file
+        keep = ~table.select(NATURAL_KEY).to_pandas().duplicated(keep="last").to_numpy()
+        table = table.filter(pa.array(keep)).sort_by([("ts", "ascending"), ("participant_id", "ascending")])
+        # named after the newest file it replaces, so files published meanwhile still sort after it
+        name = f"part-{parts[-1].split('-')[1]}-compacted.parquet"
+        tmp = os.path.join(directory, name + TMP_SUFFIX)
+        with _open_writer(tmp) as writer:
+            for lo in range(0, table.num_rows, ROW_GROUP_ROWS):
+                writer.write_table(table.slice(lo, ROW_GROUP_ROWS))
+        os.replace(tmp, os.path.join(directory, name))
+        for n in parts:
+            os.remove(os.path.join(directory, n))
+        return {"month": month, "files": len(parts), "rows": table.num_rows, "duplicatesDropped": before - table.num_rows}
+
+
+def compact_study(study_id: str, root: Optional[str] = None) -> List[Dict[str, Any]]:
+    """compact_partition for every month of a study (POST /studies/{study_id}/snapshot)."""
+    root = root or ROOT
+    directory = study_dir(root, study_id)
+    if not os.path.isdir(directory):
+        return []
+    months = sorted(unquote(d[len("month="):]) for d in os.listdir(directory) if d.startswith("month="))
+    return [compact_partition(root, study_id, m) for m in months]
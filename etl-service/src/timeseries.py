@@ -0,0 +1,327 @@
+# etl-service/src/timeseries.py
+"""
+Downsampled time series of one participant and measurement type
+(GET /studies/{study_id}/participants/{participant_id}/series).
+
+The rows come from one range scan of idx_fact_study_part_ts (study,
+participant, ts DESC), filtered to the type. They are reduced on the server
+to at most `points` points per series, so a chart of two years of readings
+gets a few hundred points instead of every row. Each of value_numeric,
+systolic and diastolic that has readings is its own series. There are two
+methods:
+
+- lttb (default): Largest-Triangle-Three-Buckets. It keeps the shape of the
+  line with one point per bucket of equal row count.
+- minmax: the lowest and highest reading of each of points/2 equal-time
+  buckets, so no spike is lost.
+
+Responses are kept JSON-encoded in an LRU (SeriesCache) bounded in bytes and
+keyed by participant, type, range, points and method. A repeat view is
+served without a query or any encoding. When a chunk commits, loaded()
+drops the entries of the participants it had rows for. A job also drops
+them once more when it ends, which covers a detached load's rows that only
+become visible when its partitions are attached. A query that was running
+while its participant got new rows does not store its result. The cache is
+per process. Loads run by another replica are only seen once an entry is
+older than ETL_SERIES_CACHE_SECONDS, so set that when several replicas load.
+"""
+import asyncio
+import json
+import os
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Set, Tuple
+
+import numpy as np
+
+import db
+from dimcache import dim_cache
+
+DEFAULT_POINTS = 500
+MAX_POINTS = int(os.getenv("ETL_SERIES_MAX_POINTS", "5000"))
+METHODS = ("lttb", "minmax")
+SERIES = ("value", "systolic", "diastolic")
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+# open ends of the range, as bounds the index scan can use
+EARLIEST = datetime(1, 1, 1, tzinfo=timezone.utc)
+LATEST = datetime(9999, 12, 31, tzinfo=timezone.utc)
+
+SELECT_SERIES = """
+SELECT (extract(epoch FROM ts) * 1000000)::int8 AS us, unit_id,
+       coalesce(value_numeric::float8, 'NaN') AS value,
+       coalesce(systolic::float8, 'NaN') AS systolic,
+       coalesce(diastolic::float8, 'NaN') AS diastolic
+FROM fact_measurement
+WHERE study_id = $1 AND participant_id = $2 AND ts >= $3 AND ts < $4
+  AND measurement_type_id = $5
+ORDER BY ts DESC;
+"""
+
+Pair = Tuple[str, str]
+Key = Tuple[str, str, str, Optional[datetime], Optional[datetime], int, str]
+
+
+class SeriesError(ValueError):
+    """Bad series request (unknown type or method, bad range, ...)."""
+
+
+# ----------------------------------------------------------------------
+# Downsampling: both return the indices of the points to keep, in order
+# ----------------------------------------------------------------------
+def lttb(x: np.ndarray, y: np.ndarray, n: int) -> np.ndarray:
+    """Largest-Triangle-Three-Buckets: first and last point, and one point per bucket in between."""
+    m = len(x)
+    if n >= m or n < 3:
+        return np.arange(m)
+    x = (x - x[0]).astype(np.float64)
+    edges = np.linspace(1, m - 1, n - 1).astype(np.intp)  # n-2 buckets between the end points
+    out = np.empty(n, dtype=np.intp)
+    out[0], out[-1] = 0, m - 1
+    a = 0
+    for i in range(n - 2):
+        lo, hi = edges[i], edges[i + 1]
+        if i == n - 3:
+            cx, cy = x[-1], y[-1]
+        else:
+            cx, cy = x[hi:edges[i + 2]].mean(), y[hi:edges[i + 2]].mean()
+        # twice the area of the triangle (last kept point, candidate, next bucket's centre)
+        area = np.abs((x[a] - cx) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (cy - y[a]))
+        a = lo + int(area.argmax())
+        out[i + 1] = a
+    return out
+
+
+def minmax(x: np.ndarray, y: np.ndarray, n: int) -> np.ndarray:
+    """The lowest and highest point of each of n/2 equal-time buckets."""
+    m = len(x)
+    if n >= m:
+        return np.arange(m)
+    buckets = max(1, n // 2)
+    b = (x - x[0]) * buckets // (x[-1] - x[0] + 1)
+    starts = np.flatnonzero(np.r_[True, b[1:] != b[:-1]])  # x is sorted, so a bucket is one run
+    counts = np.diff(np.r_[starts, m])
+    lows = _first_per_run(np.repeat(np.minimum.reduceat(y, starts), counts) == y, b)
+    highs = _first_per_run(np.repeat(np.maximum.reduceat(y, starts), counts) == y, b)
+    return np.unique(np.r_[lows, highs])
+
+
+def _first_per_run(mask: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """Index of the first True of each bucket run in b."""
+    hit = np.flatnonzero(mask)
+    hb = b[hit]
+    return hit[np.r_[True, hb[1:] != hb[:-1]]]
+
+
+DOWNSAMPLE = {"lttb": lttb, "minmax": minmax}
+
+
+# ----------------------------------------------------------------------
+# Cache
+# ----------------------------------------------------------------------
+class _Fill:
+    """A query in flight for a participant; loaded() marks it stale."""
+    __slots__ = ("stale",)
+
+    def __init__(self):
+        self.stale = False
+
+
+class SeriesCache:
+    """LRU of encoded series responses, bounded in bytes and dropped per (study, participant) on load."""
+
+    def __init__(self, max_bytes: int = 64 << 20, max_age: float = 0.0):
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.entries: "OrderedDict[Key, Tuple[bytes, float]]" = OrderedDict()
+        self.by_participant: Dict[Pair, Set[Key]] = {}
+        self.filling: Dict[Pair, Set[_Fill]] = {}
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key: Key) -> Optional[bytes]:
+        entry = self.entries.get(key)
+        if entry is not None and self.max_age and time.monotonic() - entry[1] > self.max_age:
+            self._drop(key)
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    @contextmanager
+    def fill(self, pair: Pair):
+        """Register a query for `pair`; put() ignores its result if the participant was loaded meanwhile."""
+        f = _Fill()
+        self.filling.setdefault(pair, set()).add(f)
+        try:
+            yield f
+        finally:
+            waiting = self.filling[pair]
+            waiting.discard(f)
+            if not waiting:
+                del self.filling[pair]
+
+    def put(self, key: Key, body: bytes, fill: _Fill):
+        if fill.stale or len(body) > self.max_bytes:
+            return
+        if key in self.entries:
+            self._drop(key)
+        self.entries[key] = (body, time.monotonic())
+        self.by_participant.setdefault(key[:2], set()).add(key)
+        self.bytes += len(body)
+        while self.bytes > self.max_bytes:
+            self._drop(next(iter(self.entries)))
+            self.evictions += 1
+
+    def _drop(self, key: Key):
+        body, _ = self.entries.pop(key)
+        self.bytes -= len(body)
+        keys = self.by_participant[key[:2]]
+        keys.discard(key)
+        if not keys:
+            del self.by_participant[key[:2]]
+
+    def invalidate(self, pairs: Iterable[Pair]):
+        for pair in pairs:
+            for f in self.filling.get(pair, ()):
+                f.stale = True
+            for key in list(self.by_participant.get(pair, ())):
+                self._drop(key)
+                self.invalidations += 1
+
+    def clear(self):
+        self.entries.clear()
+        self.by_participant.clear()
+        self.bytes = 0
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "entries": len(self.entries),
+            "bytes": self.bytes,
+            "maxBytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
+
+
+series_cache = SeriesCache(int(float(os.getenv("ETL_SERIES_CACHE_MB", "64")) * (1 << 20)),
+                           float(os.getenv("ETL_SERIES_CACHE_SECONDS", "0")))
+
+_touched: ContextVar[Optional[Set[Pair]]] = ContextVar("etl_job_series_touched", default=None)
+
+
+@contextmanager
+def job_scope():
+    """Drop the cached series of every participant the block loaded once more when it ends."""
+    touched: Set[Pair] = set()
+    token = _touched.set(touched)
+    try:
+        yield touched
+    finally:
+        _touched.reset(token)
+        series_cache.invalidate(touched)
+
+
+def loaded(cols: Dict[str, Sequence], rejected: Set[int] = frozenset()):
+    """A chunk committed: drop the cached series of the participants it loaded rows for."""
+    pairs = set(zip(cols["study_id"], cols["participant_id"]))
+    if rejected:
+        pairs = {(s, p) for i, (s, p) in enumerate(zip(cols["study_id"], cols["participant_id"]))
+                 if i not in rejected}
+    series_cache.invalidate(pairs)
+    touched = _touched.get()
+    if touched is not None:
+        touched |= pairs
+
+
+# ----------------------------------------------------------------------
+# Request
+# ----------------------------------------------------------------------
+def _parse_time(name: str, value: Optional[str]) -> Optional[datetime]:
+    if value is None:
+        return None
+    try:
+        when = datetime.fromisoformat(value)
+    except ValueError:
+        raise SeriesError(f"{name} is not an ISO timestamp: {value}")
+    if when.tzinfo is None:
+        raise SeriesError(f"{name} needs a UTC offset")
+    return when.astimezone(timezone.utc)
+
+
+async def parse_request(measurement_type: str, start: Optional[str], end: Optional[str],
+                        points: int, method: str) -> Tuple[int, Optional[datetime], Optional[datetime]]:
+    """The measurement type id and the range as UTC datetimes (None for an open end)."""
+    if method not in DOWNSAMPLE:
+        raise SeriesError(f"method must be one of {list(METHODS)}")
+    if not 3 <= points <= MAX_POINTS:
+        raise SeriesError(f"points must be between 3 and {MAX_POINTS}")
+    start, end = _parse_time("from", start), _parse_time("to", end)
+    if start and end and start >= end:
+        raise SeriesError("from must be before to")
+    if measurement_type not in dim_cache.measurement_types:
+        async with db.acquire() as conn:
+            await dim_cache.load_names(conn)
+        if measurement_type not in dim_cache.measurement_types:
+            raise SeriesError(f"unknown measurement type: {measurement_type}")
+    return dim_cache.measurement_types[measurement_type], start, end
+
+
+def _iso(us: np.ndarray) -> List[str]:
+    return [(EPOCH + timedelta(microseconds=int(u))).isoformat() for u in us]
+
+
+def render(rows: Sequence[Any], head: Dict[str, Any], points: int, method: str) -> bytes:
+    """The response body: every series of `rows` (newest first) downsampled to `points`."""
+    n = len(rows)
+    x = np.fromiter((r["us"] for r in reversed(rows)), dtype=np.int64, count=n)
+    out = {}
+    for name in SERIES:
+        # NULL comes back as NaN (see SELECT_SERIES), so each column is one flat float read
+        y = np.fromiter((r[name] for r in reversed(rows)), dtype=np.float64, count=n)
+        has = ~np.isnan(y)
+        if not has.any():
+            continue
+        sx, sy = x[has], y[has]
+        keep = DOWNSAMPLE[method](sx, sy, points)
+        values = sy[keep].tolist() if name == "value" else sy[keep].astype(int).tolist()
+        out[name] = [list(p) for p in zip(_iso(sx[keep]), values)]
+    body = {**head, "method": method, "points": points, "rows": n, "series": out}
+    return json.dumps(body, separators=(",", ":")).encode()
+
+
+async def series(study_id: str, participant_id: str, measurement_type: str, type_id: int,
+                 start: Optional[datetime], end: Optional[datetime], points: int,
+                 method: str) -> Tuple[bytes, bool]:
+    """(JSON body, served from cache) for one participant's series."""
+    key = (study_id, participant_id, measurement_type, start, end, points, method)
+    body = series_cache.get(key)
+    if body is not None:
+        return body, True
+    with series_cache.fill((study_id, participant_id)) as fill:
+        async with db.acquire() as conn:
+            rows = await conn.fetch(SELECT_SERIES, study_id, participant_id, start or EARLIEST,
+                                    end or LATEST, type_id)
+            _, unit_names = dim_cache.names()
+            if rows and rows[0]["unit_id"] not in unit_names:
+                await dim_cache.load_names(conn)
+                _, unit_names = dim_cache.names()
+        head = {
+            "studyId": study_id, "participantId": participant_id, "measurementType": measurement_type,
+            "unit": unit_names.get(rows[0]["unit_id"]) if rows else None,
+            "from": start.isoformat() if start else None, "to": end.isoformat() if end else None,
+        }
+        body = await asyncio.to_thread(render, rows, head, points, method)
+        series_cache.put(key, body, fill)
+    return body, False
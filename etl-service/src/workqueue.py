@@ -0,0 +1,251 @@
+# etl-service/src/workqueue.py
+"""
+Postgres work queue shared by every ETL replica (ETL_WORK_QUEUE=postgres).
+
+With the queue on, POST /jobs and POST /batches do not run the job on the
+replica that received the call. They write the job to etl_jobs and an item
+to etl_work_queue in one transaction. Each replica runs a WorkQueue loop
+that claims items with SELECT ... FOR UPDATE SKIP LOCKED, so replicas never
+block on or double-claim an item. It claims only while its JobScheduler has
+a free slot, so busy replicas leave work to idle ones.
+
+A claimed item carries a lease. The worker renews it every lease/3
+seconds, and the chunk transactions of the job renew it as well (see
+guard()). A worker that finds its lease gone (it stalled past the lease and
+another replica took the item) cancels the job and drops it locally
+without writing its status. Because the lease check runs inside every
+chunk's transaction, a stalled worker cannot commit a chunk after losing
+the item. An item whose lease expires goes back to the queue and is
+claimed again, up to ETL_QUEUE_MAX_ATTEMPTS times. It then resumes from its
+file checkpoints like any restarted job. Items that run out of attempts are
+failed, and so are their jobs.
+
+The default (ETL_WORK_QUEUE=local) keeps the original behaviour: the job
+runs in the receiving replica's background tasks.
+"""
+import asyncio
+import json
+import os
+import socket
+from contextvars import ContextVar
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+import db
+from checkpoint import CheckpointLost
+from jobstore import SELECT_JOB, UPSERT_JOB, from_row, job_store, to_params
+
+MODE = os.getenv("ETL_WORK_QUEUE", "local")  # local | postgres
+LEASE_SECONDS = float(os.getenv("ETL_LEASE_SECONDS", "30"))
+POLL_SECONDS = float(os.getenv("ETL_QUEUE_POLL_SECONDS", "1.0"))
+MAX_ATTEMPTS = int(os.getenv("ETL_QUEUE_MAX_ATTEMPTS", "3"))
+WORKER_ID = os.getenv("ETL_WORKER_ID") or f"{socket.gethostname()}:{os.getpid()}"
+
+TABLE = "etl_work_queue"
+
+ENQUEUE = f"""
+INSERT INTO {TABLE} (job_id, kind, args) VALUES ($1, $2, $3::jsonb) RETURNING id;
+"""
+
+# oldest claimable item: queued, or running on a lease that has expired
+CLAIM = f"""
+UPDATE {TABLE} q
+SET status = 'running', worker = $1, attempts = q.attempts + 1,
+    lease_until = NOW() + make_interval(secs => $2), updated_at = NOW()
+WHERE q.id = (
+  SELECT id FROM {TABLE}
+  WHERE (status = 'queued' OR (status = 'running' AND lease_until < NOW()))
+    AND attempts < $3
+  ORDER BY id
+  FOR UPDATE SKIP LOCKED
+  LIMIT 1
+)
+RETURNING q.id, q.job_id, q.kind, q.args, q.attempts;
+"""
+
+RENEW = f"""
+UPDATE {TABLE} SET lease_until = NOW() + make_interval(secs => $3), updated_at = NOW()
+WHERE id = $1 AND worker = $2 AND status = 'running';
+"""
+
+FINISH = f"""
+UPDATE {TABLE} SET status = $3, lease_until = NULL, updated_at = NOW()
+WHERE id = $1 AND worker = $2 AND status = 'running';
+"""
+
+# expired items without attempts left fail, and so do their jobs
+REAP = f"""
+WITH dead AS (
+  UPDATE {TABLE} SET status = 'failed', updated_at = NOW()
+  WHERE status = 'running' AND lease_until < NOW() AND attempts >= $1
+  RETURNING job_id, worker
+)
+UPDATE etl_jobs j
+SET status = 'failed', message = 'worker lost: ' || dead.worker, updated_at = NOW()
+FROM dead WHERE j.id = dead.job_id
+RETURNING j.id;
+"""
+
+
+def enabled() -> bool:
+    return MODE == "postgres"
+
+
+class LeaseLost(CheckpointLost):
+    """Another worker took this job's queue item over; the current worker must stop."""
+
+
+_lease: ContextVar[Optional[Tuple[int, str]]] = ContextVar("etl_work_lease", default=None)
+
+
+def guard() -> Optional[Callable[[Any], Awaitable[None]]]:
+    """
+    Lease check for the chunk transactions of the job running in this task
+    (None outside a claimed item): renews the lease, or raises LeaseLost so
+    the transaction rolls back.
+    """
+    lease = _lease.get()
+    if lease is None:
+        return None
+    item_id, worker = lease
+
+    async def renew(conn):
+        if await conn.execute(RENEW, item_id, worker, LEASE_SECONDS) != "UPDATE 1":
+            raise LeaseLost(f"work item {item_id} was taken over by another worker")
+    return renew
+
+
+class WorkQueue:
+    """Claim loop of one replica; see module docstring."""
+
+    def __init__(self, worker_id: str = WORKER_ID, lease_seconds: float = LEASE_SECONDS,
+                 poll_seconds: float = POLL_SECONDS, max_attempts: int = MAX_ATTEMPTS):
+        self.worker_id = worker_id
+        self.lease_seconds = lease_seconds
+        self.poll_seconds = poll_seconds
+        self.max_attempts = max_attempts
+        self.handlers: Dict[str, Callable[..., Awaitable[Any]]] = {}
+        self.active: Dict[int, asyncio.Task] = {}
+        self.pending = 0  # claimed items whose job has not reached the scheduler yet
+        self.claimed = 0
+        self.finished = 0
+        self.lost = 0
+        self.reaped = 0
+        self._task: Optional[asyncio.Task] = None
+
+    def register(self, kind: str, handler: Callable[..., Awaitable[Any]]):
+        """handler(job_id, **args) runs the items of this kind."""
+        self.handlers[kind] = handler
+
+    async def submit(self, job: Dict[str, Any], kind: str, args: Dict[str, Any]) -> int:
+        """Persist the job and queue it, atomically; any replica may run it."""
+        async with db.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute(UPSERT_JOB, *to_params(job))
+                return await conn.fetchval(ENQUEUE, job["jobId"], kind, json.dumps(args))
+
+    # ------------------------------------------------------------------
+    # Claim loop
+    # ------------------------------------------------------------------
+    def start(self, slots: Callable[[], int]):
+        """Start claiming; slots() is how many more jobs this replica can run now."""
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._loop(slots))
+
+    async def stop(self):
+        tasks = [t for t in (self._task, *self.active.values()) if t is not None]
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._task = None
+        self.active.clear()
+
+    async def _loop(self, slots: Callable[[], int]):
+        while True:
+            try:
+                async with db.acquire() as conn:
+                    self.reaped += len(await conn.fetch(REAP, self.max_attempts))
+                    while slots() - self.pending > 0:
+                        row = await conn.fetchrow(CLAIM, self.worker_id, self.lease_seconds, self.max_attempts)
+                        if row is None:
+                            break
+                        self.claimed += 1
+                        self.pending += 1
+                        self.active[row["id"]] = asyncio.get_running_loop().create_task(self._run(row))
+            except Exception as e:
+                print(f"[ETL] work queue: claim failed: {e}", flush=True)
+            await asyncio.sleep(self.poll_seconds)
+
+    async def _load_job(self, job_id: str, attempt: int) -> Dict[str, Any]:
+        async with db.acquire() as conn:
+            row = await conn.fetchrow(SELECT_JOB, job_id)
+        job = from_row(row) if row is not None else {"jobId": job_id}
+        job.update(worker=self.worker_id, attempt=attempt)
+        return job_store.create(job)
+
+    async def _run(self, row):
+        item_id, job_id = row["id"], row["job_id"]
+        args = row["args"]
+        args = json.loads(args) if isinstance(args, str) else dict(args or {})
+        lost = asyncio.Event()
+        token = _lease.set((item_id, self.worker_id))
+        status: Optional[str] = "done"
+        try:
+            try:
+                await self._load_job(job_id, row["attempts"])
+            finally:
+                self.pending -= 1
+            job = asyncio.get_running_loop().create_task(self.handlers[row["kind"]](job_id, **args))
+            beat = asyncio.get_running_loop().create_task(self._heartbeat(item_id, job, lost))
+            try:
+                await job
+            finally:
+                beat.cancel()
+        except LeaseLost:
+            status = None  # a chunk transaction found the lease gone
+        except asyncio.CancelledError:
+            if not lost.is_set():
+                raise  # stop(): the lease runs out and another replica resumes the job
+            status = None
+        except Exception as e:
+            print(f"[ETL] work item {item_id} (job {job_id}) failed: {e}", flush=True)
+            status = "failed"
+        finally:
+            _lease.reset(token)
+            self.active.pop(item_id, None)
+        if status is None:
+            # the new owner reports this job from now on
+            self.lost += 1
+            job_store.forget(job_id)
+            print(f"[ETL] work item {item_id} (job {job_id}) lost its lease; dropped", flush=True)
+            return
+        async with db.acquire() as conn:
+            await conn.execute(FINISH, item_id, self.worker_id, status)
+        self.finished += 1
+
+    async def _heartbeat(self, item_id: int, job: asyncio.Task, lost: asyncio.Event):
+        while True:
+            await asyncio.sleep(self.lease_seconds / 3)
+            try:
+                async with db.acquire() as conn:
+                    renewed = await conn.execute(RENEW, item_id, self.worker_id, self.lease_seconds) == "UPDATE 1"
+            except Exception as e:
+                print(f"[ETL] work item {item_id}: heartbeat failed: {e}", flush=True)
+                continue  # the chunk transactions fail too if the database is gone
+            if not renewed:
+                lost.set()
+                job.cancel()
+                return
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "mode": MODE,
+            "worker": self.worker_id,
+            "active": len(self.active),
+            "claimed": self.claimed,
+            "finished": self.finished,
+            "lost": self.lost,
+            "reaped": self.reaped,
+        }
+
+
+work_queue = WorkQueue()
@@ -0,0 +1,118 @@
+# etl-service/tests/test_batches.py
+import asyncio
+from contextlib import asynccontextmanager
+
+import pytest
+from fastapi.testclient import TestClient
+
+import batches
+import main
+from checkpoint import Checkpoint
+from quarantine import ChunkRejects
+
+HEADER = "study_id,participant_id,measurement_type,value,unit,timestamp,site_id,quality_score\n"
+
+
+def write(path, rows, start=0):
+    path.write_text(HEADER + "".join(
+        f"S1,P{i:04d},glucose,95,mg/dL,2024-01-15T09:30:00Z,A,0.9\n" for i in range(start, start + rows)))
+
+
+class FakeConn:
+    def __init__(self):
+        self.statements = []
+
+    async def execute(self, sql, *args):
+        self.statements.append((sql, args))
+        return "UPDATE 1"
+
+
+def test_select_files_lists_then_globs_without_repeats(tmp_path):
+    for name in ("b.csv", "a.csv", "c.txt"):
+        write(tmp_path / name, 1)
+    (tmp_path / "sub").mkdir()
+    write(tmp_path / "sub" / "d.csv", 1)
+    assert batches.select_files(str(tmp_path), ["b.csv"], "**/*.csv") == ["b.csv", "a.csv", "sub/d.csv"]
+    with pytest.raises(batches.BatchError):
+        batches.select_files(str(tmp_path), ["../etc/passwd"])
+    with pytest.raises(batches.BatchError):
+        batches.select_files(str(tmp_path), ["missing.csv"])
+    with pytest.raises(batches.BatchError):
+        batches.select_files(str(tmp_path), pattern="../*.csv")
+
+
+def test_watcher_waits_for_a_stable_size(tmp_path):
+    write(tmp_path / "old.csv", 1)
+    w = batches.Watcher(str(tmp_path), "*.csv", ["old.csv"])
+    write(tmp_path / "new.csv", 1)
+    assert w.poll() == []
+    write(tmp_path / "new.csv", 2)  # still growing
+    assert w.poll() == []
+    assert w.poll() == ["new.csv"]
+    assert w.poll() == []
+
+
+def test_coalesced_rejects_map_back_to_their_files():
+    a, b = ChunkRejects("j", "a.csv", first_row=1), ChunkRejects("j", "b.csv", first_row=101)
+    c = batches.Coalescer()
+    entry_a, entry_b = batches.file_entry("a.csv", 1), batches.file_entry("b.csv", 1)
+    c.add({"study_id": ["S"] * 3}, batches.Segment(entry_a, None, 3, 3, a))
+    c.add({"study_id": ["S"] * 2}, batches.Segment(entry_b, None, 2, 102, b))
+    assert c.finish_file(entry_a) and not c.finish_file(batches.file_entry("x.csv", 1))
+    batch, segments, rejects = c.take()
+    assert len(batch["study_id"]) == 5 and [s.last for s in segments] == [True, False]
+    rejects.add(4, "bad")
+    rejects.subset([0, 2]).add(1, "worse")
+    assert [(r[1], r[2], r[5]) for r in rejects.records()] == [("a.csv", 3, "worse"), ("b.csv", 102, "bad")]
+    assert c.rows == 0 and c.parts == []
+
+
+def test_batch_coalesces_small_files_and_checkpoints_each(tmp_path, monkeypatch):
+    write(tmp_path / "a.csv", 3)
+    write(tmp_path / "b.csv", 4, start=3)
+    (tmp_path / "c.csv").write_text((tmp_path / "a.csv").read_text())  # same content as a.csv
+    write(tmp_path / "d.csv", 1, start=7)
+    conn = FakeConn()
+    loads = []
+
+    @asynccontextmanager
+    async def fake_acquire():
+        yield conn
+
+    async def fake_begin(job_id, path, filename, study_id, load_mode, detached=False):
+        return Checkpoint("sha256:" + open(path).read(), job_id)
+
+    async def fake_load_chunk(conn, batch, filename, before_commit=None, table=None, rejects=None):
+        loads.append(list(batch["source_file"]))
+        await before_commit(conn)
+        return len(batch["study_id"]), 0
+
+    monkeypatch.setattr(main.db, "acquire", fake_acquire)
+    monkeypatch.setattr(main.dim_cache, "warmed", True)
+    monkeypatch.setattr(main, "DATA_DIR", str(tmp_path))
+    monkeypatch.setattr(main, "CHUNK_SIZE", 5)
+    monkeypatch.setattr(main, "begin_checkpoint", fake_begin)
+    monkeypatch.setattr(main, "load_chunk", fake_load_chunk)
+    files = batches.select_files(str(tmp_path), pattern="*.csv")
+    main.jobs["batch-1"] = {"jobId": "batch-1", "files": [batches.file_entry(f, 1) for f in files]}
+    asyncio.run(main.process_batch("batch-1", None, None))
+
+    job = main.jobs["batch-1"]
+    assert job["status"] == "completed" and job["progress"] == 100
+    # a chunk is flushed once CHUNK_SIZE rows are buffered, so it spans the files
+    assert loads == [["a.csv"] * 3 + ["b.csv"] * 4, ["d.csv"]]
+    assert job["rowsProcessed"] == 8 and job["rowsInserted"] == 8
+    assert [(e["filename"], e["status"], e["rowsProcessed"]) for e in job["files"]] == [
+        ("a.csv", "completed", 3), ("b.csv", "completed", 4), ("c.csv", "skipped", 0), ("d.csv", "completed", 1)]
+    assert "same content as a.csv" in job["files"][2]["skippedBecause"]
+    # each chunk transaction advances the checkpoint of every file in it and completes the files
+    # it holds the end of; b.csv ended after its rows were flushed, so it completes on its own
+    marks = [args[2] if len(args) > 2 else "complete" for _, args in conn.statements]
+    assert marks == [3, "complete", 4, "complete", 1, "complete"]
+
+
+def test_submit_batch_validates(client: TestClient, monkeypatch, tmp_path):
+    monkeypatch.setattr(main, "DATA_DIR", str(tmp_path))
+    assert client.post("/batches", json={"glob": "*.csv"}).status_code == 400  # nothing matches
+    assert client.post("/batches", json={"watch": True}).status_code == 400
+    assert client.post("/batches", json={"files": ["../x.csv"]}).status_code == 400
@@ -0,0 +1,87 @@
+# etl-service/tests/test_batchparse.py
+import itertools
+import math
+import random
+
+import pytest
+
+import batchparse
+from parsing import NO_FLAGS, parse_row
+from quality import NON_NUMERIC_QUALITY, convert_to_canonical, range_flags
+
+MEAS = ["glucose", " Weight ", "height", "blood_pressure", "BLOOD_PRESSURE", "heart_rate", "unknown", ""]
+UNITS = ["mg/dL", "lb", "LBS", "kg", "in", "inches", "cm", "mmHg", "bpm", " mg/dL ", ""]
+VALUES = ["95.5", "150", " 72 ", "1e3", ".5", "5.", "+5", "-0", "1_000", "inf", "nan", "abc", "", None,
+          "120/80", " 130 / 85 ", "300/200", "12/8", "1200/80", "120-80", "0.1", "0.30000000000000004"]
+TIMESTAMPS = ["2024-01-15T09:30:00Z", "2024-01-15T09:30:00+02:00", "2024-01-15T09:30:00.5Z",
+              "2024-02-30T09:30:00Z", "2024-01-15", "not-a-date", "", None]
+
+def same(a, b):
+    if isinstance(a, float) and isinstance(b, float) and math.isnan(a) and math.isnan(b):
+        return True
+    return type(a) is type(b) and a == b
+
+def assert_same_records(rows):
+    expected = [parse_row(r) for r in rows]
+    got = batchparse.parse_rows(rows)
+    assert len(got) == len(expected)
+    for e, g in zip(expected, got):
+        assert e.keys() == g.keys()
+        for k in e:
+            assert same(e[k], g[k]), (k, e[k], g[k])
+            if k == "ts" and e[k] is not None:
+                assert e[k].utcoffset() == g[k].utcoffset()
+
+def test_parse_batch_matches_parse_row_on_edge_cases():
+    rows = [
+        {"study_id": " S1 ", "participant_id": "P1", "measurement_type": mt, "value": v,
+         "unit": u, "timestamp": ts, "site_id": None, "quality_score": q}
+        for (mt, u, v), ts, q in zip(
+            itertools.product(MEAS, UNITS, VALUES),
+            itertools.cycle(TIMESTAMPS),
+            itertools.cycle(["0.98", "", None, "1"]),
+        )
+    ]
+    assert_same_records(rows)
+
+def test_parse_batch_matches_parse_row_on_random_decimals():
+    rnd = random.Random(7)
+    rows = [
+        {"study_id": "S", "participant_id": f"P{i % 50}", "measurement_type": rnd.choice(["weight", "height", "glucose"]),
+         "value": repr(rnd.uniform(0, 500)), "unit": rnd.choice(["lb", "kg", "in", "cm", "mg/dL"]),
+         "timestamp": f"2024-01-{1 + i % 28:02d}T09:{i % 60:02d}:00Z", "site_id": "A", "quality_score": repr(rnd.random())}
+        for i in range(5000)
+    ]
+    assert_same_records(rows)
+
+def test_bad_quality_score_is_flagged_like_parse_row():
+    row = {"measurement_type": "glucose", "value": "1", "quality_score": "high"}
+    rec = parse_row(row)
+    assert rec["quality_score"] is None and NON_NUMERIC_QUALITY in rec["flags"]
+    assert batchparse.parse_rows([row, {**row, "quality_score": "0.5"}]) == [rec, parse_row({**row, "quality_score": "0.5"})]
+
+def test_canonicalize_batch_matches_quality_functions():
+    triples = [(mt, v, u) for mt, u, v in itertools.product(MEAS, UNITS, VALUES) if v is not None]
+    out = batchparse.canonicalize_batch(*zip(*triples))
+    for i, (mt, v, u) in enumerate(triples):
+        ok, payload, err = convert_to_canonical(mt, v, u)
+        assert out["ok"][i] == ok and out["err"][i] == err
+        for k in ("value_numeric", "systolic", "diastolic", "unit"):
+            assert same(out[k][i], payload.get(k)), (mt, v, u, k)
+        assert out["flags"][i] == (range_flags(payload, mt) if ok else [])
+
+def test_parsed_rows_are_compact_records_sharing_repeated_values():
+    rows = [{"study_id": "S1", "participant_id": f"P{i}", "measurement_type": " Glucose ", "value": "95",
+             "unit": "mg/dL", "timestamp": "2024-01-15T09:30:00Z", "site_id": "A", "quality_score": "1"}
+            for i in range(2)]
+    # fresh string objects per row, as csv.DictReader produces them
+    a, b = (parse_row({k: "".join(v) for k, v in r.items()}) for r in rows)
+    assert a.measurement_type is b.measurement_type and a.unit is b.unit and a.study_id is b.study_id
+    assert a["flags"] is b["flags"] is NO_FLAGS
+    assert not hasattr(a, "__dict__") and a.get("source_file") is None and a.get("nope", 1) == 1
+    a["source_file"] = "f.csv"
+    assert a["source_file"] == "f.csv"
+    with pytest.raises(KeyError):
+        a["nope"]
+    parsed = batchparse.parse_batch(batchparse.columns_from_rows(rows))
+    assert parsed["flags"][0] is NO_FLAGS and parsed["measurement_type"][0] is a.measurement_type
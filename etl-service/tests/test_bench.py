@@ -0,0 +1,39 @@
+# etl-service/tests/test_bench.py
+import csv
+import io
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "bench"))
+
+import bench_etl  # noqa: E402
+import gen_csv  # noqa: E402
+from parsing import parse_row  # noqa: E402
+
+def test_generator_honours_cardinality_and_invalid_ratio():
+    rows = list(csv.DictReader(io.StringIO(gen_csv.make_csv(20_000, participants=50, sites=4, invalid_ratio=0.1))))
+    assert len(rows) == 20_000
+    assert len({r["participant_id"] for r in rows}) == 50
+    assert len({r["site_id"] for r in rows}) == 4
+    recs = [parse_row(r) for r in rows]
+    bad = sum(1 for r in recs if not r["is_valid"] or r["ts"] is None)
+    assert 0.08 < bad / len(recs) < 0.12
+
+def test_generator_is_deterministic_per_seed():
+    assert gen_csv.make_csv(100, seed=1) == gen_csv.make_csv(100, seed=1)
+    assert gen_csv.make_csv(100, seed=1) != gen_csv.make_csv(100, seed=2)
+
+def test_compare_flags_only_regressions_beyond_tolerance():
+    baseline = {"parse/row": {"rowsPerSec": 100.0}, "e2e/bulk": {"rowsPerSec": 100.0}}
+    results = {"parse/row": {"rowsPerSec": 95.0}, "e2e/bulk": {"rowsPerSec": 80.0}, "load/row": {"rowsPerSec": 1.0}}
+    assert bench_etl.compare(results, baseline, tolerance=0.10) == ["e2e/bulk"]
+    assert results["parse/row"]["vsBaseline"] == 0.95
+    assert "vsBaseline" not in results["load/row"]
+
+def test_stages_run_against_the_stand_in(tmp_path):
+    path = tmp_path / "bench.csv"
+    path.write_text(gen_csv.make_csv(300, invalid_ratio=0.05))
+    for stage in ("parse", "load"):
+        for mode in ("row", "bulk"):
+            res = bench_etl.run_stage(stage, mode, str(path), 100, False)
+            assert res["rows"] == 300 and res["rowsPerSec"] > 0 and res["peakRssMb"] > 0
@@ -0,0 +1,181 @@
+# etl-service/tests/test_bulk_load.py
+import asyncio
+from contextlib import asynccontextmanager
+
+import batchparse
+import dedupe
+import dimcache
+import loader
+import main
+import reader
+
+ROWS = [
+    {"study_id": "STUDY001", "participant_id": "P001", "measurement_type": "glucose", "value": "95.5",
+     "unit": "mg/dL", "timestamp": "2024-01-15T09:30:00Z", "site_id": "SITE_A", "quality_score": "0.98"},
+    {"study_id": "STUDY001", "participant_id": "P002", "measurement_type": "weight", "value": "150",
+     "unit": "lbs", "timestamp": "2024-01-15T09:30:00Z", "site_id": "SITE_A", "quality_score": "0.97"},
+    {"study_id": "STUDY001", "participant_id": "P003", "measurement_type": "glucose", "value": "90",
+     "unit": "mg/dL", "timestamp": "not-a-date", "site_id": "SITE_A", "quality_score": "0.9"},
+]
+
+class FakeConn:
+    """Records what the loader sends; fails the staging COPY when asked to."""
+    def __init__(self, fail_copy=False):
+        self.fail_copy = fail_copy
+        self.executed = []
+        self.executed_many = []
+        self.copied = []
+        self.staged_facts = []
+
+    @asynccontextmanager
+    async def transaction(self):
+        yield
+
+    async def execute(self, sql, *args):
+        self.executed.append((sql, args))
+        if sql is main.INSERT_FACT and args[9] is None:
+            raise ValueError("null value in column \"ts\"")
+        return f"INSERT 0 {len(self.copied[-1]) if self.copied else 0}"
+
+    async def executemany(self, sql, args):
+        self.executed_many.append((sql, args))
+        if sql is main.INSERT_FACT and any(a[9] is None for a in args):
+            raise ValueError("null value in column \"ts\"")
+
+    async def fetchval(self, sql, *args):
+        self.executed.append((sql, args))
+        return 1
+
+    async def fetch(self, sql, *args):
+        self.executed.append((sql, args))
+        return []
+
+    async def fetchrow(self, sql, *args):
+        # an upsert_sql() result: every staged row is new
+        self.executed.append((sql, args))
+        n = len(self.copied[-1]) if self.copied else 0
+        return {"written": n, "existing": 0, "inserted": n, "touched": None, "unwritten": None}
+
+    async def copy_records_to_table(self, table, records, columns):
+        if table == dedupe.FACT_STAGE:
+            records = list(records)
+            if any(a[9] is None for a in records):
+                raise ValueError("null value in column \"ts\"")
+            self.staged_facts.append(records)
+            self.copied.append(records)
+            return
+        if self.fail_copy:
+            raise RuntimeError("copy failed")
+        assert table == loader.STAGE_TABLE
+        assert columns == loader.STAGE_COLUMNS
+        self.copied.append(list(records))
+
+def test_copy_chunk_is_one_copy_and_set_based_upserts():
+    conn = FakeConn()
+    batch = batchparse.parse_batch(batchparse.columns_from_rows(ROWS[:2]))
+    n = asyncio.run(loader.copy_chunk(conn, batch, "f.csv"))
+    assert n == 2
+    assert len(conn.copied) == 1 and len(conn.copied[0]) == 2
+    sqls = [sql for sql, _ in conn.executed]
+    for upsert in loader.STAGE_UPSERT_DIMS.values():
+        assert sqls.count(upsert) == 1
+    # re-sent rows are skipped by the upsert; rollups are merged by the same statement
+    assert sqls[-1] == dedupe.upsert_sql(loader.STAGE_FACTS, "fact_measurement", "skip")
+    assert loader.STAGE_INSERT_FACTS not in sqls
+    # converted weight lands in the staging tuple
+    assert conn.copied[0][1][4] == "kg"
+
+def test_copy_chunk_into_a_load_table_is_a_plain_insert():
+    conn = FakeConn()
+    batch = batchparse.parse_batch(batchparse.columns_from_rows(ROWS[:2]))
+    assert asyncio.run(loader.copy_chunk(conn, batch, "f.csv", table="etl_load_x")) == 2
+    sqls = [sql for sql, _ in conn.executed]
+    # rolled up when its months are moved into fact_measurement, not now
+    assert sqls[-1] == loader.stage_insert_facts("etl_load_x")
+    assert not any("agg_measurement_daily" in sql for sql in sqls)
+
+def test_copy_chunk_caches_ids_of_dimensions_that_already_existed():
+    class ExistingDims(FakeConn):
+        # the upsert conflicts (RETURNING is empty); only the select finds the ids
+        async def fetch(self, sql, *args):
+            self.executed.append((sql, args))
+            if sql in dimcache.SELECT_IDS.values():
+                return [{"id": i, "name": n} for i, n in enumerate(args[0], 1)]
+            return []
+
+    conn, cache = ExistingDims(), dimcache.DimensionCache()
+    batch = batchparse.parse_batch(batchparse.columns_from_rows(ROWS[:2]))
+    asyncio.run(loader.copy_chunk(conn, batch, "f.csv", cache=cache))
+    assert cache.measurement_types == {"glucose": 1, "weight": 2}
+    assert set(cache.units) == {"mg/dL", "kg"}
+    conn.executed.clear()
+    asyncio.run(loader.copy_chunk(conn, batch, "f.csv", cache=cache))
+    sqls = [sql for sql, _ in conn.executed]
+    assert not any(sql in sqls for sql in loader.STAGE_UPSERT_DIMS.values())
+    assert not any(sql in sqls for sql in dimcache.SELECT_IDS.values())
+
+def test_load_chunk_reports_bad_rows_individually(capsys):
+    conn = FakeConn()
+    batch = batchparse.parse_batch(batchparse.columns_from_rows(ROWS))
+    assert asyncio.run(main.load_chunk(conn, batch, "f.csv")) == (2, 1)
+    assert len(conn.copied[0]) == 2  # only rows with a timestamp are copied
+    assert not any(sql is main.INSERT_FACT for sql, _ in conn.executed)  # rejected without a round trip
+    out = capsys.readouterr().out
+    assert out.count("[ETL] row error") == 1
+
+def test_load_chunk_falls_back_to_rows_when_copy_fails(capsys):
+    conn = FakeConn(fail_copy=True)
+    batch = batchparse.parse_batch(batchparse.columns_from_rows(ROWS))
+    assert asyncio.run(main.load_chunk(conn, batch, "f.csv")) == (2, 1)
+    # replayed straight in sub-batches: the rows with a timestamp go in as one staged upsert
+    assert [len(f) for f in conn.staged_facts] == [2]
+    out = capsys.readouterr().out
+    assert "chunk error" in out
+    assert out.count("[ETL] row error") == 1
+
+def test_iter_chunks_bulk_matches_dictreader_rows():
+    import io
+    text = "study_id,participant_id,measurement_type,value,unit,timestamp,site_id,quality_score\n" \
+           "S1,P1,glucose,95.5,mg/dL,2024-01-15T09:30:00Z,SITE_A,0.98\n" \
+           "\n" \
+           "S1,P2,weight,150,lbs\n"
+    row_recs = [main.parse_row(r) for _, rows in reader.iter_chunks(io.StringIO(text), 10, "row") for r in rows]
+    bulk_recs = [rec for _, cols in reader.iter_chunks(io.StringIO(text), 10, "bulk")
+                 for rec in batchparse.to_records(batchparse.parse_batch(cols))]
+    assert bulk_recs == row_recs
+
+def test_insert_rows_is_one_staged_upsert_with_checkpoint():
+    conn = FakeConn()
+    recs = [main.parse_row(r) for r in ROWS[:2]]
+    marks = []
+
+    async def before_commit(c):
+        marks.append(c)
+
+    assert asyncio.run(main.insert_rows(conn, recs, "f.csv", before_commit)) == (2, 0)
+    assert [len(f) for f in conn.staged_facts] == [2] and not conn.executed_many
+    assert conn.executed[-1][0] == dedupe.upsert_sql(dedupe.FACT_STAGE_SOURCE, "fact_measurement", "skip")
+    assert marks == [conn]
+
+def test_insert_rows_into_a_load_table_is_one_executemany():
+    conn = FakeConn()
+    recs = [main.parse_row(r) for r in ROWS[:2]]
+
+    async def before_commit(c):
+        pass
+
+    assert asyncio.run(main.insert_rows(conn, recs, "f.csv", before_commit, table="etl_load_x")) == (2, 0)
+    [(sql, args)] = conn.executed_many
+    assert sql is main.insert_fact_sql("etl_load_x") and len(args) == 2
+
+def test_insert_rows_replays_failed_chunk_and_still_checkpoints(capsys):
+    conn = FakeConn()
+    recs = [main.parse_row(r) for r in ROWS]
+    marks = []
+
+    async def before_commit(c):
+        marks.append(c)
+
+    assert asyncio.run(main.insert_rows(conn, recs, "f.csv", before_commit)) == (2, 1)
+    assert marks == [conn]  # the failed attempt never reached it; the replay did
+    assert capsys.readouterr().out.count("[ETL] row error") == 1
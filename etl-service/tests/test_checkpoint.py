@@ -0,0 +1,114 @@
+# etl-service/tests/test_checkpoint.py
+import asyncio
+from contextlib import asynccontextmanager
+
+import pytest
+
+import checkpoint
+import main
+import reader
+from checkpoint import Checkpoint, CheckpointLost
+
+HEADER = "study_id,participant_id,measurement_type,value,unit,timestamp,site_id,quality_score\n"
+
+def write_csv(tmp_path, n=250):
+    path = tmp_path / "resume.csv"
+    path.write_text(HEADER + "".join(
+        f"S1,P{i:04d},glucose,{i}.5,mg/dL,2024-01-15T09:30:00Z,SITE_A,0.9\n" + ("\n" if i % 7 == 0 else "")
+        for i in range(n)
+    ))
+    return path
+
+class FakeConn:
+    """Stands in for the etl_file_loads row of one file."""
+    def __init__(self, owner="job-1"):
+        self.owner = owner
+        self.rows_committed = 0
+
+    async def execute(self, sql, content_hash, job_id, *args):
+        if job_id != self.owner:
+            return "UPDATE 0"
+        if sql is checkpoint.ADVANCE_ROWS:
+            self.rows_committed = args[0]
+        return "UPDATE 1"
+
+def test_content_hash_sample_matches_full_for_small_files(tmp_path):
+    path = write_csv(tmp_path)
+    assert checkpoint.content_hash(str(path), "full") == checkpoint.content_hash(str(path), "sample")
+    assert checkpoint.content_hash(str(path)).startswith("sha256:")
+    other = tmp_path / "other.csv"
+    other.write_text(path.read_text().replace("P0001", "P9999"))
+    assert checkpoint.content_hash(str(other)) != checkpoint.content_hash(str(path))
+
+def test_load_key_depends_on_the_load_options():
+    options = dict(studyId=None, loadMode="row", detached=False, dedupe="skip")
+    key = checkpoint.load_key("sha256:x", **options)
+    assert key.startswith("sha256:x/") and key == checkpoint.load_key("sha256:x", **options)
+    for change in ({"studyId": "S2"}, {"loadMode": "bulk"}, {"detached": True}, {"dedupe": "update"}):
+        assert checkpoint.load_key("sha256:x", **{**options, **change}) != key, change
+
+def test_large_files_are_sampled_by_default(tmp_path):
+    path = tmp_path / "big.csv"
+    path.write_bytes(b"x" * (4 * checkpoint.SAMPLE_BYTES))
+    assert checkpoint.content_hash(str(path)).startswith("sample:")
+    assert checkpoint.content_hash(str(path), "full").startswith("sha256:")
+
+@pytest.mark.parametrize("mode", ["row", "bulk"])
+def test_skip_rows_resumes_after_last_committed_row(tmp_path, mode):
+    path = write_csv(tmp_path)
+    with reader.CSVStream(str(path)) as stream:
+        ids = [r["participant_id"] if mode == "row" else r
+               for _, chunk in stream.chunks(40, mode, skip_rows=100)
+               for r in (chunk if mode == "row" else chunk["participant_id"])]
+    assert ids == [f"P{i:04d}" for i in range(100, 250)]
+
+def test_checkpoint_taken_over_by_another_job_stops_the_load():
+    conn = FakeConn(owner="job-2")
+    cp = Checkpoint("sha256:x", "job-1")
+    with pytest.raises(CheckpointLost):
+        asyncio.run(cp.mark_rows(10)(conn))
+
+@pytest.mark.parametrize("depth", [0, 2])
+def test_resumed_job_loads_only_uncommitted_rows(tmp_path, monkeypatch, depth):
+    path = write_csv(tmp_path)
+    conn = FakeConn()
+    loaded = []
+
+    @asynccontextmanager
+    async def fake_acquire():
+        yield conn
+
+    async def fake_load(conn, recs, filename, load_mode, before_commit=None, table=None, rejects=None):
+        loaded.extend(r["participant_id"] for r in recs)
+        await before_commit(conn)
+        return len(recs), 0
+
+    monkeypatch.setattr(main.db, "acquire", fake_acquire)
+    monkeypatch.setattr(main, "_load", fake_load)
+    monkeypatch.setattr(main, "PIPELINE_DEPTH", depth)
+    monkeypatch.setattr(main.dim_cache, "warmed", True)
+    main.jobs["job-1"] = {"jobId": "job-1"}
+    cp = Checkpoint("sha256:x", "job-1", rows=130)
+    processed = asyncio.run(main.process_stream("job-1", str(path), "resume.csv", None, "row", cp))
+    assert processed == 120
+    assert loaded == [f"P{i:04d}" for i in range(130, 250)]
+    assert conn.rows_committed == 250
+
+def test_fully_loaded_content_is_skipped(tmp_path, monkeypatch):
+    path = write_csv(tmp_path)
+
+    async def fake_begin(job_id, path, filename, study_id, load_mode, detached=False):
+        return Checkpoint("sha256:x", job_id, completed_by="job-0")
+
+    async def must_not_load(*args):
+        raise AssertionError("a completed file was loaded again")
+
+    monkeypatch.setattr(main, "DATA_DIR", str(tmp_path))
+    monkeypatch.setattr(main, "begin_checkpoint", fake_begin)
+    monkeypatch.setattr(main, "process_stream", must_not_load)
+    main.jobs["job-1"] = {"jobId": "job-1"}
+    asyncio.run(main.process_file("job-1", "resume.csv", None))
+    job = main.jobs["job-1"]
+    assert job["status"] == "completed" and job["skipped"] is True
+    assert "job-0" in job["message"]
+    assert set(job["metrics"]["stages"]) == set(main.metrics.STAGES)
@@ -0,0 +1,81 @@
+# etl-service/tests/test_db_pool.py
+import asyncio
+
+import db
+
+class FakePool:
+    def __init__(self, size=3):
+        self.released = []
+        self.size = size
+        self.terminated = False
+
+    def get_idle_size(self): return 0
+    def get_size(self): return self.size
+    def get_min_size(self): return 1
+    def get_max_size(self): return 4
+
+    async def acquire(self):
+        await asyncio.sleep(0.01)
+        return "conn"
+
+    async def release(self, conn):
+        self.released.append(conn)
+
+    def terminate(self):
+        self.terminated = True
+
+def test_pool_config_from_env(monkeypatch):
+    monkeypatch.setenv("ETL_POOL_MIN_SIZE", "3")
+    monkeypatch.setenv("ETL_POOL_MAX_SIZE", "20")
+    monkeypatch.setenv("ETL_STATEMENT_CACHE_SIZE", "500")
+    cfg = db.pool_config()
+    assert (cfg["min_size"], cfg["max_size"], cfg["statement_cache_size"]) == (3, 20, 500)
+
+def test_a_new_loop_terminates_the_old_pool(monkeypatch):
+    created = []
+
+    async def create_pool(**cfg):
+        created.append(FakePool())
+        return created[-1]
+
+    monkeypatch.setattr(db.asyncpg, "create_pool", create_pool)
+    monkeypatch.setattr(db, "_pool", None)
+    monkeypatch.setattr(db, "_pool_loop", None)
+    monkeypatch.setattr(db, "_lock", None)
+    first = asyncio.run(db.get_pool())
+    second = asyncio.run(db.get_pool())
+    assert created == [first, second]
+    assert first.terminated and not second.terminated
+
+def test_acquire_records_wait_and_saturation(monkeypatch):
+    pool = FakePool()
+
+    async def fake_get_pool():
+        return pool
+
+    monkeypatch.setattr(db, "get_pool", fake_get_pool)
+    monkeypatch.setattr(db, "_pool", pool)
+    before = dict(db._stats)
+
+    async def use():
+        async with db.acquire() as conn:
+            assert conn == "conn"
+
+    asyncio.run(use())
+    stats = db.pool_stats()
+    assert pool.released == ["conn"]
+    assert stats["acquires"] == before["acquires"] + 1
+    # nothing idle, but the pool can still grow to max_size: not saturated
+    assert stats["saturatedAcquires"] == before["saturatedAcquires"]
+    assert stats["waitSecondsMax"] > 0
+    assert stats["waiting"] == 0
+    assert stats["inUse"] == 3 and stats["saturation"] == 0.75
+
+    pool.size = 4
+    asyncio.run(use())
+    assert db.pool_stats()["saturatedAcquires"] == before["saturatedAcquires"] + 1
+
+def test_pool_stats_route(client):
+    r = client.get("/pool/stats")
+    assert r.status_code == 200
+    assert "acquires" in r.json()
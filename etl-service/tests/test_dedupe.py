@@ -0,0 +1,155 @@
+# etl-service/tests/test_dedupe.py
+import asyncio
+from contextlib import asynccontextmanager
+from datetime import date, datetime, timezone
+
+import pytest
+from fastapi.testclient import TestClient
+
+import batchparse
+import dedupe
+import loader
+import metrics
+import rollups
+
+UTC = timezone.utc
+T0 = datetime(2024, 1, 15, 9, 30, tzinfo=UTC)
+
+
+def args(pid="P1", value=1.0, ts=T0):
+    return ("S1", pid, "SITE_A", 1, 1, value, None, None, 0.9, ts, "f.csv", True, [])
+
+
+class FakeConn:
+    def __init__(self, result):
+        self.result = result
+        self.executed = []
+        self.copied = []
+
+    @asynccontextmanager
+    async def transaction(self):
+        yield
+
+    async def execute(self, sql, *a):
+        self.executed.append(sql)
+        return "OK"
+
+    async def fetch(self, sql, *a):
+        self.executed.append(sql)
+        return []
+
+    async def fetchrow(self, sql, *a):
+        self.executed.append(sql)
+        return self.result
+
+    async def copy_records_to_table(self, table, records, columns):
+        self.copied.append((table, list(records)))
+
+
+def test_in_chunk_duplicates_keep_first_for_skip_and_last_for_update():
+    rows = [args("P1", 1.0), args("P2", 2.0), args("P1", 3.0)]
+    kept, pos = dedupe.unique_args(rows, "skip")
+    assert pos == [0, 1] and [a[5] for a in kept] == [1.0, 2.0]
+    kept, pos = dedupe.unique_args(rows, "update")
+    assert pos == [1, 2] and [a[5] for a in kept] == [2.0, 3.0]
+    same, pos = dedupe.unique_args(rows[:2], "skip")
+    assert pos == [0, 1] and same == rows[:2]
+
+
+def test_unique_batch_filters_every_column():
+    batch = {"study_id": ["S1", "S1", "S1"], "participant_id": ["P1", "P1", "P1"],
+             "measurement_type": ["glucose", "glucose", "weight"], "ts": [T0, T0, T0],
+             "value_numeric": [1.0, 2.0, 3.0]}
+    out, keep = dedupe.unique_batch(batch, "update")
+    assert keep == [1, 2]
+    assert out["value_numeric"] == [2.0, 3.0]
+    assert out["measurement_type"] == ["glucose", "weight"]
+
+
+def test_upsert_sql_per_mode(monkeypatch):
+    monkeypatch.setattr(rollups, "ENABLED", True)
+    skip = dedupe.upsert_sql(dedupe.FACT_STAGE_SOURCE, "fact_measurement", "skip")
+    assert "ON CONFLICT (study_id, participant_id, measurement_type_id, ts) DO NOTHING" in skip
+    assert "INSERT INTO agg_measurement_daily" in skip and "FROM new f" in skip
+    update = dedupe.upsert_sql(dedupe.FACT_STAGE_SOURCE, "fact_measurement", "update")
+    assert "DO UPDATE SET site_id = EXCLUDED.site_id" in update
+    assert "IS DISTINCT FROM (EXCLUDED.site_id" in update
+    assert dedupe.upsert_sql(dedupe.FACT_STAGE_SOURCE, "fact_measurement", "update") is update
+    monkeypatch.setattr(rollups, "ENABLED", False)
+    assert "agg_measurement_daily" not in dedupe.upsert_sql(dedupe.FACT_STAGE_SOURCE, "fact_measurement", "update")
+
+
+def test_counts_and_rollup_rebuild_of_updated_days(monkeypatch):
+    monkeypatch.setattr(rollups, "ENABLED", True)
+    rebuilt = []
+
+    async def fake_rebuild(conn, study_id=None, day=None):
+        rebuilt.append((study_id, day))
+        return 1
+
+    monkeypatch.setattr(rollups, "rebuild", fake_rebuild)
+    # 5 rows: 2 new, 2 changed, 1 identical to what is stored
+    conn = FakeConn({"written": 4, "existing": 3, "inserted": 2, "touched": '[["S1", "2024-01-15"]]',
+                     "unwritten": [4]})
+    rows = [args(f"P{i}") + (i,) for i in range(5)]  # each row followed by its position
+    unwritten = set()
+    assert asyncio.run(dedupe.upsert_rows(conn, rows, "fact_measurement", "update", unwritten)) == (2, 2, 1)
+    assert conn.copied == [(dedupe.FACT_STAGE, rows)] and unwritten == {4}
+    assert rebuilt == [("S1", date(2024, 1, 15))]
+
+
+def test_copy_chunk_upserts_and_counts_updated_and_skipped(monkeypatch):
+    monkeypatch.setattr(rollups, "ENABLED", False)
+    rows = [
+        {"study_id": "S1", "participant_id": "P1", "measurement_type": "glucose", "value": "95",
+         "unit": "mg/dL", "timestamp": "2024-01-15T09:30:00Z", "site_id": "SITE_A", "quality_score": "0.9"},
+        {"study_id": "S1", "participant_id": "P1", "measurement_type": "glucose", "value": "97",
+         "unit": "mg/dL", "timestamp": "2024-01-15T09:30:00Z", "site_id": "SITE_A", "quality_score": "0.9"},
+        {"study_id": "S1", "participant_id": "P2", "measurement_type": "glucose", "value": "90",
+         "unit": "mg/dL", "timestamp": "2024-01-15T09:30:00Z", "site_id": "SITE_A", "quality_score": "0.9"},
+    ]
+    batch = batchparse.parse_batch(batchparse.columns_from_rows(rows))
+    conn = FakeConn({"written": 2, "existing": 1, "inserted": 1, "touched": None, "unwritten": None})
+    metrics.jobs.pop("dedupe-job", None)
+    with metrics.job_scope("dedupe-job") as m, dedupe.job_mode("update"):
+        inserted = asyncio.run(loader.copy_chunk(conn, batch, "f.csv"))
+    assert inserted == 1
+    assert m.rows["updated"] == 1 and m.rows["skipped"] == 1
+    # the later P1 row won, and the plain fact insert was not used
+    assert [r[5] for r in conn.copied[0][1]] == [97.0, 90.0]
+    assert loader.STAGE_INSERT_FACTS not in conn.executed
+    assert dedupe.upsert_sql(loader.STAGE_FACTS, "fact_measurement", "update") in conn.executed
+
+
+def test_default_skips_and_counts_rows_already_loaded(monkeypatch):
+    monkeypatch.setattr(rollups, "ENABLED", False)
+    assert dedupe.MODES == ("skip", "update")
+    # a detached load's table has no natural key index: plain inserts whatever the mode
+    assert dedupe.effective("update", True) == "update" and dedupe.effective("update", False) is None
+    rows = [{"study_id": "S1", "participant_id": p, "measurement_type": "glucose", "value": "95",
+             "unit": "mg/dL", "timestamp": "2024-01-15T09:30:00Z", "site_id": "SITE_A", "quality_score": "0.9"}
+            for p in ("P1", "P2")]
+    batch = batchparse.parse_batch(batchparse.columns_from_rows(rows))
+    # P1 was loaded before: it is skipped, not a failed chunk
+    conn = FakeConn({"written": 1, "existing": 1, "inserted": 1, "touched": None, "unwritten": None})
+    metrics.jobs.pop("skip-job", None)
+    # "off" (removed; it behaved as skip) still runs jobs queued with it
+    with metrics.job_scope("skip-job") as m, dedupe.job_mode("off"):
+        assert asyncio.run(loader.copy_chunk(conn, batch, "f.csv")) == 1
+    assert m.rows["skipped"] == 1 and m.rows["updated"] == 0
+    assert dedupe.upsert_sql(loader.STAGE_FACTS, "fact_measurement", "skip") in conn.executed
+
+
+def test_job_mode_rejects_unknown_modes():
+    with pytest.raises(ValueError):
+        with dedupe.job_mode("merge"):
+            pass
+    assert dedupe.current() == dedupe.MODE
+
+
+def test_submit_validates_dedupe(client: TestClient):
+    for mode in ("merge", "off"):
+        r = client.post("/jobs", json={"filename": "x.csv", "dedupe": mode})
+        assert r.status_code == 422
+    r = client.post("/jobs", json={"filename": "x.csv", "dedupe": "skip", "detached": True})
+    assert r.status_code == 400
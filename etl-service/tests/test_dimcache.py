@@ -0,0 +1,70 @@
+# etl-service/tests/test_dimcache.py
+import asyncio
+
+import dimcache
+from dimcache import DimensionCache
+
+class FakeConn:
+    def __init__(self):
+        self.calls = []
+        self.next_id = 10
+
+    async def execute(self, sql, *args):
+        self.calls.append(sql)
+
+    async def fetchval(self, sql, *args):
+        self.calls.append(sql)
+        self.next_id += 1
+        return self.next_id
+
+    async def fetch(self, sql, *args):
+        if "dim_measurement_type" in sql:
+            return [{"id": 1, "name": "glucose"}]
+        if "dim_unit" in sql:
+            return [{"id": 2, "name": "mg/dL"}]
+        if "dim_study" in sql:
+            return [{"study_id": "STUDY001"}]
+        if "dim_site" in sql:
+            return [{"site_id": "SITE_A"}]
+        return [{"study_id": "STUDY001", "participant_id": "P001"}]
+
+REC = {"study_id": "STUDY001", "participant_id": "P001", "site_id": "SITE_A",
+       "measurement_type": "glucose", "unit": "mg/dL"}
+
+def test_warm_cache_resolves_without_round_trips():
+    cache = DimensionCache()
+    conn = FakeConn()
+    asyncio.run(cache.warm(conn))
+    assert asyncio.run(cache.resolve(conn, REC)) == (1, 2)
+    assert conn.calls == []
+    assert cache.stats()["misses"] == {d: 0 for d in dimcache.DIMENSIONS}
+    assert cache.stats()["hits"]["participant"] == 1
+
+def test_miss_upserts_once_then_hits():
+    cache = DimensionCache()
+    conn = FakeConn()
+    rec = dict(REC, measurement_type="weight", unit="kg")
+    first = asyncio.run(cache.resolve(conn, rec))
+    n_calls = len(conn.calls)
+    assert n_calls == 5
+    assert asyncio.run(cache.resolve(conn, rec)) == first
+    assert len(conn.calls) == n_calls
+    assert cache.stats()["hits"]["unit"] == 1 and cache.stats()["misses"]["unit"] == 1
+
+def test_participant_lru_eviction():
+    cache = DimensionCache(max_participants=2)
+    conn = FakeConn()
+    for pid in ("P1", "P2", "P1", "P3"):
+        asyncio.run(cache.ensure_participant(conn, "S", pid))
+    assert list(cache.participants) == [("S", "P1"), ("S", "P3")]
+    assert cache.evictions == 1
+
+def test_unknown_dimensions_for_bulk_chunks():
+    cache = DimensionCache()
+    asyncio.run(cache.warm(FakeConn()))
+    batch = {k: [v] for k, v in REC.items()}
+    new_participant = dict(batch, participant_id=["P009"])
+    assert cache.unknown_dimensions(batch) == set()
+    assert cache.unknown_dimensions(new_participant) == {"participant"}
+    cache.remember_chunk(new_participant)
+    assert cache.unknown_dimensions(new_participant) == set()
@@ -0,0 +1,136 @@
+# etl-service/tests/test_export.py
+import asyncio
+import json
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta, timezone
+
+import pyarrow as pa
+import pytest
+from fastapi.testclient import TestClient
+
+import export
+from dimcache import dim_cache
+
+T0 = datetime(2024, 1, 15, 9, 30, tzinfo=timezone.utc)
+TYPES = {1: "glucose", 2: "heart_rate"}
+
+
+def fact(participant, minutes, mt_id):
+    return {"study_id": "S1", "participant_id": participant, "site_id": "A", "measurement_type_id": mt_id,
+            "unit_id": 10, "value_numeric": 95.0 + minutes, "systolic": None, "diastolic": None,
+            "quality_score": 0.9, "is_valid": True, "quality_flags": [], "ts": T0 + timedelta(minutes=minutes),
+            "source_file": "f.csv"}
+
+
+# 3 participants x 2 timestamps x 2 types, and a row of another study
+FACTS = [fact(p, m, mt) for p in ("P1", "P2", "P3") for m in (0, 5) for mt in (1, 2)] + [
+    {**fact("P0", 0, 1), "study_id": "S2"}]
+
+
+def order(r):
+    return r["participant_id"], -r["ts"].timestamp(), r["measurement_type_id"]
+
+
+class FakeConn:
+    """Runs the two export queries over FACTS in Python."""
+
+    def __init__(self):
+        self.queries = []
+        self.held = False
+        self.name_loads = 0
+
+    async def fetch(self, sql, *args):
+        if sql not in (export.SELECT_FIRST, export.SELECT_AFTER):
+            self.name_loads += 1
+            if "measurement_type" in sql:
+                return [{"id": i, "name": n} for i, n in TYPES.items()]
+            return [{"id": 10, "name": "mg/dL"}]
+        self.queries.append(sql)
+        study_id, *args = args
+        rows = sorted((r for r in FACTS if r["study_id"] == study_id), key=order)
+        if sql is export.SELECT_AFTER:
+            p, ts, mt, limit = args
+            rows = [r for r in rows if order(r) > (p, -ts.timestamp(), mt)]
+        else:
+            (limit,) = args
+        return rows[:limit]
+
+
+@pytest.fixture
+def conn(monkeypatch):
+    c = FakeConn()
+
+    @asynccontextmanager
+    async def fake_acquire():
+        c.held = True
+        try:
+            yield c
+        finally:
+            c.held = False
+    monkeypatch.setattr(export.db, "acquire", fake_acquire)
+    monkeypatch.setattr(export, "PAGE_ROWS", 5)
+    monkeypatch.setattr(export, "BATCH_ROWS", 2)
+    dim_cache.clear()
+    yield c
+    dim_cache.clear()
+
+
+def lines(r):
+    return [json.loads(line) for line in r.text.splitlines()]
+
+
+def test_ndjson_export_pages_by_keyset_and_resolves_names(client: TestClient, conn):
+    r = client.get("/studies/S1/export")
+    assert r.status_code == 200 and r.headers["content-type"].startswith("application/x-ndjson")
+    rows = lines(r)
+    expected = sorted((f for f in FACTS if f["study_id"] == "S1"), key=order)
+    assert [(x["participantId"], x["ts"], x["measurementType"]) for x in rows] == [
+        (f["participant_id"], f["ts"].isoformat(), TYPES[f["measurement_type_id"]]) for f in expected]
+    assert rows[0]["unit"] == "mg/dL" and rows[0]["studyId"] == "S1"
+    # 12 rows in pages of 5: two full pages and a short one, each after the previous one's last row
+    assert conn.queries == [export.SELECT_FIRST, export.SELECT_AFTER, export.SELECT_AFTER]
+    assert conn.name_loads == 2  # once, for the first unknown ids
+
+
+def test_export_resumes_after_the_last_row_a_client_got(client: TestClient, conn):
+    first = lines(client.get("/studies/S1/export"))
+    last = first[6]
+    rest = lines(client.get("/studies/S1/export", params={
+        "afterParticipant": last["participantId"], "afterTs": last["ts"], "afterType": last["measurementType"]}))
+    assert rest == first[7:]
+
+
+def test_arrow_export_is_one_ipc_stream(client: TestClient, conn):
+    r = client.get("/studies/S1/export", params={"format": "arrow"})
+    assert r.headers["content-type"] == "application/vnd.apache.arrow.stream"
+    table = pa.ipc.open_stream(r.content).read_all()
+    assert table.num_rows == 12 and table.schema == export.arrow_schema()
+    assert table.column("measurementType").to_pylist()[:2] == ["glucose", "heart_rate"]
+    empty = pa.ipc.open_stream(client.get("/studies/S9/export", params={"format": "arrow"}).content).read_all()
+    assert empty.num_rows == 0
+
+
+def test_pages_are_read_only_as_fast_as_they_are_consumed(conn):
+    async def take(n):
+        body = export.stream("S1", "ndjson")
+        chunks = []
+        for _ in range(n):
+            chunks.append(await body.__anext__())
+            assert not conn.held  # the page's connection went back to the pool before it was sent
+        await body.aclose()
+        return chunks
+    assert len(asyncio.run(take(1))[0].splitlines()) == 2
+    assert conn.queries == [export.SELECT_FIRST]
+    # a page of 5 is three batches; the fourth is the first of the next page
+    conn.queries.clear()
+    asyncio.run(take(4))
+    assert conn.queries == [export.SELECT_FIRST, export.SELECT_AFTER]
+
+
+def test_bad_export_requests(client: TestClient, conn):
+    assert client.get("/studies/S1/export", params={"format": "csv"}).status_code == 400
+    assert client.get("/studies/S1/export", params={"afterParticipant": "P1"}).status_code == 400
+    params = {"afterParticipant": "P1", "afterTs": "2024-01-15T09:30:00", "afterType": "glucose"}
+    assert client.get("/studies/S1/export", params=params).status_code == 400  # no offset
+    params.update(afterTs="2024-01-15T09:30:00+00:00", afterType="nope")
+    assert client.get("/studies/S1/export", params=params).status_code == 400
@@ -0,0 +1,145 @@
+# etl-service/tests/test_inputs.py
+import asyncio
+import gzip
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import batchparse
+import main
+import reader
+from checkpoint import Checkpoint
+
+HEADER = "study_id,participant_id,measurement_type,value,unit,timestamp,site_id,quality_score\n"
+LINES = [f"S1,P{i:04d},weight,{150 + i}.5,lbs,2024-01-15T09:{i % 60:02d}:00Z,A,0.9\n" for i in range(250)]
+
+def rows_of(stream, mode="row", skip=0):
+    with stream:
+        return [r for _, chunk in stream.chunks(100, mode, skip_rows=skip)
+                for r in (chunk if mode == "row" else batchparse.to_records(batchparse.parse_batch(chunk)))]
+
+def test_gzip_csv_streams_like_plain_csv(tmp_path):
+    plain = tmp_path / "a.csv"
+    plain.write_text(HEADER + "".join(LINES))
+    gz = tmp_path / "a.csv.gz"
+    gz.write_bytes(gzip.compress(plain.read_bytes()))
+    stream = reader.open_input(str(gz))
+    assert stream.compression == "gzip"
+    assert rows_of(stream, skip=30) == rows_of(reader.open_input(str(plain)), skip=30)
+    assert rows_of(reader.open_input(str(gz)), "bulk") == rows_of(reader.open_input(str(plain)), "bulk")
+    assert stream.progress() == 100
+
+def test_zstd_csv_streams_like_plain_csv(tmp_path):
+    zstandard = pytest.importorskip("zstandard")
+    plain = tmp_path / "a.csv"
+    plain.write_text(HEADER + "".join(LINES))
+    zst = tmp_path / "a.csv.zst"
+    zst.write_bytes(zstandard.ZstdCompressor().compress(plain.read_bytes()))
+    assert rows_of(reader.open_input(str(zst))) == rows_of(reader.open_input(str(plain)))
+
+def test_compressed_and_columnar_files_are_not_sharded(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "SHARD_MIN_BYTES", 0)
+    for name in ("a.csv", "a.csv.gz", "a.parquet"):
+        (tmp_path / name).write_bytes(b"x")
+    assert main.shard_count(str(tmp_path / "a.csv"), "bulk", 4) == 4
+    assert main.shard_count(str(tmp_path / "a.csv.gz"), "bulk", 4) == 1
+    assert main.shard_count(str(tmp_path / "a.parquet"), "bulk", 4) == 1
+
+def test_typed_columns_skip_string_parsing():
+    strings = {
+        "study_id": ["S1", "S1", "S1"], "participant_id": ["P1", "P2", "P3"],
+        "measurement_type": ["weight", "glucose", "blood_pressure"], "value": ["150", None, "120/80"],
+        "unit": ["lbs", "mg/dL", "mmHg"],
+        "timestamp": ["2024-01-15T09:30:00Z", None, "2024-01-15T11:30:00+02:00"],
+        "site_id": ["A", "A", "A"], "quality_score": ["0.5", None, "1"],
+    }
+    typed = dict(strings,
+                 value=np.array([150.0, np.nan, np.nan]),
+                 timestamp=pd.Series(pd.to_datetime(["2024-01-15 09:30", None, "2024-01-15 09:30"])),
+                 quality_score=np.array([0.5, np.nan, 1.0]))
+    got = batchparse.parse_batch(typed)
+    want = batchparse.parse_batch(strings)
+    for k in want:
+        if k not in ("flags", "is_valid", "systolic", "diastolic", "ts"):
+            assert got[k] == want[k], k
+    assert got["ts"] == [datetime(2024, 1, 15, 9, 30, tzinfo=timezone.utc), None,
+                         datetime(2024, 1, 15, 9, 30, tzinfo=timezone.utc)]
+    # a number can never be a blood pressure reading
+    assert got["flags"][2] == ["invalid_bp_format"] and not got["is_valid"][2]
+
+def test_parquet_yields_typed_column_batches(tmp_path):
+    pa = pytest.importorskip("pyarrow")
+    pq = pytest.importorskip("pyarrow.parquet")
+    n = 250
+    table = pa.table({
+        "study_id": ["S1"] * n, "participant_id": [f"P{i:04d}" for i in range(n)],
+        "measurement_type": pa.array(["weight"] * n).dictionary_encode(),
+        "value": [150.0 + i for i in range(n)], "unit": ["lbs"] * n,
+        "timestamp": pa.array([datetime(2024, 1, 15, 9, i % 60) for i in range(n)], pa.timestamp("us")),
+        "site_id": ["A"] * n, "quality_score": [0.9] * n,
+    })
+    path = tmp_path / "a.parquet"
+    pq.write_table(table, path, row_group_size=64)
+    stream = reader.open_input(str(path))
+    with stream:
+        chunks = list(stream.chunks(100, "bulk", skip_rows=70))
+        assert stream.progress() == 100
+    counts = [c for c, _ in chunks]
+    assert sum(counts) == n - 70 and max(counts) <= 100
+    cols = chunks[0][1]
+    assert cols["value"].dtype == np.float64 and cols["value"][0] == 220.0
+    recs = [r for _, c in chunks for r in batchparse.to_records(batchparse.parse_batch(c))]
+    assert len(recs) == n - 70
+    assert recs[0]["participant_id"] == "P0070" and recs[0]["unit"] == "kg"
+    assert recs[0]["ts"] == datetime(2024, 1, 15, 9, 10, tzinfo=timezone.utc)
+
+def test_gzip_job_loads_every_row(tmp_path, monkeypatch):
+    path = tmp_path / "a.csv.gz"
+    path.write_bytes(gzip.compress((HEADER + "".join(LINES)).encode()))
+    loaded = []
+
+    class Conn:
+        async def execute(self, sql, *args):
+            return "UPDATE 1"
+
+    @asynccontextmanager
+    async def fake_acquire():
+        yield Conn()
+
+    async def fake_load(conn, recs, filename, load_mode, before_commit=None, table=None, rejects=None):
+        loaded.extend(recs)
+        await before_commit(conn)
+        return len(recs), 0
+
+    monkeypatch.setattr(main.db, "acquire", fake_acquire)
+    monkeypatch.setattr(main.dim_cache, "warmed", True)
+    monkeypatch.setattr(main, "_load", fake_load)
+    main.jobs["gz-1"] = {"jobId": "gz-1"}
+    cp = Checkpoint("sha256:x", "gz-1")
+    assert asyncio.run(main.process_stream("gz-1", str(path), "a.csv.gz", None, "row", cp)) == 250
+    assert [r["participant_id"] for r in loaded] == [f"P{i:04d}" for i in range(250)]
+    assert main.jobs["gz-1"]["progress"] == 100
+
+@pytest.mark.parametrize("writer", ["file", "stream"])
+def test_arrow_ipc_batches_are_rechunked(tmp_path, writer):
+    pa = pytest.importorskip("pyarrow")
+    batch = pa.table({
+        "study_id": ["S1"] * 150, "participant_id": [f"P{i}" for i in range(150)],
+        "measurement_type": ["glucose"] * 150, "value": [f"{90 + i % 5}" for i in range(150)],
+        "unit": ["mg/dL"] * 150, "timestamp": ["2024-01-15T09:30:00Z"] * 150,
+    }).to_batches()[0]
+    path = tmp_path / "a.arrow"
+    open_writer = pa.ipc.new_file if writer == "file" else pa.ipc.new_stream
+    with pa.OSFile(str(path), "wb") as sink, open_writer(sink, batch.schema) as w:
+        w.write_batch(batch)
+        w.write_batch(batch)
+    with reader.open_input(str(path)) as stream:
+        chunks = list(stream.chunks(100, "bulk", skip_rows=20))
+        assert stream.progress() == 100
+    assert [c for c, _ in chunks] == [100, 30, 100, 50]
+    recs = [r for _, c in chunks for r in batchparse.to_records(batchparse.parse_batch(c))]
+    assert recs[0]["participant_id"] == "P20" and recs[0]["value_numeric"] == 90.0
+    assert recs[0]["quality_score"] == 0.0 and recs[0]["site_id"] == ""
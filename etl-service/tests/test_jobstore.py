@@ -0,0 +1,69 @@
+# etl-service/tests/test_jobstore.py
+import asyncio
+import json
+from contextlib import asynccontextmanager
+
+import jobstore
+from jobstore import JobRepository
+
+class FakeConn:
+    def __init__(self, rows=None):
+        self.batches = []
+        self.rows = rows or {}
+
+    async def executemany(self, sql, params):
+        self.batches.append(list(params))
+
+    async def fetchrow(self, sql, job_id):
+        return self.rows.get(job_id)
+
+def use_conn(monkeypatch, conn):
+    @asynccontextmanager
+    async def fake_acquire():
+        yield conn
+    monkeypatch.setattr(jobstore.db, "acquire", fake_acquire)
+
+def new_job(job_id):
+    return {"jobId": job_id, "filename": "f.csv", "studyId": "S1", "status": "queued", "progress": 0,
+            "createdAt": jobstore.now_iso(), "updatedAt": jobstore.now_iso()}
+
+def test_updates_are_coalesced_into_one_batched_write(monkeypatch):
+    conn = FakeConn()
+    use_conn(monkeypatch, conn)
+    store = JobRepository()
+    store.create(new_job("a"))
+    store.create(new_job("b"))
+    for pct in range(0, 100, 10):
+        store.update("a", status="running", progress=pct)
+        store.incr("a", rowsProcessed=100)
+    asyncio.run(store.flush())
+    assert len(conn.batches) == 1
+    written = {p[0]: p for p in conn.batches[0]}
+    assert set(written) == {"a", "b"}
+    assert written["a"][3:5] == ("running", 90)
+    assert written["a"][7] == 1000
+    asyncio.run(store.flush())  # nothing dirty -> no write
+    assert len(conn.batches) == 1
+
+def test_failed_flush_keeps_jobs_dirty(monkeypatch):
+    @asynccontextmanager
+    async def broken():
+        raise OSError("db down")
+        yield
+    monkeypatch.setattr(jobstore.db, "acquire", broken)
+    store = JobRepository()
+    store.create(new_job("a"))
+    asyncio.run(store.flush())
+    assert store.dirty == {"a"}
+
+def test_remote_jobs_are_read_through_a_ttl_cache(monkeypatch):
+    store = JobRepository(cache_ttl=60)
+    row = {c: None for c in jobstore.COLUMNS.values()}
+    row.update(id="r1", filename="f.csv", status="completed", progress=100, details=json.dumps({"shards": []}))
+    conn = FakeConn({"r1": row})
+    use_conn(monkeypatch, conn)
+    job = asyncio.run(store.get("r1"))
+    assert job["jobId"] == "r1" and job["status"] == "completed" and job["shards"] == []
+    conn.rows.clear()
+    assert asyncio.run(store.get("r1")) == job  # served from the cache
+    assert asyncio.run(store.get("missing")) is None
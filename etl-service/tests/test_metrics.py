@@ -0,0 +1,52 @@
+# etl-service/tests/test_metrics.py
+import asyncio
+
+import metrics
+
+def test_histogram_buckets_are_cumulative_and_le_inclusive():
+    h = metrics.Histogram()
+    for v in (0.001, 0.002, 0.3, 60.0):
+        h.observe(v)
+    cum = h.cumulative()
+    assert cum[0] == 1                      # le=0.001
+    assert cum[metrics.BUCKETS.index(0.005)] == 2
+    assert cum[metrics.BUCKETS.index(0.5)] == 3
+    assert cum[-1] == h.count == 4          # +Inf
+    assert abs(h.sum - 60.303) < 1e-9
+
+def test_job_scope_covers_tasks_started_by_the_job():
+    async def shard():
+        metrics.observe("insert", 0.5)
+        metrics.count_rows(inserted=10)
+
+    async def job():
+        with metrics.job_scope("scoped-job") as m:
+            assert metrics.jobs["scoped-job"] is m
+            await asyncio.gather(shard(), shard())
+            metrics.observe("read", 0.25)
+        return m
+
+    before = metrics.service.rows["inserted"]
+    m = asyncio.run(job())
+    assert m.stages["insert"].count == 2 and m.stages["insert"].sum == 1.0
+    assert m.rows["inserted"] == 20
+    assert metrics.service.rows["inserted"] - before == 20
+    assert "scoped-job" not in metrics.jobs
+    assert metrics.current() is None
+    snap = m.snapshot()
+    assert snap["stages"]["read"]["calls"] == 1 and snap["bucketBounds"][-1] == "+Inf"
+
+def test_timed_iter_times_every_next():
+    before = metrics.service.stages["read"].count
+    assert list(metrics.timed_iter("read", [1, 2, 3])) == [1, 2, 3]
+    assert metrics.service.stages["read"].count - before == 4  # three items + exhaustion
+
+def test_metrics_route_serves_prometheus_text(client):
+    r = client.get("/metrics")
+    assert r.status_code == 200
+    assert r.headers["content-type"].startswith("text/plain")
+    body = r.text
+    assert "# TYPE etl_stage_seconds histogram" in body
+    assert 'etl_stage_seconds_bucket{stage="parse",le="+Inf"}' in body
+    assert 'etl_rows_total{kind="inserted"}' in body
+    assert "etl_pool_acquires_total" in body
@@ -0,0 +1,120 @@
+# etl-service/tests/test_partitions.py
+import asyncio
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import partitions
+from partitions import PartitionManager
+
+UTC = timezone.utc
+
+class FakeConn:
+    def __init__(self, tree=(), children=None, repeated=0):
+        self.tree = list(tree)
+        self.children = children or {}
+        self.repeated = repeated
+        self.ddl = []
+
+    @asynccontextmanager
+    async def transaction(self):
+        yield
+
+    async def execute(self, sql, *args):
+        if sql is not partitions.LOCK_NAME:
+            self.ddl.append(sql)
+        return "OK"
+
+    async def fetch(self, sql, *args):
+        if sql is partitions.PARTITION_TREE:
+            return self.tree
+        if not args:
+            self.ddl.append(sql)
+            return []
+        return self.children.get(args[0], [])
+
+    async def fetchval(self, sql, *args):
+        self.ddl.append(sql)
+        return self.repeated
+
+def test_months_of_are_the_months_present():
+    lo = datetime(2023, 11, 30, 23, 0, tzinfo=UTC)
+    hi = datetime(2024, 2, 1, tzinfo=UTC)
+    assert partitions.months_of([hi, lo, hi]) == [(2023, 11), (2024, 2)]
+    # a mistyped year is one more month, not two centuries of them
+    assert partitions.months_of([lo, datetime(2204, 1, 5, tzinfo=UTC)]) == [(2023, 11), (2204, 1)]
+    # month boundaries are UTC whatever the offset of the timestamp
+    local = datetime(2024, 3, 1, 0, 30, tzinfo=timezone(timedelta(hours=2)))
+    assert partitions.month_of(local) == (2024, 2)
+
+def test_ensure_creates_missing_months_once():
+    conn = FakeConn(tree=[{"name": "fact_measurement_2024_01", "isleaf": True}])
+    pm = PartitionManager(by_study=False)
+    ts = [datetime(2024, 1, 5, tzinfo=UTC), None, datetime(2024, 3, 2, tzinfo=UTC)]
+    asyncio.run(pm.ensure(conn, "fact_measurement", ts, ["S1"]))
+    assert len(conn.ddl) == 1  # March only: no row needs February
+    assert '"fact_measurement_2024_03" PARTITION OF "fact_measurement"' in conn.ddl[0]
+    assert "FROM ('2024-03-01T00:00:00+00:00') TO ('2024-04-01T00:00:00+00:00');" in conn.ddl[0]
+    asyncio.run(pm.ensure(conn, "fact_measurement", ts, ["S1"]))
+    assert len(conn.ddl) == 1  # cached
+
+def test_ensure_sub_partitions_by_study():
+    conn = FakeConn()
+    pm = PartitionManager(by_study=True)
+    asyncio.run(pm.ensure(conn, "fact_measurement", [datetime(2024, 1, 5, tzinfo=UTC)], ["S1", "O'Brien"]))
+    assert conn.ddl[0].endswith("PARTITION BY LIST (study_id);")
+    subs = conn.ddl[1:]
+    assert len(subs) == 2
+    assert any("FOR VALUES IN ('O''Brien');" in d for d in subs)
+    assert all('PARTITION OF "fact_measurement_2024_01"' in d for d in subs)
+
+def test_leaf_months_are_not_sub_partitioned():
+    conn = FakeConn(tree=[{"name": "fact_measurement_2024_01", "isleaf": True}])
+    pm = PartitionManager(by_study=True)
+    asyncio.run(pm.ensure(conn, "fact_measurement", [datetime(2024, 1, 5, tzinfo=UTC)], ["S1"]))
+    assert conn.ddl == []
+
+def detached_conn(load, repeated=0):
+    return FakeConn(
+        tree=[{"name": "fact_measurement_2024_01", "isleaf": True}],
+        children={load: [
+            {"name": f"{load}_2023_12", "bound": "FOR VALUES FROM ('2023-12-01') TO ('2024-01-01')"},
+            {"name": f"{load}_2024_01", "bound": "FOR VALUES FROM ('2024-01-01') TO ('2024-02-01')"},
+        ]},
+        repeated=repeated,
+    )
+
+def test_finish_detached_attaches_new_months_and_merges_existing(monkeypatch):
+    monkeypatch.setattr(partitions.rollups, "ENABLED", True)
+    load = partitions.load_table_name("sha256:abc")
+    conn = detached_conn(load)
+    pm = PartitionManager(by_study=False)
+    attached = asyncio.run(pm.finish_detached(conn, load))
+    assert attached == ["fact_measurement_2023_12"]
+    ddl = "\n".join(conn.ddl)
+    assert f'ALTER TABLE "{load}_2023_12" RENAME TO "fact_measurement_2023_12";' in ddl
+    assert ('ALTER TABLE "fact_measurement" ATTACH PARTITION "fact_measurement_2023_12" '
+            "FOR VALUES FROM ('2023-12-01') TO ('2024-01-01');") in ddl
+    # January already exists: copied in and dropped instead of attached
+    assert f'INSERT INTO "fact_measurement" SELECT * FROM "{load}_2024_01";' in ddl
+    # both months were checked for repeated keys, and January against what is loaded
+    assert ddl.count("GROUP BY study_id, participant_id, measurement_type_id, ts") == 2
+    assert ddl.count('FROM "fact_measurement_2024_01" f WHERE') == 1
+    # each month is rolled up as it moves, from the load month itself
+    for month in ("2023_12", "2024_01"):
+        merge = next(i for i, d in enumerate(conn.ddl) if d.startswith("INSERT INTO agg_measurement_daily")
+                     and f'FROM "{load}_{month}" f' in d)
+        assert conn.ddl[merge - 1] == f'ALTER TABLE "{load}" DETACH PARTITION "{load}_{month}";'
+    assert conn.ddl[-1] == f'DROP TABLE IF EXISTS "{load}";'
+    assert pm.known == set()
+
+def test_finish_detached_drops_a_load_that_repeats_rows():
+    load = partitions.load_table_name("sha256:abc")
+    conn = detached_conn(load, repeated=1)
+    pm = PartitionManager(by_study=False)
+    with pytest.raises(partitions.LoadOverlap, match="3 rows repeat"):
+        asyncio.run(pm.finish_detached(conn, load))
+    # nothing was moved or rolled up
+    assert not any("DETACH" in d or "INSERT" in d for d in conn.ddl)
+    assert conn.ddl[-1] == f'DROP TABLE IF EXISTS "{load}";'
@@ -0,0 +1,128 @@
+# etl-service/tests/test_pipeline.py
+import asyncio
+import time
+from contextlib import asynccontextmanager
+
+import pytest
+
+import main
+from checkpoint import Checkpoint
+
+HEADER = "study_id,participant_id,measurement_type,value,unit,timestamp,site_id,quality_score\n"
+
+class FakeConn:
+    async def execute(self, sql, *args):
+        return "UPDATE 1"
+
+def setup(tmp_path, monkeypatch, rows=1000):
+    path = tmp_path / "p.csv"
+    path.write_text(HEADER + "".join(
+        f"S1,P{i:04d},glucose,95,mg/dL,2024-01-15T09:30:00Z,A,0.9\n" for i in range(rows)))
+    conn = FakeConn()
+
+    @asynccontextmanager
+    async def fake_acquire():
+        yield conn
+
+    monkeypatch.setattr(main.db, "acquire", fake_acquire)
+    monkeypatch.setattr(main.dim_cache, "warmed", True)
+    monkeypatch.setattr(main, "PIPELINE_DEPTH", 2)
+    main.jobs["pipe-1"] = {"jobId": "pipe-1"}
+    return str(path)
+
+def run(path, cp=None):
+    cp = cp or Checkpoint("sha256:x", "pipe-1")
+    return main.process_stream("pipe-1", path, "p.csv", None, "row", cp)
+
+def test_parsing_does_not_block_the_event_loop(tmp_path, monkeypatch):
+    path = setup(tmp_path, monkeypatch, rows=500)
+    parse = main._parse
+
+    def slow_parse(chunk, study_id, load_mode, ts_parser=None):
+        time.sleep(0.04)  # CPU-bound stand-in: holds the thread, not the loop
+        return parse(chunk, study_id, load_mode, ts_parser)
+
+    async def fake_load(conn, recs, filename, load_mode, before_commit=None, table=None, rejects=None):
+        await asyncio.sleep(0.04)  # database round trip
+        return len(recs), 0
+
+    monkeypatch.setattr(main, "_parse", slow_parse)
+    monkeypatch.setattr(main, "_load", fake_load)
+
+    async def scenario():
+        ticks = 0
+        load = asyncio.create_task(run(path))
+        while not load.done():
+            await asyncio.sleep(0.005)
+            ticks += 1
+        return await load, ticks
+
+    t0 = time.perf_counter()
+    processed, ticks = asyncio.run(scenario())
+    elapsed = time.perf_counter() - t0
+    assert processed == 500
+    assert ticks >= 10
+    # five chunks: parse and write overlap instead of adding up (~0.4s)
+    assert elapsed < 0.35
+
+def test_reading_is_bounded_by_the_writer(tmp_path, monkeypatch):
+    path = setup(tmp_path, monkeypatch)
+    parsed, written = [], []
+    parse = main._parse
+
+    def counting_parse(chunk, study_id, load_mode, ts_parser=None):
+        parsed.append(len(chunk))
+        return parse(chunk, study_id, load_mode, ts_parser)
+
+    async def slow_load(conn, recs, filename, load_mode, before_commit=None, table=None, rejects=None):
+        # raw and parsed queues hold 2 chunks each, plus one in each stage
+        assert len(parsed) - len(written) <= 2 * main.PIPELINE_DEPTH + 2
+        await asyncio.sleep(0.005)
+        await before_commit(conn)
+        written.append(recs[0]["participant_id"])
+        return len(recs), 0
+
+    monkeypatch.setattr(main, "_parse", counting_parse)
+    monkeypatch.setattr(main, "_load", slow_load)
+    assert asyncio.run(run(path)) == 1000
+    assert written == [f"P{i:04d}" for i in range(0, 1000, 100)]  # in file order
+
+def test_stage_failure_is_raised_by_the_job(tmp_path, monkeypatch):
+    path = setup(tmp_path, monkeypatch)
+    calls = []
+
+    def bad_parse(chunk, study_id, load_mode, ts_parser=None):
+        calls.append(1)
+        if len(calls) == 3:
+            raise ValueError("bad chunk")
+        return [{"participant_id": r["participant_id"]} for r in chunk]
+
+    async def fake_load(conn, recs, filename, load_mode, before_commit=None, table=None, rejects=None):
+        return len(recs), 0
+
+    monkeypatch.setattr(main, "_parse", bad_parse)
+    monkeypatch.setattr(main, "_load", fake_load)
+    with pytest.raises(ValueError, match="bad chunk"):
+        asyncio.run(run(path))
+
+def test_each_stream_detects_timestamps_with_its_own_parser(tmp_path, monkeypatch):
+    path = setup(tmp_path, monkeypatch)
+    parsers = []
+    parse = main._parse
+
+    def recording_parse(chunk, study_id, load_mode, ts_parser=None):
+        parsers.append(ts_parser)
+        return parse(chunk, study_id, load_mode, ts_parser)
+
+    async def fake_load(conn, recs, filename, load_mode, before_commit=None, table=None, rejects=None):
+        return len(recs), 0
+
+    monkeypatch.setattr(main, "_parse", recording_parse)
+    monkeypatch.setattr(main, "_load", fake_load)
+
+    async def two_jobs():
+        return await asyncio.gather(run(path), run(path, Checkpoint("sha256:y", "pipe-1")))
+    assert asyncio.run(two_jobs()) == [1000, 1000]
+    # ten chunks each, never through a parser the other stream was detecting with
+    assert sorted(parsers.count(p) for p in set(parsers)) == [10, 10]
+    assert all(p.layout.name == "utc" for p in parsers)
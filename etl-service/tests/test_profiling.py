@@ -0,0 +1,164 @@
+# etl-service/tests/test_profiling.py
+import asyncio
+import json
+import random
+from contextlib import asynccontextmanager
+
+import numpy as np
+from fastapi.testclient import TestClient
+
+import batchparse
+import main
+import profiling
+from parsing import parse_row
+from profiling import HyperLogLog, Profile, TDigest
+
+
+def rows(n, study="S1", seed=0):
+    rnd = random.Random(seed)
+    out = []
+    for i in range(n):
+        mt = rnd.choice(["glucose", "heart_rate", "blood_pressure"])
+        value = f"{rnd.randint(90, 160)}/{rnd.randint(60, 100)}" if mt == "blood_pressure" else str(rnd.randint(40, 400))
+        out.append({"study_id": study, "participant_id": f"P{rnd.randrange(500)}", "measurement_type": mt,
+                    "value": value, "unit": "", "timestamp": "2024-01-15T09:30:00Z",
+                    "site_id": f"SITE_{i % 4}", "quality_score": str(rnd.random())})
+    return out
+
+
+def test_hyperloglog_estimates_and_merges():
+    a, b = HyperLogLog(), HyperLogLog()
+    for lo in range(0, 60_000, 5_000):
+        a.add([f"P{i}" for i in range(lo, lo + 5_000)])
+    b.add([f"P{i}" for i in range(40_000, 100_000)] + ["", None])
+    assert abs(a.estimate() - 60_000) < 60_000 * 0.05
+    a.merge(HyperLogLog.from_dict(json.loads(json.dumps(b.to_dict()))))
+    assert abs(a.estimate() - 100_000) < 100_000 * 0.05
+    small = HyperLogLog()
+    small.add(["x", "y", "x"])
+    assert small.estimate() == 2
+
+
+def test_tdigest_quantiles_stay_close_with_bounded_centroids():
+    x = np.random.default_rng(1).lognormal(4, 0.5, 200_000)
+    t = TDigest()
+    for part in np.array_split(x, 40):
+        t.add(part)
+    assert len(t.means) <= t.compression / 2 + 1
+    for q in (0.01, 0.25, 0.5, 0.75, 0.99):
+        assert abs(t.quantile(q) - np.quantile(x, q)) < 0.01 * np.quantile(x, q)
+    assert t.quantile(0) == x.min() and t.quantile(1) == x.max()
+    merged = TDigest()
+    merged.merge(TDigest.from_dict(json.loads(json.dumps(t.to_dict()))))
+    merged.merge(t)
+    assert merged.count == 2 * len(x) and abs(merged.quantile(0.5) - t.quantile(0.5)) < 1e-6 * t.quantile(0.5)
+
+
+def test_row_and_bulk_paths_give_the_same_profile():
+    data = rows(2_000) + rows(500, study="S2", seed=1)
+    bulk, by_row = Profile(), Profile()
+    cols = {c: [r.get(c) for r in data] for c in batchparse.CSV_COLUMNS}
+    bulk.observe(batchparse.parse_batch(cols))
+    by_row.observe_records([parse_row(r) for r in data])
+    assert bulk.summary() == by_row.summary()
+    s1 = bulk.summary()["studies"]["S1"]
+    assert s1["rows"] == 2_000 and s1["sites"] == 4 and abs(s1["participants"] - 500) < 25
+    bp = s1["measurementTypes"]["blood_pressure"]
+    assert "value" not in bp and bp["systolic"]["min"] >= 90 and bp["diastolic"]["max"] <= 100
+    assert s1["flags"]  # e.g. glucose out of range
+    assert set(s1["flags"]) <= {f for r in data[:2_000] for f in parse_row(r)["flags"]}
+
+
+def test_study_profile_merges_the_sketches_of_every_job(client: TestClient, monkeypatch):
+    first, second = Profile(), Profile()
+    first.observe_records([parse_row(r) for r in rows(300)])
+    second.observe_records([parse_row(r) for r in rows(300, seed=2)])
+    stored = {"job-a": first, "job-b": second}
+
+    class FakeConn:
+        async def fetch(self, sql, study_id):
+            assert sql is profiling.SELECT_STUDY_SKETCHES
+            return [{"id": j, "sketch": json.dumps(p.to_dict()[study_id])} for j, p in stored.items()
+                    if study_id in p.studies]
+
+    @asynccontextmanager
+    async def fake_acquire():
+        yield FakeConn()
+    monkeypatch.setattr(main.db, "acquire", fake_acquire)
+
+    body = client.get("/studies/S1/profile").json()
+    both = Profile()
+    both.merge(first)
+    both.merge(second)
+    assert body == {"studyId": "S1", "jobs": ["job-a", "job-b"], **both.summary()["studies"]["S1"]}
+    assert body["rows"] == 600
+    assert client.get("/studies/S9/profile").status_code == 404
+
+
+def test_job_details_show_the_summary_but_not_the_sketches(client: TestClient):
+    p = Profile()
+    p.observe_records([parse_row(r) for r in rows(10)])
+    main.jobs["profiled"] = {"jobId": "profiled", "status": "completed", **main._profile_fields(p)}
+    try:
+        body = client.get("/jobs/profiled").json()
+        assert body["profile"]["studies"]["S1"]["rows"] == 10 and "profileSketches" not in body
+        assert "profileSketches" in main.jobs["profiled"]
+    finally:
+        main.jobs.pop("profiled")
+
+
+def test_only_the_job_scope_profiles():
+    batch = batchparse.parse_batch({c: [r.get(c) for r in rows(5)] for c in batchparse.CSV_COLUMNS})
+    profiling.observe(batch)  # no job: nothing to do
+
+    async def shard():
+        profiling.observe(batch)
+
+    async def job():
+        with profiling.job_scope() as p:
+            profiling.observe(batch)
+            await asyncio.create_task(shard())  # tasks started by the job report to it too
+        return p
+    assert asyncio.run(job()).summary()["studies"]["S1"]["rows"] == 10
+
+
+class ChunkConn:
+    """The first chunk transaction rolls back; after that the upsert leaves chunk position 0 alone."""
+
+    def __init__(self):
+        self.fail = True
+
+    @asynccontextmanager
+    async def transaction(self):
+        yield
+
+    async def execute(self, sql, *args):
+        return "OK"
+
+    async def fetch(self, sql, *args):
+        return []
+
+    async def fetchval(self, sql, *args):
+        return 1
+
+    async def fetchrow(self, sql, *args):
+        return {"written": 3, "existing": 1, "inserted": 3, "touched": None, "unwritten": [0]}
+
+    async def copy_records_to_table(self, table, records, columns):
+        if self.fail:
+            self.fail = False
+            raise RuntimeError("copy failed")
+
+
+def test_only_rows_a_committed_chunk_wrote_are_profiled():
+    data = rows(5)
+    data[2]["timestamp"] = "not-a-date"  # quarantined
+    batch = batchparse.parse_batch({c: [r.get(c) for r in data] for c in batchparse.CSV_COLUMNS})
+
+    async def job():
+        with profiling.job_scope() as p:
+            # the COPY fails and the chunk is replayed: still observed once
+            await main.load_chunk(ChunkConn(), batch, "f.csv")
+        return p
+    # 5 rows, one quarantined, one a key already loaded
+    assert asyncio.run(job()).summary()["studies"]["S1"]["rows"] == 3
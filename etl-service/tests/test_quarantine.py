@@ -0,0 +1,111 @@
+# etl-service/tests/test_quarantine.py
+import asyncio
+import math
+from contextlib import asynccontextmanager
+
+from fastapi.testclient import TestClient
+
+import dedupe
+import main
+import metrics
+import quarantine
+from quarantine import ChunkRejects
+
+ROW = {"study_id": "S1", "participant_id": "P1", "measurement_type": "glucose", "value": "95",
+       "unit": "mg/dL", "timestamp": "2024-01-15T09:30:00Z", "site_id": "SITE_A", "quality_score": "0.9"}
+
+
+class FakeConn:
+    """Staging a fact batch fails for any batch holding participant BAD."""
+    def __init__(self):
+        self.batches = []
+        self.copied = []
+        self.order = []
+
+    @asynccontextmanager
+    async def transaction(self):
+        yield
+
+    async def execute(self, sql, *args):
+        return "OK"
+
+    async def fetchval(self, sql, *args):
+        return 1
+
+    async def fetch(self, sql, *args):
+        return []
+
+    async def fetchrow(self, sql, *args):
+        n = len(self.batches[-1])
+        return {"written": n, "existing": 0, "inserted": n, "touched": None, "unwritten": None}
+
+    async def copy_records_to_table(self, table, records, columns):
+        if table == dedupe.FACT_STAGE:
+            self.batches.append([a[1] for a in records])
+            if any(a[1] == "BAD" for a in records):
+                raise ValueError("violates foreign key")
+            return
+        assert table == quarantine.TABLE and columns == quarantine.COLUMNS
+        self.copied.append(list(records))
+        self.order.append("rejects")
+
+
+def test_precheck_sets_aside_rows_that_cannot_be_inserted(monkeypatch):
+    ts = [object(), None, object(), object(), object(), None]
+    quality = [0.5, 0.5, 1.5, math.nan, 0.5, 0.5]
+    valid = [True, True, True, True, False, True]
+    flags = [[], [], [], [], ["non_numeric_value"], ["unparseable_timestamp"]]
+    before = metrics.service.rows["bad_timestamp"]
+    assert quarantine.precheck(ts, quality, valid, flags) == {
+        1: ("error", quarantine.MISSING_TS), 2: ("error", quarantine.BAD_QUALITY), 3: ("error", quarantine.BAD_QUALITY),
+        4: ("invalid", "non_numeric_value"), 5: ("error", quarantine.BAD_TS),
+    }
+    assert metrics.service.rows["bad_timestamp"] == before + 1
+    monkeypatch.setattr(quarantine, "QUARANTINE_INVALID", False)  # load invalid rows flagged
+    assert 4 not in quarantine.precheck(ts, quality, valid, flags)
+
+
+def test_non_numeric_quality_score_is_quarantined_not_fatal():
+    raws = [ROW, dict(ROW, participant_id="P2", quality_score="high")]
+    bulk = main._parse({k: [r[k] for r in raws] for k in ROW}, None, "bulk")
+    assert quarantine.precheck(bulk["ts"], bulk["quality_score"], bulk["is_valid"], bulk["flags"]) == {
+        1: ("error", quarantine.BAD_QUALITY)}
+    conn = FakeConn()
+    rejects = ChunkRejects("job-q", "f.csv", quarantine.raw_rows(raws), first_row=1)
+    assert asyncio.run(main.insert_rows(conn, main._parse(raws, None, "row"), "f.csv", rejects=rejects)) == (1, 1)
+    [(bad,)] = conn.copied
+    assert bad[2] == 2 and bad[5] == quarantine.BAD_QUALITY and "non_numeric_quality_score" in bad[6]
+
+
+def test_raw_rows_render_chunks_as_csv(tmp_path):
+    assert quarantine.raw_rows([{"a": "x,y", "b": None}])(0) == '"x,y",'
+    assert quarantine.raw_rows({"a": ["1", "2"], "b": ["3", "4"]})(1) == "2,4"
+    path = tmp_path / "piece.csv"
+    path.write_text("h1,h2\nS1,P1\n\nS1,P2\n")
+    raw = quarantine.raw_piece(str(path), 6, path.stat().st_size)
+    assert raw(1) == "S1,P2" and raw(2) is None
+
+
+def test_failed_chunk_is_replayed_in_sub_batches_and_rejects_are_written_first(monkeypatch):
+    monkeypatch.setattr(main, "REPLAY_BATCH", 2)
+    conn = FakeConn()
+    raws = [dict(ROW, participant_id=p) for p in ("P0", "P1", "P2", "BAD", "P4")]
+    raws.insert(1, dict(ROW, participant_id="NOTS", timestamp="yesterday"))
+    recs = [main.parse_row(r) for r in raws]
+    rejects = ChunkRejects("job-q", "f.csv", quarantine.raw_rows(raws), first_row=11)
+
+    async def checkpoint(c):
+        conn.order.append("checkpoint")
+
+    assert asyncio.run(main.insert_rows(conn, recs, "f.csv", checkpoint, rejects=rejects)) == (4, 2)
+    # whole chunk, then sub-batches of 2; only the failing one is split into rows
+    assert conn.batches == [["P0", "P1", "P2", "BAD", "P4"], ["P0", "P1"], ["P2", "BAD"], ["P2"], ["BAD"], ["P4"]]
+    assert conn.order == ["rejects", "checkpoint"]
+    (bad_ts, bad), = conn.copied
+    assert bad_ts[:3] == ("job-q", "f.csv", 12) and bad_ts[5] == quarantine.BAD_TS
+    assert bad[2] == 15 and bad[3].startswith("S1,BAD,glucose") and "foreign key" in bad[5]
+
+
+def test_rejects_endpoint_needs_a_known_job(client: TestClient):
+    assert client.get("/jobs/no-such-job/rejects").status_code == 404
+    assert client.get("/jobs/no-such-job/rejects?limit=0").status_code == 422
@@ -0,0 +1,46 @@
+# etl-service/tests/test_reader.py
+from reader import CSVStream
+
+HEADER = "study_id,participant_id,measurement_type,value,unit,timestamp,site_id,quality_score\n"
+
+def test_stream_reports_byte_progress_in_one_pass(tmp_path):
+    path = tmp_path / "s.csv"
+    path.write_text(HEADER + "".join(
+        f"S1,P{i},glucose,{i}.5,mg/dL,2024-01-15T09:30:00Z,SITE_A,0.9\n" for i in range(2000)
+    ))
+    seen = []
+    rows = 0
+    with CSVStream(str(path), block_size=4096) as stream:
+        assert stream.size == path.stat().st_size
+        for n, cols in stream.chunks(250, "bulk"):
+            rows += n
+            seen.append(stream.progress())
+        assert stream.bytes_read == stream.size
+    assert rows == 2000
+    assert seen == sorted(seen) and seen[0] < 100 and seen[-1] == 100
+
+def test_row_mode_yields_dict_rows(tmp_path):
+    path = tmp_path / "s.csv"
+    path.write_text(HEADER + "S1,P1,glucose,95.5,mg/dL,2024-01-15T09:30:00Z,SITE_A,0.98\n")
+    with CSVStream(str(path)) as stream:
+        chunks = list(stream.chunks(100, "row"))
+    assert chunks[0][0] == 1
+    assert chunks[0][1][0]["participant_id"] == "P1"
+
+def test_empty_file_is_complete(tmp_path):
+    path = tmp_path / "empty.csv"
+    path.write_text("")
+    with CSVStream(str(path)) as stream:
+        assert list(stream.chunks(10, "bulk")) == []
+        assert stream.progress() == 100
+
+def test_byte_order_mark_is_not_part_of_the_header(tmp_path):
+    path = tmp_path / "bom.csv"
+    path.write_bytes(b"\xef\xbb\xbf" + (HEADER + "S1,P1,glucose,95.5,mg/dL,2024-01-15T09:30:00Z,SITE_A,0.98\n").encode())
+    with CSVStream(str(path)) as stream:
+        [(_, rows)] = stream.chunks(100, "row")
+    assert rows[0]["study_id"] == "S1"
+    with CSVStream(str(path)) as stream:
+        [(_, cols)] = stream.chunks(100, "bulk")
+        assert stream.bytes_read == stream.size
+    assert list(cols["study_id"]) == ["S1"]
@@ -0,0 +1,166 @@
+# etl-service/tests/test_rollups.py
+import asyncio
+from contextlib import asynccontextmanager
+from datetime import date
+
+import pytest
+from fastapi.testclient import TestClient
+
+import batchparse
+import dedupe
+import loader
+import main
+import partitions
+import rollups
+
+class FakeConn:
+    def __init__(self):
+        self.executed = []
+
+    @asynccontextmanager
+    async def transaction(self):
+        yield
+
+    async def execute(self, sql, *args):
+        self.executed.append((sql, args))
+        return "INSERT 0 7" if sql.startswith("INSERT") else "DELETE 3"
+
+def test_rebuild_replaces_the_slice():
+    conn = FakeConn()
+    assert asyncio.run(rollups.rebuild(conn, "S1", date(2024, 1, 15))) == 7
+    (delete, dargs), (insert, iargs) = conn.executed
+    assert delete.startswith("DELETE FROM agg_measurement_daily WHERE study_id = $1 AND day = $2")
+    assert dargs == iargs == ("S1", date(2024, 1, 15))
+    assert "FROM fact_measurement f WHERE f.study_id = $1 AND f.ts >= $2" in insert
+
+def test_rebuild_needs_a_study_or_day():
+    with pytest.raises(ValueError):
+        asyncio.run(rollups.rebuild(FakeConn()))
+    client = TestClient(main.app)
+    assert client.post("/rollups/rebuild", json={}).status_code == 400
+
+def test_merge_sql_adds_every_stat_into_the_existing_row():
+    sql = rollups.merge_sql('"etl_load_x_2024_01"')
+    assert f"INSERT INTO agg_measurement_daily AS a ({', '.join(rollups.COLUMNS)})" in sql
+    assert 'FROM "etl_load_x_2024_01" f' in sql
+    # a key already rolled up is merged into, never replaced or duplicated
+    assert f"ON CONFLICT ({', '.join(rollups.KEY)}) DO UPDATE SET" in sql
+    merged = sql.split("DO UPDATE SET", 1)[1]
+    for col in rollups.COLUMNS:
+        if col not in rollups.KEY:
+            assert f"{col} = " in merged, col
+    # rows are produced in key order, so concurrent merges lock them in the same order
+    assert "ORDER BY 1, 2, 3, 4\nON CONFLICT" in sql
+    assert "n = a.n + EXCLUDED.n" in merged
+    assert not sql.rstrip().endswith(";")
+
+
+class TxConn:
+    """Fake connection that tracks which statements commit and which roll back."""
+    def __init__(self, load, fail_attach=None):
+        self.load = load
+        self.fail_attach = fail_attach
+        self.pending = None
+        self.committed = []
+        self.rolled_back = []
+
+    @asynccontextmanager
+    async def transaction(self):
+        self.pending = []
+        try:
+            yield
+        except BaseException:
+            self.rolled_back += self.pending
+            raise
+        else:
+            self.committed += self.pending
+        finally:
+            self.pending = None
+
+    async def execute(self, sql, *args):
+        if sql is partitions.LOCK_NAME:
+            return "OK"
+        if self.fail_attach and "ATTACH PARTITION" in sql and self.fail_attach in sql:
+            raise RuntimeError("attach failed")
+        (self.committed if self.pending is None else self.pending).append(sql)
+        return "OK"
+
+    async def fetch(self, sql, *args):
+        if sql is partitions.PARTITION_TREE:
+            return []
+        if args and args[0] == self.load:
+            return [{"name": f"{self.load}_{m}", "bound": f"FOR VALUES FROM ('{m}')"} for m in ("2024_01", "2024_02")]
+        return []
+
+    async def fetchval(self, sql, *args):
+        return 0
+
+    def merged(self, sqls):
+        return [m for m in ("2024_01", "2024_02")
+                if any(s.startswith("INSERT INTO agg_measurement_daily") and f'"{self.load}_{m}" f' in s for s in sqls)]
+
+
+def test_detached_months_are_rolled_up_with_the_move(monkeypatch):
+    monkeypatch.setattr(rollups, "ENABLED", True)
+    load = partitions.load_table_name("sha256:abc")
+    conn = TxConn(load)
+    asyncio.run(partitions.PartitionManager(by_study=False).finish_detached(conn, load))
+    assert conn.merged(conn.committed) == ["2024_01", "2024_02"]
+    assert conn.rolled_back == []
+
+
+def test_a_month_that_fails_to_attach_is_not_rolled_up(monkeypatch):
+    monkeypatch.setattr(rollups, "ENABLED", True)
+    load = partitions.load_table_name("sha256:abc")
+    conn = TxConn(load, fail_attach="fact_measurement_2024_02")
+    with pytest.raises(RuntimeError):
+        asyncio.run(partitions.PartitionManager(by_study=False).finish_detached(conn, load))
+    # January stays rolled up; February's merge goes back with its rows
+    assert conn.merged(conn.committed) == ["2024_01"]
+    assert conn.merged(conn.rolled_back) == ["2024_02"]
+
+
+def test_detached_months_are_not_rolled_up_when_disabled(monkeypatch):
+    monkeypatch.setattr(rollups, "ENABLED", False)
+    load = partitions.load_table_name("sha256:abc")
+    conn = TxConn(load)
+    attached = asyncio.run(partitions.PartitionManager(by_study=False).finish_detached(conn, load))
+    assert attached == ["fact_measurement_2024_01", "fact_measurement_2024_02"]
+    assert conn.merged(conn.committed) == []
+
+
+class ChunkConn:
+    def __init__(self):
+        self.fetched = []
+
+    @asynccontextmanager
+    async def transaction(self):
+        yield
+
+    async def execute(self, sql, *args):
+        return "OK"
+
+    async def fetch(self, sql, *args):
+        return []
+
+    async def copy_records_to_table(self, table, records, columns):
+        self.rows = len(list(records))
+
+    async def fetchrow(self, sql, *args):
+        self.fetched.append(sql)
+        return {"written": self.rows, "existing": 0, "inserted": self.rows, "touched": None, "unwritten": None}
+
+
+ROW = {"study_id": "S1", "participant_id": "P1", "measurement_type": "glucose", "value": "95", "unit": "mg/dL",
+       "timestamp": "2024-01-15T09:30:00Z", "site_id": "SITE_A", "quality_score": "0.9"}
+
+@pytest.mark.parametrize("enabled", [True, False])
+def test_chunk_rows_are_rolled_up_by_the_fact_upsert(monkeypatch, enabled):
+    monkeypatch.setattr(rollups, "ENABLED", enabled)
+    conn = ChunkConn()
+    batch = batchparse.parse_batch(batchparse.columns_from_rows([ROW]))
+    asyncio.run(loader.copy_chunk(conn, batch, "f.csv"))
+    # one statement writes the facts and, when enabled, merges the rows it inserted
+    (upsert,) = conn.fetched
+    assert upsert == dedupe.upsert_sql(loader.STAGE_FACTS, "fact_measurement", "skip")
+    assert (rollups.merge_sql("new") in upsert) is enabled
@@ -0,0 +1,56 @@
+# etl-service/tests/test_rules.py
+import json
+
+import pytest
+
+import batchparse
+import parsing
+import rules
+from parsing import NO_FLAGS, parse_row
+from rules import RuleEngine
+
+def row(mt, value, unit):
+    return {"study_id": "S1", "participant_id": "P1", "measurement_type": mt, "value": value,
+            "unit": unit, "timestamp": "2024-01-15T09:30:00Z", "site_id": "A", "quality_score": "1"}
+
+def test_default_rules_flag_numeric_ranges():
+    rec = parse_row(row("glucose", "600", "mg/dL"))
+    assert rec["flags"] == ["value_out_of_range"] and rec["is_valid"]
+    # ranges apply after conversion: 900 lb is ~408 kg
+    rec = parse_row(row("weight", "900", "LBS"))
+    assert rec["unit"] == "kg" and rec["flags"] == ["value_out_of_range"]
+    assert parse_row(row("weight", "150", "lb"))["flags"] is NO_FLAGS
+    assert parse_row(row("blood_pressure", "300/200", ""))["flags"] == ["systolic_out_of_range", "diastolic_out_of_range"]
+
+def test_config_file_adds_types_and_flag_rules(tmp_path, monkeypatch):
+    path = tmp_path / "rules.json"
+    path.write_text(json.dumps({"types": {
+        "SpO2": {"unit": "%", "convert": {"fraction": 100}, "ranges": {"value": [50, 100]},
+                 "flags": [{"field": "value", "min": 90, "flag": "low_spo2"}]},
+        "bp_standing": {"kind": "bp", "unit": "mmHg", "ranges": {"systolic": [60, 260]}},
+    }}))
+    engine = RuleEngine(rules.load_config(str(path)))
+    assert engine.types["glucose"].checks  # built-in types are kept
+    assert engine.convert("spo2", "Fraction", 0.97) == (97.0, "%")
+    assert engine.flags("spo2", 45.0) == ["value_out_of_range", "low_spo2"]
+    assert engine.flags("spo2", 95.0) == []
+
+    monkeypatch.setattr(parsing, "engine", engine)
+    monkeypatch.setattr(batchparse, "engine", engine)
+    rows = [row("spo2", v, u) for v, u in [("0.85", "fraction"), ("97", "%"), ("40", "%"), ("x", "%")]]
+    rows += [row("bp_standing", v, "") for v in ["120/80", "300/80", "1-2"]]
+    expected = [parse_row(r) for r in rows]
+    assert [list(r["flags"]) for r in expected] == [
+        ["low_spo2"], [], ["value_out_of_range", "low_spo2"], ["non_numeric_value"],
+        [], ["systolic_out_of_range"], ["invalid_bp_format"],
+    ]
+    assert expected[4]["systolic"] == 120 and expected[4]["unit"] == "mmHg"
+    assert batchparse.parse_rows(rows) == expected
+
+def test_bad_config_is_rejected_at_compile_time():
+    with pytest.raises(ValueError):
+        RuleEngine({"types": {"x": {"kind": "text"}}})
+    with pytest.raises(ValueError):
+        RuleEngine({"types": {"x": {"ranges": {"weight": [1, 2]}}}})
+    with pytest.raises(ValueError):
+        RuleEngine({"types": {"x": {"convert": {"g": 0.001}}}})
@@ -0,0 +1,81 @@
+# etl-service/tests/test_sharding.py
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+
+import batchparse
+import main
+import reader
+import sharding
+from checkpoint import Checkpoint
+from scheduler import JobScheduler
+
+HEADER = "study_id,participant_id,measurement_type,value,unit,timestamp,site_id,quality_score\n"
+
+def write_csv(tmp_path, n=500):
+    lines = [f"S1,P{i:04d},glucose,{90 + i % 50}.5,mg/dL,2024-01-15T09:{i % 60:02d}:00Z,SITE_{i % 3},0.9\n" for i in range(n)]
+    path = tmp_path / "big.csv"
+    path.write_text(HEADER + "".join(lines))
+    return str(path)
+
+def test_plan_shards_covers_every_row_once(tmp_path):
+    path = write_csv(tmp_path)
+    header, plan = sharding.plan_shards(path, 4, piece_bytes=1000)
+    assert header == HEADER.strip().split(",")
+    assert len(plan) == 4
+    pieces = [p for shard in plan for p in shard]
+    assert pieces[0][0] == len(HEADER)
+    assert all(a[1] == b[0] for a, b in zip(pieces, pieces[1:]))  # contiguous, no gaps
+    sharded = []
+    for start, end in pieces:
+        sharded += batchparse.to_records(sharding.parse_range(path, start, end, header))
+    with open(path, newline="") as f:
+        whole = [rec for _, cols in reader.iter_chunks(f, 10_000, "bulk")
+                 for rec in batchparse.to_records(batchparse.parse_batch(cols))]
+    assert sharded == whole
+
+def test_scheduler_bounds_concurrency():
+    sched = JobScheduler(max_jobs=2)
+    peak = 0
+
+    async def job():
+        nonlocal peak
+        peak = max(peak, sched.running)
+        await asyncio.sleep(0.01)
+
+    async def run_all():
+        await asyncio.gather(*(sched.run(job) for _ in range(6)))
+
+    asyncio.run(run_all())
+    assert peak == 2
+    assert sched.stats() == {"maxJobs": 2, "running": 0, "queued": 0, "completed": 6}
+
+def test_process_sharded_rolls_up_progress(tmp_path, monkeypatch):
+    path = write_csv(tmp_path)
+    loaded = []
+
+    @asynccontextmanager
+    async def fake_acquire():
+        yield object()
+
+    async def fake_load_chunk(conn, batch, filename, before_commit=None, table=None, rejects=None):
+        loaded.extend(batch["participant_id"])
+        assert set(batch["study_id"]) == {"STUDY_X"}
+        return len(batch["study_id"]), 0
+
+    monkeypatch.setattr(main.db, "acquire", fake_acquire)
+    monkeypatch.setattr(main, "load_chunk", fake_load_chunk)
+    monkeypatch.setattr(main.dim_cache, "warmed", True)
+    monkeypatch.setattr(main, "SHARD_PIECE_BYTES", 2000)
+    with ThreadPoolExecutor(2) as ex:
+        monkeypatch.setattr(sharding, "get_executor", lambda: ex)
+        main.jobs["shard-job"] = {"jobId": "shard-job"}
+        cp = Checkpoint("sha256:x", "shard-job", shards=3, piece_bytes=2000)
+        rows = asyncio.run(main.process_sharded("shard-job", path, "big.csv", "STUDY_X", 3, cp))
+
+    job = main.jobs["shard-job"]
+    assert rows == 500 and job["progress"] == 100
+    assert len(job["shards"]) == 3
+    assert sum(s["rows"] for s in job["shards"]) == 500
+    assert job["rowsProcessed"] == job["rowsInserted"] == 500
+    assert sorted(loaded) == [f"P{i:04d}" for i in range(500)]
@@ -0,0 +1,202 @@
+# etl-service/tests/test_snapshots.py
+import asyncio
+import os
+from contextlib import asynccontextmanager
+
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+import pytest
+from fastapi.testclient import TestClient
+
+import batchparse
+import dedupe
+import main
+import rollups
+import snapshots
+
+
+def row(participant, ts, value="95", study="S1", mt="glucose"):
+    return {"study_id": study, "participant_id": participant, "measurement_type": mt, "value": value,
+            "unit": "mg/dL", "timestamp": ts, "site_id": "SITE_A", "quality_score": "0.9"}
+
+
+def batch(rows):
+    return batchparse.parse_batch(batchparse.columns_from_rows(rows))
+
+
+@pytest.fixture
+def root(tmp_path, monkeypatch):
+    monkeypatch.setattr(snapshots, "ROOT", str(tmp_path))
+    return str(tmp_path)
+
+
+def files(root, study, month):
+    return sorted(os.listdir(snapshots.partition_dir(root, study, month)))
+
+
+def test_job_files_are_partitioned_sorted_and_published_at_the_end(root, monkeypatch):
+    monkeypatch.setattr(snapshots, "ROW_GROUP_ROWS", 2)
+    rows = [row("P2", "2024-01-20T00:00:00Z"), row("P1", "2024-01-03T00:00:00Z"),
+            row("P1", "2024-02-01T00:00:00Z"), row("P3", "2024-01-10T00:00:00Z"),
+            row("P4", "2024-01-05T00:00:00Z", study="S2"), row("P5", "2024-01-01T00:00:00Z")]
+
+    async def job():
+        with snapshots.job_scope("job-1") as w:
+            await snapshots.add(batch(rows), {5}, "f.csv")  # row 5 was rejected
+            # the full January group of S1 is already out, but only under its temporary name
+            assert files(root, "S1", "2024-01") == ["part-job-1.parquet.tmp"]
+            return await snapshots.finish(w)
+    out = asyncio.run(job())["snapshot"]
+    assert out["rows"] == 5
+    assert sorted(out["partitions"]) == ["study_id=S1/month=2024-01", "study_id=S1/month=2024-02",
+                                         "study_id=S2/month=2024-01"]
+    [name] = files(root, "S1", "2024-01")
+    assert name.startswith("part-") and name.endswith("-job-1.parquet")
+
+    meta = pq.ParquetFile(os.path.join(snapshots.partition_dir(root, "S1", "2024-01"), name)).metadata
+    assert meta.num_rows == 3 and meta.num_row_groups == 2
+    ts_col = meta.schema.names.index("ts")
+    first = meta.row_group(0).column(ts_col).statistics
+    assert first.has_min_max and first.min < first.max  # sorted by ts within the row group
+    participant = meta.row_group(0).column(meta.schema.names.index("participant_id"))
+    assert "RLE_DICTIONARY" in participant.encodings
+
+    table = ds.dataset(root, format="parquet", partitioning="hive").to_table(
+        filter=(ds.field("study_id") == "S1") & (ds.field("month") == "2024-01"))
+    assert sorted(table.column("participant_id").to_pylist()) == ["P1", "P2", "P3"]
+    assert set(table.column("source_file").to_pylist()) == {"f.csv"}
+
+
+def test_dropped_snapshot_leaves_no_files(root):
+    async def job():
+        with snapshots.job_scope("job-2") as w:
+            await snapshots.add(batch([row("P1", "2024-01-03T00:00:00Z")]), set(), "f.csv")
+            return await snapshots.finish(w, publish=False)
+    assert asyncio.run(job()) == {"snapshot": {"rows": 0, "partitions": []}}
+    assert not os.listdir(root)  # nothing was flushed yet, so there is not even a directory
+    assert asyncio.run(snapshots.finish(None)) == {}
+
+
+def test_compaction_keeps_the_newest_copy_of_each_row(root, client: TestClient):
+    async def job(job_id, rows):
+        with snapshots.job_scope(job_id) as w:
+            await snapshots.add(batch(rows), set(), "f.csv")
+            return await snapshots.finish(w)
+    asyncio.run(job("a", [row("P1", "2024-01-03T00:00:00Z", "90"), row("P2", "2024-01-02T00:00:00Z", "80")]))
+    asyncio.run(job("b", [row("P1", "2024-01-03T00:00:00Z", "99"), row("P3", "2024-01-01T00:00:00Z", "70")]))
+    assert len(files(root, "S1", "2024-01")) == 2
+
+    r = client.post("/studies/S1/snapshot")
+    assert r.status_code == 200
+    assert r.json()["months"] == [{"month": "2024-01", "files": 2, "rows": 3, "duplicatesDropped": 1}]
+    [name] = files(root, "S1", "2024-01")
+    assert name.endswith("-compacted.parquet")
+    table = pq.read_table(os.path.join(snapshots.partition_dir(root, "S1", "2024-01"), name))
+    assert table.column("participant_id").to_pylist() == ["P3", "P2", "P1"]  # by ts
+    assert table.column("value").to_pylist() == [70.0, 80.0, 99.0]  # the re-sent P1 row wins
+    assert client.post("/studies/S9/snapshot").status_code == 404
+
+
+def test_ids_cannot_reach_outside_the_snapshot_dir(root):
+    async def job():
+        with snapshots.job_scope("../../job") as w:
+            await snapshots.add(batch([row("P1", "2024-01-03T00:00:00Z", study="../../etc")]), set(), "f.csv")
+            return await snapshots.finish(w)
+    asyncio.run(job())
+    assert os.listdir(root) == ["study_id=..%2F..%2Fetc"]
+    [name] = files(root, "../../etc", "2024-01")
+    assert name.endswith("-..%2F..%2Fjob.parquet")
+    # readers decode the partition value back
+    table = ds.dataset(root, format="parquet", partitioning="hive").to_table()
+    assert table.column("study_id").to_pylist() == ["../../etc"]
+    assert snapshots.compact_study("..") == []
+
+
+def test_snapshot_endpoint_needs_a_snapshot_dir(client: TestClient, monkeypatch):
+    monkeypatch.setattr(snapshots, "ROOT", "")
+    assert client.post("/studies/S1/snapshot").status_code == 409
+
+
+class FakeConn:
+    @asynccontextmanager
+    async def transaction(self):
+        yield
+
+    async def execute(self, sql, *args):
+        return "INSERT 0 2"
+
+    async def fetchval(self, sql, *args):
+        return 1
+
+    async def fetch(self, sql, *args):
+        return []
+
+    async def fetchrow(self, sql, *args):
+        return {"written": 2, "existing": 0, "inserted": 2, "touched": None, "unwritten": None}
+
+    async def copy_records_to_table(self, table, records, columns):
+        pass
+
+
+def test_load_chunk_snapshots_only_the_rows_it_loaded(root):
+    rows = [row("P1", "2024-01-03T00:00:00Z"), row("P2", "not-a-date"), row("P3", "2024-01-04T00:00:00Z")]
+
+    async def job():
+        with snapshots.job_scope("job-3") as w:
+            assert await main.load_chunk(FakeConn(), batch(rows), "f.csv") == (2, 1)
+            return await snapshots.finish(w)
+    assert asyncio.run(job())["snapshot"]["rows"] == 2
+    table = ds.dataset(root, format="parquet", partitioning="hive").to_table()
+    assert sorted(table.column("participant_id").to_pylist()) == ["P1", "P3"]
+
+
+class FactConn(FakeConn):
+    """fact_measurement as a dict keyed by natural key, written by the loader's upsert."""
+
+    def __init__(self):
+        self.facts = {}
+        self.staged = []
+
+    async def copy_records_to_table(self, table, records, columns):
+        self.staged = [dict(zip(columns, r)) for r in records]
+
+    async def fetchrow(self, sql, *args):
+        update = "DO UPDATE" in sql
+        existing, unwritten = 0, []
+        for r in self.staged:
+            key = (r["study_id"], r["participant_id"], r["measurement_type"], r["ts"])
+            existing += key in self.facts
+            if key in self.facts and not update:
+                unwritten.append(r["pos"])
+            else:
+                self.facts[key] = r["value_numeric"]
+        written = len(self.staged) - len(unwritten)
+        return {"written": written, "existing": existing, "inserted": len(self.staged) - existing,
+                "touched": None, "unwritten": unwritten or None}
+
+
+def test_compacted_snapshot_matches_the_table_after_skipped_and_updated_reloads(root, monkeypatch):
+    monkeypatch.setattr(rollups, "ENABLED", False)
+    conn = FactConn()
+
+    async def job(job_id, mode, value):
+        rows = [row("P1", "2024-01-03T00:00:00Z", value), row("P2", "2024-01-04T00:00:00Z", value)]
+        with snapshots.job_scope(job_id) as w, dedupe.job_mode(mode):
+            await main.load_chunk(conn, batch(rows[:1] if job_id == "a" else rows), "f.csv")
+            return await snapshots.finish(w)
+
+    def compacted():
+        snapshots.compact_study("S1")
+        [name] = files(root, "S1", "2024-01")
+        table = pq.read_table(os.path.join(snapshots.partition_dir(root, "S1", "2024-01"), name))
+        return dict(zip(table.column("participant_id").to_pylist(), table.column("value").to_pylist()))
+
+    def stored():
+        return {participant: value for (_, participant, _, _), value in conn.facts.items()}
+
+    asyncio.run(job("a", "skip", "90"))
+    # P1 is already loaded: the skip reload leaves it alone and does not snapshot it
+    assert asyncio.run(job("b", "skip", "99"))["snapshot"]["rows"] == 1
+    assert compacted() == stored() == {"P1": 90.0, "P2": 99.0}
+    asyncio.run(job("c", "update", "101"))
+    assert compacted() == stored() == {"P1": 101.0, "P2": 101.0}
@@ -0,0 +1,150 @@
+# etl-service/tests/test_timeseries.py
+import asyncio
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+import pytest
+from fastapi.testclient import TestClient
+
+import timeseries
+from dimcache import dim_cache
+from timeseries import SeriesCache, lttb, minmax, series_cache
+
+T0 = datetime(2024, 1, 1, tzinfo=timezone.utc)
+TYPES = {1: "glucose", 2: "blood_pressure"}
+URL = "/studies/S1/participants/P1/series"
+NAN = float("nan")  # what SELECT_SERIES returns for NULL
+
+
+def reading(minutes, value=NAN, systolic=NAN, diastolic=NAN, mt=1):
+    us = int((T0 + timedelta(minutes=minutes) - timeseries.EPOCH) / timedelta(microseconds=1))
+    return {"us": us, "value": value, "systolic": systolic, "diastolic": diastolic, "unit_id": 10, "mt": mt}
+
+
+class FakeConn:
+    """Answers SELECT_SERIES for participant P1 of S1 from `rows`."""
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.queries = 0
+
+    async def fetch(self, sql, *args):
+        if sql is not timeseries.SELECT_SERIES:
+            if "measurement_type" in sql:
+                return [{"id": i, "name": n} for i, n in TYPES.items()]
+            return [{"id": 10, "name": "mg/dL"}]
+        self.queries += 1
+        study, participant, start, end, mt = args
+        lo = (start - timeseries.EPOCH) / timedelta(microseconds=1)
+        hi = (end - timeseries.EPOCH) / timedelta(microseconds=1)
+        rows = [r for r in self.rows if (study, participant) == ("S1", "P1") and r["mt"] == mt and lo <= r["us"] < hi]
+        return sorted(rows, key=lambda r: -r["us"])
+
+
+@pytest.fixture
+def conn(monkeypatch):
+    rng = np.random.default_rng(0)
+    rows = [reading(5 * i, value=float(v)) for i, v in enumerate(rng.normal(110, 10, 2_000).round(1))]
+    rows[700]["value"] = 400.0  # a spike a chart must not lose
+    rows += [reading(60 * i, systolic=120 + i % 7, diastolic=80 - i % 5, mt=2) for i in range(300)]
+    c = FakeConn(rows)
+
+    @asynccontextmanager
+    async def fake_acquire():
+        yield c
+    monkeypatch.setattr(timeseries.db, "acquire", fake_acquire)
+    dim_cache.clear()
+    series_cache.clear()
+    yield c
+    dim_cache.clear()
+    series_cache.clear()
+
+
+def test_downsampling_keeps_the_ends_and_the_extremes():
+    x = np.arange(10_000, dtype=np.int64) * 300_000_000
+    y = np.sin(np.arange(10_000) / 300.0)
+    y[4321] = 5.0
+    keep = lttb(x, y, 200)
+    assert len(keep) == 200 and np.all(np.diff(keep) > 0)
+    assert keep[0] == 0 and keep[-1] == len(x) - 1 and 4321 in keep
+    keep = minmax(x, y, 200)
+    assert len(keep) <= 200 and np.all(np.diff(keep) > 0)
+    assert 4321 in keep and y.argmin() in keep
+    assert lttb(x[:50], y[:50], 200).tolist() == list(range(50))  # fewer rows than points: all of them
+
+
+def test_series_is_downsampled_per_value_and_served_from_cache(client: TestClient, conn):
+    r = client.get(URL, params={"type": "glucose", "points": 100})
+    assert r.status_code == 200 and r.headers["x-cache"] == "miss"
+    body = r.json()
+    assert body["rows"] == 2_000 and body["unit"] == "mg/dL" and list(body["series"]) == ["value"]
+    points = body["series"]["value"]
+    assert len(points) == 100 and [400.0] == [v for _, v in points if v == 400.0]
+    assert points[0][0] == T0.isoformat() and [p[0] for p in points] == sorted(p[0] for p in points)
+
+    again = client.get(URL, params={"type": "glucose", "points": 100})
+    assert again.headers["x-cache"] == "hit" and again.content == r.content and conn.queries == 1
+    # another resolution is another entry
+    assert client.get(URL, params={"type": "glucose", "points": 50}).headers["x-cache"] == "miss"
+
+    bp = client.get(URL, params={"type": "blood_pressure", "method": "minmax", "points": 40,
+                                 "from": "2024-01-02T00:00:00+00:00"}).json()
+    assert set(bp["series"]) == {"systolic", "diastolic"} and bp["rows"] == 300 - 24
+    assert max(v for _, v in bp["series"]["systolic"]) == 126 and min(v for _, v in bp["series"]["diastolic"]) == 76
+
+
+def test_loads_drop_only_the_series_of_their_participants(client: TestClient, conn):
+    client.get(URL, params={"type": "glucose"})
+    timeseries.loaded({"study_id": ["S1", "S2"], "participant_id": ["P2", "P1"]})
+    assert client.get(URL, params={"type": "glucose"}).headers["x-cache"] == "hit"
+    # the P1 row was rejected, so nothing of P1 was loaded
+    timeseries.loaded({"study_id": ["S1", "S1"], "participant_id": ["P2", "P1"]}, rejected={1})
+    assert client.get(URL, params={"type": "glucose"}).headers["x-cache"] == "hit"
+
+    async def job():
+        with timeseries.job_scope() as touched:
+            timeseries.loaded({"study_id": ["S1"], "participant_id": ["P1"]})
+            assert series_cache.get(("S1", "P1", "glucose", None, None, 500, "lttb")) is None
+            assert touched == {("S1", "P1")}
+    asyncio.run(job())
+    assert client.get(URL, params={"type": "glucose"}).headers["x-cache"] == "miss"
+    assert client.get("/cache/stats").json()["series"]["invalidations"] == 1
+
+
+def test_a_query_overtaken_by_a_load_is_not_cached(conn):
+    fetch = conn.fetch
+
+    async def fetch_during_load(sql, *args):
+        rows = await fetch(sql, *args)
+        if sql is timeseries.SELECT_SERIES:
+            timeseries.loaded({"study_id": ["S1"], "participant_id": ["P1"]})
+        return rows
+    conn.fetch = fetch_during_load
+
+    async def view():
+        type_id, start, end = await timeseries.parse_request("glucose", None, None, 100, "lttb")
+        return await timeseries.series("S1", "P1", "glucose", type_id, start, end, 100, "lttb")
+    assert asyncio.run(view())[1] is False
+    assert series_cache.stats()["entries"] == 0
+
+
+def test_cache_is_bounded_in_bytes():
+    cache = SeriesCache(max_bytes=250)
+    for i in range(5):
+        with cache.fill(("S1", f"P{i}")) as f:
+            cache.put(("S1", f"P{i}", "glucose", None, None, 500, "lttb"), b"x" * 100, f)
+    assert cache.stats()["entries"] == 2 and cache.bytes == 200 and cache.evictions == 3
+    assert cache.get(("S1", "P4", "glucose", None, None, 500, "lttb")) == b"x" * 100
+    assert cache.get(("S1", "P0", "glucose", None, None, 500, "lttb")) is None
+    assert not cache.filling
+
+
+def test_bad_series_requests(client: TestClient, conn):
+    assert client.get(URL).status_code == 422  # type is required
+    assert client.get(URL, params={"type": "nope"}).status_code == 400
+    assert client.get(URL, params={"type": "glucose", "method": "mean"}).status_code == 400
+    assert client.get(URL, params={"type": "glucose", "points": 2}).status_code == 400
+    assert client.get(URL, params={"type": "glucose", "from": "2024-01-02"}).status_code == 400  # no offset
+    params = {"type": "glucose", "from": "2024-01-02T00:00:00Z", "to": "2024-01-01T00:00:00Z"}
+    assert client.get(URL, params=params).status_code == 400
@@ -0,0 +1,63 @@
+# etl-service/tests/test_timestamps.py
+import itertools
+from datetime import timedelta
+
+import batchparse
+import timestamps
+from parsing import parse_row
+from timestamps import TimestampParser, parse_ts
+
+ODD = ["2024-01-15T09:30:00+02:00", "2024-01-15T09:30:00.5Z", "2024-02-30T09:30:00Z", "2024-01-15",
+       "2024-01-15 09:30:00", "15/01/2024 9:30", "not-a-date", " 2024-01-15T09:30:00Z", "", None]
+
+
+def same(a, b):
+    return a == b and (a is None or a.utcoffset() == b.utcoffset())
+
+
+def test_detect_picks_the_layout_most_values_use():
+    assert timestamps.detect(["2024-01-15T09:30:00Z"] * 5 + ["x"]).name == "utc"
+    assert timestamps.detect(["2024-01-15T09:30:00.250Z", None, ""]).name == "utc_fraction"
+    assert timestamps.detect(["2024-01-15T09:30:00-05:00"]).name == "offset"
+    assert timestamps.detect(["15/01/2024 9:30"] * 3) is None
+
+
+def test_parser_matches_parse_ts_and_learns_each_file():
+    p = TimestampParser()
+    utc = [f"2024-01-{d:02d}T09:{m:02d}:00Z" for d in range(1, 4) for m in range(20)]
+    for s in utc + ODD:
+        assert same(p.parse(s), parse_ts(s)), s
+    assert p.layout.name == "utc" and not p.memoized
+    p.reset()
+    offsets = [f"2024-03-01T10:{m:02d}:00+01:00" for m in range(10)] * 10  # readings sharing timestamps
+    for s in offsets:
+        assert same(p.parse(s), parse_ts(s)), s
+    assert p.layout.name == "offset" and p.memoized
+    assert p.parse.cache_info().hits >= 50  # the repeats after detection
+    p.reset()
+    for s in ["15/01/2024 9:30"] * 40 + ODD:
+        assert same(p.parse(s), parse_ts(s)), s
+    assert p.layout is None and p.parse is parse_ts
+
+
+def test_values_without_an_offset_are_utc():
+    values = ["2024-01-15T09:30:00Z", "2024-01-15 09:30:00"]
+    for parsed in ([parse_ts(v) for v in values], [timestamps.parse_fast(v) for v in values],
+                   timestamps.parse_column(values)):
+        assert parsed[0] == parsed[1] and parsed[1].utcoffset() == timedelta(0)
+    assert min(parsed) == max(parsed)  # comparable, so partitions can be planned
+
+
+def test_parse_column_matches_parse_ts_value_by_value():
+    for head in ("2024-01-15T09:30:00Z", "2024-01-15T09:30:00.5Z", "2024-01-15T09:30:00+02:00", "junk"):
+        values = [head] * 40 + list(itertools.islice(itertools.cycle(ODD), 40))
+        for got, s in zip(timestamps.parse_column(values), values):
+            assert same(got, parse_ts(s)), (head, s)
+
+
+def test_unparseable_timestamps_are_flagged_missing_ones_are_not():
+    rows = [{"study_id": "S1", "participant_id": "P1", "measurement_type": "glucose", "value": "95",
+             "unit": "mg/dL", "timestamp": ts, "site_id": "A", "quality_score": "1"}
+            for ts in ("2024-01-15T09:30:00Z", "yesterday", "", None)]
+    assert [list(parse_row(r)["flags"]) for r in rows] == [[], ["unparseable_timestamp"], [], []]
+    assert batchparse.parse_rows(rows) == [parse_row(r) for r in rows]
@@ -0,0 +1,139 @@
+# etl-service/tests/test_workqueue.py
+import asyncio
+import json
+from contextlib import asynccontextmanager
+
+import pytest
+from fastapi.testclient import TestClient
+
+import workqueue
+from checkpoint import Checkpoint
+from jobstore import job_store
+from workqueue import WorkQueue
+
+
+class FakeTx:
+    def __init__(self, conn):
+        self.conn = conn
+
+    async def __aenter__(self):
+        self.conn.log.append("BEGIN")
+
+    async def __aexit__(self, *exc):
+        self.conn.log.append("ROLLBACK" if exc[0] else "COMMIT")
+
+
+class FakeConn:
+    def __init__(self, renew="UPDATE 1"):
+        self.renew = renew
+        self.log = []
+
+    def transaction(self):
+        return FakeTx(self)
+
+    async def execute(self, sql, *args):
+        self.log.append((sql, args))
+        return self.renew if sql is workqueue.RENEW else "UPDATE 1"
+
+    async def fetchval(self, sql, *args):
+        self.log.append((sql, args))
+        return 7
+
+    async def fetchrow(self, sql, *args):
+        return None
+
+
+def use_conn(monkeypatch, conn):
+    @asynccontextmanager
+    async def fake_acquire():
+        yield conn
+    monkeypatch.setattr(workqueue.db, "acquire", fake_acquire)
+
+
+def item(kind="file", **args):
+    return {"id": 7, "job_id": "wq-1", "kind": kind, "args": json.dumps(args), "attempts": 1}
+
+
+def test_submit_queues_the_job_instead_of_running_it(client: TestClient, monkeypatch):
+    conn = FakeConn()
+    use_conn(monkeypatch, conn)
+    monkeypatch.setattr(workqueue, "MODE", "postgres")
+    r = client.post("/jobs", json={"jobId": "wq-submit", "filename": "f.csv", "studyId": "S1"})
+    assert r.status_code == 200 and r.json()["status"] == "queued"
+    assert "wq-submit" not in job_store.jobs  # whichever replica claims it owns it
+    assert conn.log[0] == "BEGIN" and conn.log[-1] == "COMMIT"
+    (upsert, job), (enqueue, args) = conn.log[1:3]
+    assert job[0] == "wq-submit" and job[3] == "queued"
+    assert enqueue is workqueue.ENQUEUE and args[:2] == ("wq-submit", "file")
+    assert json.loads(args[2])["study_id"] == "S1"
+
+
+def test_guard_raises_when_the_lease_was_taken_over():
+    async def run(renew):
+        token = workqueue._lease.set((7, "me"))
+        try:
+            await workqueue.guard()(FakeConn(renew))
+        finally:
+            workqueue._lease.reset(token)
+
+    assert workqueue.guard() is None  # not a queued job
+    asyncio.run(run("UPDATE 1"))
+    with pytest.raises(workqueue.LeaseLost):
+        asyncio.run(run("UPDATE 0"))
+
+
+def test_checkpoint_writes_check_the_lease_first():
+    conn = FakeConn("UPDATE 0")
+
+    async def run():
+        token = workqueue._lease.set((7, "me"))
+        try:
+            cp = Checkpoint("sha256:x", "wq-1")
+            cp.guard = workqueue.guard()
+            await cp.mark_rows(10)(conn)
+        finally:
+            workqueue._lease.reset(token)
+
+    with pytest.raises(workqueue.LeaseLost):
+        asyncio.run(run())
+    assert [sql for sql, _ in conn.log] == [workqueue.RENEW]  # the checkpoint never moved
+
+
+def test_finished_item_is_marked_done(monkeypatch):
+    conn = FakeConn()
+    use_conn(monkeypatch, conn)
+    ran = []
+
+    async def handler(job_id, filename):
+        ran.append((job_id, filename))
+        job_store.update(job_id, status="completed")
+
+    q = WorkQueue(worker_id="me")
+    q.register("file", handler)
+    q.pending = 1
+    asyncio.run(q._run(item(filename="f.csv")))
+    assert ran == [("wq-1", "f.csv")]
+    assert conn.log[-1] == (workqueue.FINISH, (7, "me", "done"))
+    assert q.finished == 1 and q.pending == 0 and job_store.jobs["wq-1"]["attempt"] == 1
+    job_store.forget("wq-1")
+
+
+def test_lost_lease_cancels_and_drops_the_job(monkeypatch):
+    conn = FakeConn(renew="UPDATE 0")
+    use_conn(monkeypatch, conn)
+    cancelled = []
+
+    async def handler(job_id):
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.append(job_id)
+            raise
+
+    q = WorkQueue(worker_id="me", lease_seconds=0.03)
+    q.register("batch", handler)
+    q.pending = 1
+    asyncio.run(q._run(item("batch")))
+    assert cancelled == ["wq-1"] and q.lost == 1
+    assert "wq-1" not in job_store.jobs and "wq-1" not in job_store.dirty
+    assert not any(s[0] is workqueue.FINISH for s in conn.log if isinstance(s, tuple))